@@ -0,0 +1,37 @@
+"""インデックス・キャッシュの保存先
+
+起動したフォルダに関係なく、GUI・コマンドライン・cron から同じファイルを使うよう、
+ユーザーごとのデータフォルダに置く。
+
+    Windows: %LOCALAPPDATA%\\enhanced_image_viewer
+    macOS:   ~/Library/Application Support/enhanced_image_viewer
+    その他:  $XDG_DATA_HOME/enhanced_image_viewer（既定は ~/.local/share/enhanced_image_viewer）
+
+環境変数 ENHANCED_IMAGE_VIEWER_DATA でフォルダを変更できる。
+"""
+import os
+import sys
+
+APP_NAME = "enhanced_image_viewer"
+DATA_DIR_ENV = "ENHANCED_IMAGE_VIEWER_DATA"
+
+
+def data_dir():
+    """データフォルダのパス（なければ作成する）"""
+    path = os.environ.get(DATA_DIR_ENV)
+    if not path:
+        if os.name == "nt":
+            base = os.environ.get("LOCALAPPDATA") or os.path.expanduser(os.path.join("~", "AppData", "Local"))
+        elif sys.platform == "darwin":
+            base = os.path.expanduser(os.path.join("~", "Library", "Application Support"))
+        else:
+            base = os.environ.get("XDG_DATA_HOME") or os.path.expanduser(os.path.join("~", ".local", "share"))
+        path = os.path.join(base, APP_NAME)
+    path = os.path.abspath(os.path.expanduser(path))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def data_path(name):
+    """データフォルダ内のファイル・フォルダのパス"""
+    return os.path.join(data_dir(), name)
@@ -0,0 +1,226 @@
+"""一括処理のコマンドライン版
+
+    python batch_cli.py convert INPUT [-o OUTPUT] [--format PNG|JPEG|WEBP] [--rename ...]
+    python batch_cli.py organize INPUT [-o OUTPUT] [--by model|vae|date|size] [--mode hardlink ...]
+    python batch_cli.py organize INPUT --by template --template "{model}/{sampler}" [--filter "steps >= 30"]
+    python batch_cli.py metadata INPUT [-o OUTPUT] (--find REGEX --replace TEXT | --strip)
+    python enhanced_image_viewer.py batch ...   （同じ。GUIのモジュールは読み込まない）
+
+オプションは一括処理ダイアログと同じ。進捗とエラーは標準出力に1行1件のJSONで出力する。
+organize を --dry-run で実行すると、最後にフォルダごとの件数を plan イベントで出力する。
+処理は BatchEngine で行うため、GUIから実行した場合と結果は同じになる。
+tkinter には依存しないこと（ディスプレイのない環境やcronから実行するため）。
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+
+from batch_engine import (BatchEngine, ProgressStats, default_worker_count, iter_inputs, make_options,
+                          start_counting, track_input_sizes)
+from file_transfer import TRANSFER_MODES
+from organize_template import FilterExpression, OrganizeTemplate
+
+# file イベントにはこの件数ごと（と最後）に処理速度と残り時間を付ける
+PROGRESS_INTERVAL = 100
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="batch_cli.py",
+        description="Convert, organize or edit the metadata of every image in a folder.")
+    subparsers = parser.add_subparsers(dest="process_type", required=True)
+
+    def add_common(subparser):
+        subparser.add_argument("input", help="input folder")
+        subparser.add_argument("-o", "--output", help="output folder (default: the input folder)")
+        subparser.add_argument("--workers", type=int, default=default_worker_count(),
+                               help="number of worker processes (default: CPU count)")
+        subparser.add_argument("--dry-run", action="store_true",
+                               help="report what would be written without writing anything")
+        subparser.add_argument("--include", action="append", default=[], metavar="GLOB",
+                               help="only process files matching the pattern (repeatable)")
+        subparser.add_argument("--exclude", action="append", default=[], metavar="GLOB",
+                               help="skip files and folders matching the pattern (repeatable)")
+        subparser.add_argument("--max-depth", type=int, metavar="N",
+                               help="scan at most N levels of subfolders (0: input folder only)")
+        subparser.add_argument("--no-resume", action="store_false", dest="resume",
+                               help="process files already recorded in the output folder's journal")
+        subparser.add_argument("--skip-up-to-date", action="store_true",
+                               help="skip files whose output is newer than the input")
+        subparser.add_argument("--index", dest="index_path", metavar="PATH",
+                               help="metadata index database (default: the per-user data folder)")
+
+    convert = subparsers.add_parser("convert", help="convert images to another format")
+    add_common(convert)
+    convert.add_argument("--format", choices=("PNG", "JPEG", "WEBP"), default="PNG",
+                         type=str.upper, dest="convert_format")
+    convert.add_argument("--rename", action="store_true", dest="enable_rename",
+                         help="rename output files")
+    convert.add_argument("--base-name", default="", help="base name (default: original name)")
+    convert.add_argument("--include-model", choices=("before", "after"),
+                         help="add the model name before or after the base name")
+    convert.add_argument("--include-date", choices=("before", "after"),
+                         help="add today's date before or after the base name")
+    convert.add_argument("--no-number", action="store_false", dest="include_number",
+                         help="do not add a sequence number")
+    convert.add_argument("--digits", type=int, default=3, dest="number_digits",
+                         help="digits of the sequence number (default: 3)")
+
+    organize = subparsers.add_parser("organize", help="copy images into subfolders")
+    add_common(organize)
+    organize.add_argument("--by", choices=("model", "vae", "date", "size", "template"), default="model",
+                          dest="organize_by")
+    organize.add_argument("--template", default="{model}", dest="organize_template",
+                          help='subfolder template for --by template, e.g. "{model}/{sampler}/{width}x{height}"')
+    organize.add_argument("--filter", default="", dest="organize_filter",
+                          help='only organize images matching this expression, e.g. "steps >= 30 and cfg < 8"')
+    organize.add_argument("--mode", choices=TRANSFER_MODES, default="copy", dest="organize_mode",
+                          help="how to place files (falls back to copy where unsupported)")
+    organize.add_argument("--no-skip-identical", action="store_false", dest="skip_identical",
+                          help="copy even if an identical file is already at the destination")
+    organize.add_argument("--link-identical", action="store_true",
+                          help="hardlink to an identical file already in the output folder instead of copying")
+
+    metadata = subparsers.add_parser("metadata", help="find/replace or strip generation parameters")
+    add_common(metadata)
+    action = metadata.add_mutually_exclusive_group(required=True)
+    action.add_argument("--find", dest="find_pattern", help="regular expression to replace")
+    action.add_argument("--strip", action="store_true", help="remove generation parameters")
+    metadata.add_argument("--replace", default="", dest="replace_with",
+                          help="replacement text (backreferences such as \\1 are allowed)")
+    return parser
+
+
+def build_options(args):
+    """コマンドライン引数を BatchEngine のオプションにする"""
+    output_path = os.path.abspath(args.output or args.input)
+    options = {
+        "output_path": output_path,
+        "process_type": args.process_type,
+        "dry_run": args.dry_run,
+        "in_place": output_path == os.path.abspath(args.input),
+        "include_patterns": args.include,
+        "exclude_patterns": args.exclude,
+        "max_depth": args.max_depth,
+        "resume": args.resume,
+        "skip_up_to_date": args.skip_up_to_date,
+        "index_path": os.path.abspath(args.index_path) if args.index_path else None,
+    }
+    if args.process_type == "convert":
+        options.update(
+            convert_format=args.convert_format,
+            enable_rename=args.enable_rename,
+            base_name=args.base_name,
+            include_model=args.include_model is not None,
+            model_position=args.include_model or "after",
+            include_date=args.include_date is not None,
+            date_position=args.include_date or "after",
+            include_number=args.include_number,
+            number_digits=args.number_digits,
+        )
+    elif args.process_type == "organize":
+        options.update(organize_by=args.organize_by, organize_mode=args.organize_mode,
+                       skip_identical=args.skip_identical, link_identical=args.link_identical,
+                       organize_template=args.organize_template, organize_filter=args.organize_filter)
+    else:  # metadata
+        options.update(
+            metadata_action="strip" if args.strip else "replace",
+            find_pattern=args.find_pattern or "",
+            replace_with=args.replace_with,
+        )
+    return make_options(**options)
+
+
+# 総数を数えるスレッドからも出力するため、1行ずつ排他的に書き出す
+_emit_lock = threading.Lock()
+
+
+def emit(event, **fields):
+    line = json.dumps({"event": event, **fields}, ensure_ascii=False)
+    with _emit_lock:
+        print(line, flush=True)
+
+
+def run(args):
+    options = build_options(args)
+    if args.workers <= 0:
+        emit("failed", error="--workers must be a positive number")
+        return 2
+    if not os.path.isdir(args.input):
+        emit("failed", error=f"Input folder does not exist: {args.input}")
+        return 2
+    if options["process_type"] == "metadata" and options["metadata_action"] == "replace":
+        try:
+            re.compile(options["find_pattern"])
+        except re.error as e:
+            emit("failed", error=f"Invalid regular expression: {e}")
+            return 2
+    if options["process_type"] == "organize":
+        try:
+            if options["organize_by"] == "template":
+                OrganizeTemplate(options["organize_template"])
+            if options["organize_filter"]:
+                FilterExpression(options["organize_filter"])
+        except ValueError as e:
+            emit("failed", error=str(e))
+            return 2
+    if not args.dry_run:
+        os.makedirs(options["output_path"], exist_ok=True)
+
+    engine = BatchEngine(args.process_type, options, args.workers)
+    stats = ProgressStats(scanning=True)
+    plan = {} if args.dry_run and args.process_type == "organize" else None
+
+    def on_count(count, finished):
+        stats.set_total(count, finished)
+        emit("scan", found=count, finished=finished)
+
+    try:
+        # 処理は見つけたファイルから順に始め、総数は別スレッドで数えて scan イベントで知らせる
+        emit("start", workers=engine.workers, dry_run=args.dry_run)
+        start_counting(args.input, options, on_count, engine.cancel_event)
+
+        sizes = {}
+        for index, file_path, output_path, error, status in engine.run_items(
+                track_input_sizes(iter_inputs(args.input, options), sizes)):
+            nbytes = sizes.pop(file_path, 0) if status != "skipped" else 0
+            stats.update(nbytes, error)
+            if plan is not None and output_path:
+                folder = os.path.relpath(os.path.dirname(output_path), options["output_path"])
+                plan[folder] = plan.get(folder, 0) + 1
+            event = {"index": index, "path": file_path, "output": output_path, "error": error,
+                     "status": status}
+            if stats.done % PROGRESS_INTERVAL == 0 or (not stats.scanning and stats.done == stats.total):
+                snapshot = stats.snapshot()
+                event.update(done=snapshot["done"], total=snapshot["total"],
+                             scanning=snapshot["scanning"],
+                             files_per_sec=round(snapshot["files_per_sec"], 2),
+                             mb_per_sec=round(snapshot["mb_per_sec"], 2),
+                             eta=None if snapshot["eta"] is None else round(snapshot["eta"], 1))
+            emit("file", **event)
+    except KeyboardInterrupt:
+        # 実行中のワーカーの完了を待ってから終了する
+        engine.cancel()
+    except Exception as e:
+        emit("failed", error=str(e))
+        return 2
+
+    if not engine.cancelled:
+        stats.set_total(stats.done)  # 数えた後に増減したファイルがあっても処理した数に合わせる
+    snapshot = stats.snapshot()
+    if plan is not None:
+        emit("plan", folders=dict(sorted(plan.items())))
+    emit("done", processed=snapshot["done"], total=snapshot["total"], outputs=engine.output_count,
+         skipped=engine.skipped_count, errors=len(engine.errors), elapsed=round(snapshot["elapsed"], 2), cancelled=engine.cancelled)
+    return 1 if engine.errors or engine.cancelled else 0
+
+
+def main(argv=None):
+    return run(build_parser().parse_args(argv))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,652 @@
+"""一括処理の実行エンジン
+
+BatchProcessingWindow から呼び出される変換・整理処理をまとめたモジュール。
+ワーカープロセスから読み込まれるため、tkinter には依存しないこと。
+"""
+import os
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+
+from PIL import Image
+
+from batch_journal import BatchJournal
+from file_transfer import transfer_file
+from folder_scanner import count_image_files
+from image_saver import collect_metadata, save_image
+from metadata_index import MetadataIndex, build_record, default_index_path
+from metadata_reader import read_image_metadata
+from metadata_writer import write_metadata
+from organize_template import RECORD_COLUMNS as TEMPLATE_RECORD_COLUMNS
+from organize_template import FilterExpression, OrganizeTemplate, orientation
+
+# 「メタデータを削除」で取り除くテキストのキー（A1111, ComfyUI, NovelAI）
+# JPEG/WEBP は EXIF の UserComment（parameters）だけが対象
+GENERATION_TEXT_KEYS = ("parameters", "prompt", "workflow", "Description", "Comment")
+
+# 処理オプションの既定値（BatchProcessingWindow.collect_options と同じキー）
+DEFAULT_OPTIONS = {
+    "output_path": ".",
+    "convert_format": "PNG",
+    "enable_rename": False,
+    "base_name": "",
+    "include_model": False,
+    "model_position": "after",
+    "include_date": False,
+    "date_position": "after",
+    "include_number": True,
+    "number_digits": 3,
+    "organize_by": "model",  # model, vae, date, size, template
+    "organize_template": "{model}",  # organize_by が template のときのサブフォルダ（organize_template を参照）
+    "organize_filter": "",  # 整理する画像の条件式（空なら全件）
+    "organize_mode": "copy",  # file_transfer.TRANSFER_MODES
+    "process_type": "convert",
+    "metadata_action": "replace",
+    "find_pattern": "",
+    "replace_with": "",
+    "dry_run": False,
+    "in_place": False,
+    "include_patterns": [],  # 走査の絞り込み（folder_scanner の glob）
+    "exclude_patterns": [],
+    "max_depth": None,
+    "resume": True,  # 出力フォルダのジャーナルに記録済みのファイルは処理しない
+    "skip_up_to_date": False,  # 出力が入力より新しければ処理しない
+    "skip_identical": True,  # 整理で出力先に同じ内容のファイルがあればコピーしない
+    "link_identical": False,  # 整理で出力フォルダ内に同じ内容のファイルがあればハードリンクにする
+    "index_path": None,  # メタデータインデックスのパス（None なら既定のデータフォルダ）
+}
+
+# ワーカーに渡すインデックスの列
+RECORD_COLUMNS = ("model", "vae", "width", "height")
+# テンプレート・条件式で整理するときに追加で受け取る列
+ORGANIZE_RECORD_COLUMNS = tuple(column for column in TEMPLATE_RECORD_COLUMNS if column not in RECORD_COLUMNS)
+# メタデータ処理で追加で受け取る列
+METADATA_RECORD_COLUMNS = ("format", "source", "parameters")
+
+# 整理でデータを複製する配置方法（同じ内容のファイルとの比較を行う）
+COPYING_MODES = ("copy",)
+
+# 並列処理で内容のハッシュをインデックスに書き込む間隔（件数と秒数のどちらかに達したら書き込む）
+DIGEST_COMMIT_COUNT = 1000
+DIGEST_COMMIT_SECONDS = 1.0
+
+_local = threading.local()
+
+
+def make_options(**overrides):
+    """既定値に指定した項目を上書きした処理オプションを返す"""
+    unknown = set(overrides) - set(DEFAULT_OPTIONS)
+    if unknown:
+        raise TypeError(f"Unknown batch options: {', '.join(sorted(unknown))}")
+    return {**DEFAULT_OPTIONS, **overrides}
+
+
+class UpToDate(Exception):
+    """出力が入力より新しい（skip_up_to_date）か、入力と同じ内容（skip_identical）のため処理しない"""
+
+    def __init__(self, output_path):
+        super().__init__(output_path)
+        self.output_path = output_path
+
+
+def _check_up_to_date(file_path, output_path, options):
+    if not options["skip_up_to_date"] or output_path == file_path:
+        return
+    try:
+        if os.path.getmtime(output_path) >= os.path.getmtime(file_path):
+            raise UpToDate(output_path)
+    except OSError:
+        pass  # 出力がまだない
+
+
+def _content_index(index_path):
+    """内容のハッシュを参照するインデックス（接続はプロセス・スレッドごとに作る）
+
+    計算したハッシュは書き込まずにためておき、処理結果と一緒に親プロセスへ返す
+    （複数のワーカーが1件ずつ同じデータベースに書き込まないようにする）。
+    """
+    index = getattr(_local, "index", None)
+    if index is None or index.db_path != (index_path or default_index_path()):
+        if index is not None:
+            index.close()
+        index = _local.index = MetadataIndex(index_path)
+        index.deferred_digests = {}
+    return index
+
+
+def _take_digests():
+    """この処理で計算した内容のハッシュを取り出す"""
+    index = getattr(_local, "index", None)
+    return index.take_deferred_digests() if index is not None else []
+
+
+def _check_identical(file_path, output_path, options):
+    if (os.path.exists(output_path)
+            and _content_index(options["index_path"]).same_content(file_path, output_path)):
+        raise UpToDate(output_path)
+
+
+def default_worker_count():
+    """既定のワーカー数（CPUコア数）"""
+    return os.cpu_count() or 1
+
+
+def generate_new_filename(file_path, record, index, options):
+    # ベース名を取得
+    base_name = options["base_name"]
+    if not base_name:
+        base_name = os.path.splitext(os.path.basename(file_path))[0]
+
+    # 連番を生成
+    if options["include_number"]:
+        number = str(index).zfill(options["number_digits"])
+    else:
+        number = ""
+
+    # モデル名を取得
+    model_name = ""
+    if options["include_model"] and record["model"]:
+        model_name = record["model"].split('_')[0]
+
+    # 日付を取得
+    date_str = ""
+    if options["include_date"]:
+        date_str = datetime.now().strftime("%Y%m%d")
+
+    # 名前の組み立て
+    elements = []
+
+    # 前置要素
+    if options["include_model"] and options["model_position"] == "before" and model_name:
+        elements.append(model_name)
+    if options["include_date"] and options["date_position"] == "before" and date_str:
+        elements.append(date_str)
+
+    # ベース名と連番
+    if base_name:
+        elements.append(base_name)
+    if number:
+        elements.append(number)
+
+    # 後置要素
+    if options["include_model"] and options["model_position"] == "after" and model_name:
+        elements.append(model_name)
+    if options["include_date"] and options["date_position"] == "after" and date_str:
+        elements.append(date_str)
+
+    return "_".join(elements)
+
+
+def convert_output_path(file_path, index, options, record=None):
+    """変換の出力パス（index はファイル名の連番）"""
+    # 出力ファイル名の生成
+    if options["enable_rename"]:
+        if record is None and options["include_model"]:
+            record = build_record(file_path)
+        output_filename = generate_new_filename(file_path, record or {"model": None}, index, options)
+    else:
+        output_filename = os.path.basename(file_path)
+
+    # 拡張子の変更
+    base_name = os.path.splitext(output_filename)[0]
+    return os.path.join(options["output_path"], f"{base_name}.{options['convert_format'].lower()}")
+
+
+def process_convert_file(file_path, index, options, record=None):
+    output_format = options["convert_format"]
+    output_path = convert_output_path(file_path, index, options, record)
+    _check_up_to_date(file_path, output_path, options)
+    if options.get("dry_run"):
+        return output_path
+
+    # 元画像のメタデータを付けて保存（JPEGの場合は背景を白にする）
+    image = Image.open(file_path)
+    save_image(image, output_path, collect_metadata(file_path), output_format)
+    return output_path
+
+
+@lru_cache(maxsize=8)
+def _organize_template(template):
+    return OrganizeTemplate(template)
+
+
+def organize_subfolder(file_path, record, options):
+    """整理先のサブフォルダ（出力フォルダからの相対パス）。インデックスの行から決め、画像は開かない"""
+    organize_by = options["organize_by"]
+    if organize_by == "template":
+        return _organize_template(options["organize_template"]).render(record)
+    if organize_by == "model":
+        return record["model"].split('_')[0] if record["model"] else "Unknown"
+    if organize_by == "vae":
+        return record["vae"].split('_')[0] if record["vae"] else "Unknown"
+    if organize_by == "date":
+        creation_time = os.path.getctime(file_path)
+        return datetime.fromtimestamp(creation_time).strftime("%Y-%m")
+    # size
+    return orientation(record["width"], record["height"]) or "Unknown"
+
+
+def process_organize_file(file_path, options, record=None):
+    if record is None and options["organize_by"] != "date":
+        record = build_record(file_path)
+    subfolder = organize_subfolder(file_path, record, options)
+
+    # サブフォルダの作成と配置（コピー・移動・リンク）
+    subfolder_path = os.path.join(options["output_path"], subfolder)
+    output_path = os.path.join(subfolder_path, os.path.basename(file_path))
+    _check_up_to_date(file_path, output_path, options)
+    mode = options["organize_mode"]
+    copying = mode in COPYING_MODES
+    if copying and options["skip_identical"]:
+        _check_identical(file_path, output_path, options)
+    if options.get("dry_run"):
+        return output_path
+    os.makedirs(subfolder_path, exist_ok=True)
+
+    index = None
+    if copying and (options["skip_identical"] or options["link_identical"]):
+        index = _content_index(options["index_path"])
+    if index is not None and options["link_identical"]:
+        # 出力フォルダ内の同じ内容のファイル（ハッシュを登録済みのもの）へのハードリンクにする
+        identical = index.find_identical(file_path, options["output_path"])
+        if identical is not None:
+            transfer_file(identical, output_path, "hardlink")  # 使えなければ同じ内容をコピーする
+            index.store_digest(output_path, index.content_digest(identical))
+            return output_path
+    transfer_file(file_path, output_path, mode)
+    if index is not None:
+        # 再実行時や後の入力との比較で出力を読まずに済むよう、出力のハッシュを登録しておく
+        index.store_digest(output_path, index.content_digest(file_path))
+    return output_path
+
+
+def edit_metadata_text(text, options):
+    """テキストメタデータ {キー: 値} に対する変更を {キー: 新しい値 or None(削除)} で返す"""
+    if options["metadata_action"] == "strip":
+        return {key: None for key in GENERATION_TEXT_KEYS if key in text}
+    parameters = text.get("parameters")
+    if not parameters:
+        return {}
+    replaced = re.sub(options["find_pattern"], options["replace_with"], parameters)
+    return {"parameters": replaced} if replaced != parameters else {}
+
+
+def _record_text(record, options):
+    """インデックスの行から変更の判定に必要なテキストを復元する（判定できなければ None）
+
+    A1111以外の形式は元のテキストが保存されていないため、画像のヘッダーを読み直す。
+    """
+    if not record or not all(column in record for column in METADATA_RECORD_COLUMNS):
+        return None
+    if record["source"] not in (None, "A1111"):
+        return None
+    if record["source"] is None and record["format"] == "PNG" and options["metadata_action"] == "strip":
+        return None  # 生成ツール不明のテキストチャンクが残っている可能性がある
+    return {"parameters": record["parameters"]} if record["parameters"] else {}
+
+
+def process_metadata_file(file_path, options, record=None):
+    """メタデータの置換・削除。画素は再エンコードせず、メタデータ部分だけを書き換える
+
+    変更がなければ None を返す。dry_run ではファイルを書き換えず、
+    書き換えるはずだった出力パスを返す（インデックスの行があれば画像も開かない）。
+    """
+    if options["in_place"]:
+        output_path = file_path
+    else:
+        output_path = os.path.join(options["output_path"], os.path.basename(file_path))
+    _check_up_to_date(file_path, output_path, options)
+
+    text = _record_text(record, options) if options["dry_run"] else None
+    if text is None:
+        metadata = read_image_metadata(file_path)
+        text = metadata["text"]
+        if metadata["format"] != "PNG":
+            # JPEG/WEBP で書き換えられるのは EXIF の UserComment だけ
+            text = {"parameters": text["parameters"]} if "parameters" in text else {}
+    changes = edit_metadata_text(text, options)
+    if not changes:
+        return None
+    if not options["dry_run"]:
+        write_metadata(file_path, changes, output_path)
+    return output_path
+
+
+def _scan_filters(input_path, options):
+    # 出力フォルダが入力フォルダの中にあれば走査しない
+    skip_dirs = ()
+    input_path = os.path.abspath(input_path)
+    output_path = os.path.abspath(options["output_path"] or input_path)
+    try:
+        if output_path != input_path and os.path.commonpath([input_path, output_path]) == input_path:
+            skip_dirs = (output_path,)
+    except ValueError:  # ドライブが異なる
+        pass
+    return {"include": options["include_patterns"], "exclude": options["exclude_patterns"],
+            "max_depth": options["max_depth"], "skip_dirs": skip_dirs}
+
+
+def iter_inputs(input_path, options):
+    """処理対象の (パス, インデックスの行) を見つけた順に返すジェネレータ
+
+    フォルダの走査と同時にインデックスを更新するため、最初のファイルからすぐに処理を始められる。
+    処理中に書き出されたファイルは対象にしない。
+    インデックスに接続するため、取り出しは1つのスレッドから行うこと。
+    """
+    columns = RECORD_COLUMNS
+    if options["process_type"] == "metadata":
+        columns += METADATA_RECORD_COLUMNS
+    expression = None
+    if options["process_type"] == "organize":
+        if options["organize_by"] == "template" or options["organize_filter"]:
+            columns += ORGANIZE_RECORD_COLUMNS
+        if options["organize_filter"]:
+            expression = FilterExpression(options["organize_filter"])
+    started = time.time()
+    with MetadataIndex(options["index_path"]) as metadata_index:
+        for file_path, record in metadata_index.iter_scan(input_path, columns, created_before=started,
+                                                          **_scan_filters(input_path, options)):
+            # 読めないファイルは条件を判定できないため、処理に渡してエラーにする
+            if expression is None or record is None or expression.matches(record):
+                yield file_path, record
+
+
+def track_input_sizes(items, sizes):
+    """(パス, 行) の列をそのまま返しながら、処理前の入力ファイルのサイズを sizes に記録する
+
+    移動した入力は処理後にサイズを取れないため、進捗の MB/s はここで記録したサイズで数える。
+    取り出した側は処理結果を受け取ったら sizes.pop(パス, 0) で取り除くこと。
+    """
+    for file_path, record in items:
+        if record and "size" in record:
+            sizes[file_path] = record["size"]
+        else:
+            try:
+                sizes[file_path] = os.path.getsize(file_path)
+            except OSError:
+                sizes[file_path] = 0
+        yield file_path, record
+
+
+def plan_organize(input_path, options, progress=None):
+    """整理の配置先を (入力パス, 出力パス) のリストで返す。ファイルは動かさない
+
+    インデックスの行だけから決めるため、変更のないファイルは画像を開かない。
+    読めないファイルの出力パスは None になる。progress が指定されていれば、確認した数で呼び出す。
+    """
+    plan = []
+    for file_path, record in iter_inputs(input_path, options):
+        try:
+            if record is None and options["organize_by"] != "date":
+                record = build_record(file_path)
+            subfolder = organize_subfolder(file_path, record, options)
+            output_path = os.path.join(options["output_path"], subfolder, os.path.basename(file_path))
+        except Exception:
+            output_path = None
+        plan.append((file_path, output_path))
+        if progress and len(plan) % 1000 == 0:
+            progress(len(plan))
+    return plan
+
+
+def start_counting(input_path, options, progress, stop_event=None):
+    """処理と並行して対象ファイルの総数を数えるスレッドを開始する
+
+    progress は (見つけた数, 完了したか) で呼ばれる（別スレッドから呼ばれる）。
+    条件式で絞り込む場合は数えられないため、スレッドを開始せずに None を返す。
+    """
+    if options["process_type"] == "organize" and options["organize_filter"]:
+        return None
+    thread = threading.Thread(
+        target=count_image_files, args=(input_path,), daemon=True,
+        kwargs=dict(_scan_filters(input_path, options), progress=progress, stop_event=stop_event))
+    thread.start()
+    return thread
+
+
+def process_file(process_type, file_path, index, options, record=None):
+    """1ファイル分の処理。(出力パス, エラー, 状態, 内容のハッシュ) を返す
+
+    状態は "done"・"unchanged"（メタデータ処理で変更なし）・"skipped"・"error"。
+    内容のハッシュは計算したもののリストで、親プロセスがインデックスに登録する。
+    例外はワーカー外へ持ち出さずに文字列で返す。
+    """
+    try:
+        if process_type == "convert":
+            output_path = process_convert_file(file_path, index, options, record)
+        elif process_type == "metadata":
+            output_path = process_metadata_file(file_path, options, record)
+        else:
+            output_path = process_organize_file(file_path, options, record)
+    except UpToDate as e:
+        result = e.output_path, None, "skipped"
+    except Exception as e:
+        result = None, str(e), "error"
+    else:
+        result = output_path, None, "done" if output_path is not None else "unchanged"
+    return result + (_take_digests(),)
+
+
+def _source_stat(file_path, record):
+    """入力ファイルの (サイズ, 更新日時)。インデックスの行にあればそれを使う"""
+    if record and "size" in record and "mtime" in record:
+        return record["size"], record["mtime"]
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime
+
+
+class BatchEngine:
+    """ファイル単位の処理をプロセスプールで並列実行する
+
+    結果は投入順に返すため、ログの順序は逐次処理と同じになる。
+    ファイル名の連番は出力フォルダのジャーナルに入力ファイルごとに記録し、再実行でも同じ番号を使う。
+    """
+
+    def __init__(self, process_type, options, workers=None):
+        self.process_type = process_type
+        self.options = options
+        self.workers = max(1, workers or default_worker_count())
+        self.cancel_event = threading.Event()
+        self.errors = []  # (file_path, message) のリスト
+        self.output_count = 0  # 出力した（メタデータ処理では変更した）ファイル数
+        self.skipped_count = 0  # 処理済み・出力が最新のため処理しなかったファイル数
+        self.journal = None
+        self.pending_digests = []  # ワーカーから受け取り、まだ登録していない内容のハッシュ
+        self.last_digest_commit = time.monotonic()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def run(self, image_files, records=None):
+        """(index, file_path, output_path, error, status) を入力順に返すジェネレータ
+
+        records にはメタデータインデックスの行を {パス: 行} で渡す。
+        含まれないファイルはワーカー側でメタデータを読み込む。
+        """
+        records = records or {}
+        yield from self.run_items((file_path, records.get(file_path)) for file_path in image_files)
+
+    def run_items(self, items):
+        """(file_path, 行 or None) の列を処理する。items は1件ずつ取り出すため、ジェネレータでもよい
+
+        resume が有効なら、出力フォルダのジャーナルに記録済みのファイルは処理せずに "skipped" とする。
+        変換ではジャーナルで別の入力ファイルの出力になっているパスには書き込まず、エラーにする。
+        """
+        if (self.options["resume"] or self.process_type == "convert") and self.options["output_path"]:
+            self.journal = BatchJournal(self.options["output_path"], self.options)
+        try:
+            if self.workers == 1:
+                yield from self._run_serial(items)
+            else:
+                yield from self._run_parallel(items)
+        finally:
+            if self.journal is not None:
+                self.journal.close()
+            self._flush_digests()
+
+    def _store_digests(self, digests):
+        """ワーカーが計算した内容のハッシュを登録する
+
+        書き込みは親プロセスの1つの接続だけで行う。並列処理ではまとめて書き込むため、
+        直前に処理したファイルの出力はほかのワーカーから最大 DIGEST_COMMIT_SECONDS 秒見えない。
+        逐次処理では次のファイルとの比較に使えるよう、毎回書き込む。
+        """
+        self.pending_digests.extend(digests)
+        if (self.workers == 1 or len(self.pending_digests) >= DIGEST_COMMIT_COUNT
+                or time.monotonic() - self.last_digest_commit >= DIGEST_COMMIT_SECONDS):
+            self._flush_digests()
+
+    def _flush_digests(self):
+        # トランザクションを開いたままにしない（同じスレッドで走査中のインデックスの書き込みを妨げるため）
+        if self.pending_digests:
+            _content_index(self.options["index_path"]).store_digests(self.pending_digests)
+            self.pending_digests = []
+        self.last_digest_commit = time.monotonic()
+
+    @property
+    def numbered(self):
+        """ファイル名に連番を付けるか"""
+        return (self.process_type == "convert" and self.options["enable_rename"]
+                and self.options["include_number"])
+
+    def _prepare(self, index, file_path, record):
+        """処理前の確認。(連番, 行, 結果) を返す（結果が None でなければ処理しない）"""
+        number = index
+        if self.journal is None:
+            return number, record, None
+        if self.numbered:
+            number = self.journal.number_for(file_path)
+        if self.options["resume"]:
+            stat = _source_stat(file_path, record)
+            if stat is not None and self.journal.is_done(file_path, *stat):
+                return number, record, (None, None, "skipped", [])
+        if self.process_type == "convert":
+            try:
+                if record is None and self.options["enable_rename"] and self.options["include_model"]:
+                    record = build_record(file_path)
+                output_path = convert_output_path(file_path, number, self.options, record)
+            except Exception:
+                return number, record, None  # 読めないファイルはワーカー側でエラーにする
+            owner = self.journal.claim_output(output_path, file_path)
+            if owner is not None:
+                return number, record, (None, f"Output {output_path} already belongs to {owner}", "error", [])
+        return number, record, None
+
+    def _record(self, index, file_path, record, result, number=None):
+        output_path, error, status, digests = result
+        if digests:
+            self._store_digests(digests)
+        if error is not None:
+            self.errors.append((file_path, error))
+        elif status == "skipped":
+            self.skipped_count += 1
+        elif output_path is not None:
+            self.output_count += 1
+        if self.journal is not None and status != "skipped" and not self.options["dry_run"]:
+            # 元のファイルを書き換えた場合は書き換え後の状態を記録する
+            stat = _source_stat(file_path, None if output_path == file_path else record)
+            if stat is not None:
+                self.journal.append(file_path, *stat, output_path, status, error,
+                                    number if self.numbered else None)
+        return index, file_path, output_path, error, status
+
+    def _run_serial(self, items):
+        for index, (file_path, record) in enumerate(items):
+            if self.cancelled:
+                return
+            number, record, result = self._prepare(index, file_path, record)
+            if result is None:
+                result = process_file(self.process_type, file_path, number, self.options, record)
+            yield self._record(index, file_path, record, result, number)
+
+    def _run_parallel(self, items):
+        # 投入済みの未完了タスクを一定数に抑え、キャンセル時に待ち時間が伸びないようにする
+        max_pending = self.workers * 4
+        pending = deque()
+        files = iter(enumerate(items))
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            try:
+                while True:
+                    while not self.cancelled and len(pending) < max_pending:
+                        try:
+                            index, (file_path, record) = next(files)
+                        except StopIteration:
+                            break
+                        number, record, result = self._prepare(index, file_path, record)
+                        if result is None:
+                            future = executor.submit(process_file, self.process_type,
+                                                     file_path, number, self.options, record)
+                        else:
+                            # 処理しないファイルも順序を保つため、完了済みの Future として並べる
+                            future = Future()
+                            future.set_result(result)
+                        pending.append((index, file_path, record, number, future))
+                    if not pending or self.cancelled:
+                        break
+                    index, file_path, record, number, future = pending.popleft()
+                    yield self._record(index, file_path, record, future.result(), number)
+            finally:
+                # 未着手のタスクは破棄し、実行中のものだけ完了を待つ
+                for *_, future in pending:
+                    future.cancel()
+
+
+class ProgressStats:
+    """処理済みファイル数・バイト数から速度と残り時間を計算する"""
+
+    def __init__(self, total=0, scanning=False):
+        self.total = total
+        self.scanning = scanning  # True の間は total が走査途中の見積もり
+        self.done = 0
+        self.bytes_done = 0
+        self.error_count = 0
+        self.start_time = time.monotonic()
+
+    def update(self, nbytes, error=None):
+        self.done += 1
+        self.bytes_done += nbytes
+        if error is not None:
+            self.error_count += 1
+
+    def set_total(self, total, finished=True):
+        self.total = total
+        self.scanning = not finished
+
+    def snapshot(self):
+        elapsed = max(time.monotonic() - self.start_time, 1e-6)
+        files_per_sec = self.done / elapsed
+        total = max(self.total, self.done)
+        remaining = total - self.done
+        return {
+            "done": self.done,
+            "total": total,
+            "scanning": self.scanning,
+            "errors": self.error_count,
+            "elapsed": elapsed,
+            "files_per_sec": files_per_sec,
+            "mb_per_sec": self.bytes_done / elapsed / (1024 * 1024),
+            "eta": remaining / files_per_sec if files_per_sec > 0 else None,
+        }
+
+
+def format_duration(seconds):
+    """秒数を H:MM:SS 形式の文字列にする"""
+    if seconds is None:
+        return "--:--"
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes:02d}:{seconds:02d}"
@@ -0,0 +1,108 @@
+"""一括処理の完了記録（ジャーナル）
+
+出力フォルダの .batch_journal.jsonl に、処理を終えた入力ファイルを1行1件で追記する。
+同じ設定で再実行すると、記録時から (サイズ, 更新日時) が変わっていないファイルは処理しない。
+途中で終了しても書き込み済みの行は残るため、続きから再開できる。
+
+行は処理の設定（出力に影響するオプション）ごとに区別し、設定を変えた再実行では使わない。
+
+ファイル名の連番はスキャン順ではなく入力ファイルごとに記録し、再実行でも同じ番号を使う
+（フォルダにファイルが増えても、既存の出力の番号がずれて別の画像で上書きされないようにする）。
+連番と出力先の記録は設定に関係なく出力フォルダ全体で共有する。
+"""
+import hashlib
+import json
+import os
+
+JOURNAL_NAME = ".batch_journal.jsonl"
+
+# 完了として扱う状態（"error" の行は次回も処理する）
+COMPLETED_STATUSES = ("done", "unchanged")
+
+# 出力に影響しないオプション（変えても同じ処理として扱う）
+RUN_OPTIONS = ("output_path", "dry_run", "include_patterns", "exclude_patterns", "max_depth",
+               "resume", "skip_up_to_date", "skip_identical", "organize_filter", "index_path")
+
+
+def job_key(options):
+    """出力に影響するオプションから処理の設定を識別する文字列を作る"""
+    settings = {key: value for key, value in options.items() if key not in RUN_OPTIONS}
+    data = json.dumps(settings, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()[:16]
+
+
+def _output_key(output_path):
+    return os.path.normcase(os.path.abspath(output_path))
+
+
+class BatchJournal:
+    """出力フォルダのジャーナルの読み込みと追記"""
+
+    def __init__(self, output_folder, options):
+        self.path = os.path.join(output_folder, JOURNAL_NAME)
+        self.job = job_key(options)
+        self.completed = {}  # パス -> (サイズ, 更新日時)
+        self.numbers = {}  # パス -> ファイル名の連番
+        self.outputs = {}  # 出力パス -> 入力パス
+        self.next_number = 0
+        self.file = None
+        self._load()
+
+    def _load(self):
+        try:
+            f = open(self.path, encoding="utf-8")
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # 書き込み途中で終了した行
+                if "number" in entry:
+                    self.numbers[entry["path"]] = entry["number"]
+                if entry.get("output") and entry.get("status") in COMPLETED_STATUSES:
+                    self.outputs[_output_key(entry["output"])] = entry["path"]
+                if entry.get("job") != self.job:
+                    continue
+                if entry.get("status") in COMPLETED_STATUSES:
+                    self.completed[entry["path"]] = (entry["size"], entry["mtime"])
+                else:
+                    self.completed.pop(entry["path"], None)
+
+        self.next_number = max(self.numbers.values(), default=-1) + 1
+
+    def is_done(self, path, size, mtime):
+        """記録時から変わっていない完了済みのファイルか"""
+        return self.completed.get(path) == (size, mtime)
+
+    def number_for(self, path):
+        """入力ファイルの連番（記録がなければ未使用の番号を割り当てる）"""
+        number = self.numbers.get(path)
+        if number is None:
+            number = self.numbers[path] = self.next_number
+            self.next_number += 1
+        return number
+
+    def claim_output(self, output_path, path):
+        """出力パスを入力ファイルに割り当てる。別の入力の出力として記録済みならその入力のパスを返す"""
+        owner = self.outputs.setdefault(_output_key(output_path), path)
+        return None if owner == path else owner
+
+    def append(self, path, size, mtime, output_path, status, error=None, number=None):
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+        entry = {"job": self.job, "path": path, "size": size, "mtime": mtime,
+                 "output": output_path, "status": status}
+        if number is not None:
+            entry["number"] = number
+        if error is not None:
+            entry["error"] = error
+        # 1行ずつ書き出し、異常終了しても完了した分は残るようにする
+        self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,82 @@
+"""生成パラメータ解析のマイクロベンチマーク
+
+    python benchmarks/bench_parse_parameters.py [件数]
+
+parse_parameters の1秒あたりの処理件数を、以前の正規表現による抽出
+（extract_ai_parameters で使っていた5回の re.search）と比較して表示する。
+設定行は解析時に分解するため、モデル名と数値の項目まで取り出す場合も測る。
+各関数は交互に繰り返し実行し、それぞれの最短時間で比べる（負荷の変動の影響を抑えるため）。
+"""
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from parameters_parser import parse_parameters  # noqa: E402
+
+TAGS = ["masterpiece", "best quality", "(ultra detailed:1.2)", "1girl", "solo", "looking at viewer",
+        "outdoors", "cherry blossoms", "<lora:detail_tweaker:0.6>", "cinematic lighting",
+        "depth of field", "sharp focus", "long hair", "smile", "school uniform", "blue sky"]
+NEGATIVE_TAGS = ["worst quality", "low quality", "(bad hands:1.3)", "extra fingers",
+                 "blurry", "watermark", "text", "jpeg artifacts"]
+
+
+def make_sample(rng):
+    prompt = ", ".join(rng.sample(TAGS, rng.randint(6, len(TAGS))))
+    negative = ", ".join(rng.sample(NEGATIVE_TAGS, rng.randint(3, len(NEGATIVE_TAGS))))
+    settings = (f"Steps: {rng.randint(20, 50)}, Sampler: DPM++ 2M Karras, "
+                f"CFG scale: {rng.choice([5, 6.5, 7])}, Seed: {rng.randint(0, 2**32)}, "
+                f"Size: {rng.choice(['512x768', '832x1216', '1024x1024'])}, "
+                f"Model hash: {rng.getrandbits(40):010x}, Model: sdxl_{rng.randint(1, 9)}, "
+                f"VAE: sdxl_vae.safetensors, "
+                f'Lora hashes: "detail_tweaker: {rng.getrandbits(48):012x}, style: {rng.getrandbits(48):012x}", '
+                f"Version: v1.10.1")
+    return f"{prompt}\nNegative prompt: {negative}\n{settings}"
+
+
+def legacy_parse(parameters):
+    model_match = re.search(r"Model:\s*(.*?)(,|$)", parameters)
+    vae_match = re.search(r"VAE:\s*(.*?)(,|$)", parameters)
+    prompt_match = re.search(r"^(.*?)(Negative prompt:)", parameters, re.DOTALL)
+    negative_prompt_match = re.search(r"Negative prompt:\s*(.*?)(Steps:)", parameters, re.DOTALL)
+    other_parameters_match = re.search(r"(Steps:.*)", parameters, re.DOTALL)
+    return model_match, vae_match, prompt_match, negative_prompt_match, other_parameters_match
+
+
+def parse_with_settings(parameters):
+    parsed = parse_parameters(parameters)
+    return parsed.model, parsed.vae, parsed.steps, parsed.seed, parsed.width
+
+
+def measure(funcs, samples, repeat=15):
+    """funcs を交互に repeat 回ずつ実行し、それぞれの1秒あたりの処理件数を返す"""
+    best = [float("inf")] * len(funcs)
+    for _ in range(repeat):
+        for index, func in enumerate(funcs):
+            start = time.perf_counter()
+            for sample in samples:
+                func(sample)
+            best[index] = min(best[index], time.perf_counter() - start)
+    return [len(samples) / elapsed for elapsed in best]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rng = random.Random(0)
+    samples = [make_sample(rng) for _ in range(count)]
+
+    parsed = parse_parameters(samples[0])
+    assert parsed.steps is not None and parsed.width is not None
+    assert "," in parsed.settings["Lora hashes"]
+
+    print(f"{count} strings, average length {sum(map(len, samples)) // count} chars")
+    plain, with_settings, legacy = measure([parse_parameters, parse_with_settings, legacy_parse], samples)
+    print(f"parse_parameters : {plain:>10,.0f} strings/s (prompt split and settings map)")
+    print(f"  + settings     : {with_settings:>10,.0f} strings/s (model, vae, steps, seed, width)")
+    print(f"legacy re.search : {legacy:>10,.0f} strings/s (no settings map, no typed fields)")
+
+if __name__ == "__main__":
+    main()
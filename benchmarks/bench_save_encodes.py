@@ -0,0 +1,125 @@
+"""編集後の保存処理でのエンコード・デコード回数の計測
+
+    python benchmarks/bench_save_encodes.py [幅] [高さ]
+
+反転・回転・トリミング・リサイズの各編集について、save_image と
+以前の save_edited_image の処理（保存後に開き直して parameters を付けて再保存）の
+エンコード回数・デコード回数・所要時間を表示する。
+save_image のエンコードが1回を超えた場合は終了コード1を返す。
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageFile, PngImagePlugin  # noqa: E402
+
+from image_saver import collect_metadata, save_image  # noqa: E402
+
+PARAMETERS = ("masterpiece, 1girl, cherry blossoms\nNegative prompt: lowres\n"
+              "Steps: 28, Sampler: Euler a, CFG scale: 7, Seed: 1, Size: 832x1216, Model: sdxl_base")
+
+EDITS = {
+    "flip": lambda image: image.transpose(Image.Transpose.FLIP_LEFT_RIGHT),
+    "rotate": lambda image: image.rotate(-90, expand=True),
+    "crop": lambda image: image.crop((10, 10, image.width // 2, image.height // 2)),
+    "resize": lambda image: image.resize((image.width // 2, image.height // 2), Image.Resampling.LANCZOS),
+}
+
+
+class Counter:
+    """Image.save と ImageFile.load の呼び出し回数を数える"""
+
+    def __init__(self):
+        self.encodes = 0
+        self.decodes = 0
+        self._save = Image.Image.save
+        self._load = ImageFile.ImageFile.load
+
+    def __enter__(self):
+        counter = self
+
+        def save(image, *args, **kwargs):
+            counter.encodes += 1
+            return counter._save(image, *args, **kwargs)
+
+        def load(image):
+            # 読み込み済みの画像に対する呼び出しは数えない
+            if image.tile:
+                counter.decodes += 1
+            return counter._load(image)
+
+        Image.Image.save = save
+        ImageFile.ImageFile.load = load
+        return self
+
+    def __exit__(self, *exc):
+        Image.Image.save = self._save
+        ImageFile.ImageFile.load = self._load
+
+
+def legacy_save(edited_image, source_path, save_path):
+    """以前の save_edited_image と同じ処理"""
+    if save_path.lower().endswith(('.jpg', '.jpeg')):
+        if edited_image.mode in ('RGBA', 'LA'):
+            background = Image.new('RGB', edited_image.size, (255, 255, 255))
+            background.paste(edited_image, mask=edited_image.split()[-1])
+            background.save(save_path, quality=95)
+        else:
+            edited_image.save(save_path, quality=95)
+    else:
+        edited_image.save(save_path)
+
+    if "parameters" in Image.open(source_path).info:
+        original_metadata = Image.open(source_path).info["parameters"]
+        with Image.open(save_path) as img:
+            img.info["parameters"] = original_metadata
+            img.save(save_path)
+
+
+def new_save(edited_image, source_path, save_path):
+    save_image(edited_image, save_path, collect_metadata(source_path))
+
+
+def measure(save, edit, source_path, save_path):
+    image = edit(Image.open(source_path))  # 編集前の読み込みは両方で共通のため数えない
+    with Counter() as counter:
+        start = time.perf_counter()
+        save(image, source_path, save_path)
+        elapsed = time.perf_counter() - start
+    return counter.encodes, counter.decodes, elapsed
+
+
+def main():
+    width = int(sys.argv[1]) if len(sys.argv) > 1 else 2048
+    height = int(sys.argv[2]) if len(sys.argv) > 2 else 2048
+
+    failed = False
+    with tempfile.TemporaryDirectory() as folder:
+        source_path = os.path.join(folder, "source.png")
+        pnginfo = PngImagePlugin.PngInfo()
+        pnginfo.add_text("parameters", PARAMETERS)
+        Image.linear_gradient("L").resize((width, height)).convert("RGB").save(source_path, pnginfo=pnginfo)
+
+        print(f"{width}x{height} PNG source")
+        print(f"{'edit':<8} {'output':<6} {'legacy enc/dec/ms':>20} {'new enc/dec/ms':>18}")
+        for name, edit in EDITS.items():
+            for extension in ("png", "jpg", "webp"):
+                save_path = os.path.join(folder, f"edited.{extension}")
+                legacy = measure(legacy_save, edit, source_path, save_path)
+                new = measure(new_save, edit, source_path, save_path)
+                saved_parameters = collect_metadata(save_path)["text"].get("parameters")
+                if new[0] != 1 or saved_parameters != PARAMETERS:
+                    failed = True
+                print(f"{name:<8} {extension:<6} "
+                      f"{legacy[0]:>7}/{legacy[1]}/{legacy[2] * 1000:>8.1f} "
+                      f"{new[0]:>7}/{new[1]}/{new[2] * 1000:>6.1f}")
+    if failed:
+        print("save_image must encode once and keep the parameters")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+"""ファイルの内容のハッシュ（完全一致の判定）
+
+整理処理で、出力先にすでに同じ内容のファイルがあればコピーしないために使う。
+ファイルは一定の大きさずつ読みながら BLAKE2b を計算するため、全体をメモリに読み込まない。
+ハッシュはメタデータインデックスに (サイズ, 更新日時) と一緒に保存し、
+変更のないファイルは読み直さない（MetadataIndex.content_digest を参照）。
+サイズが異なるファイルは内容も異なるため、ハッシュを計算する前にサイズで比較する。
+"""
+import hashlib
+
+CHUNK_SIZE = 1024 * 1024
+DIGEST_SIZE = 32
+
+
+def file_digest(path, chunk_size=CHUNK_SIZE):
+    """ファイルの内容の BLAKE2b を16進数の文字列で返す"""
+    digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            digest.update(view[:size])
+    return digest.hexdigest()
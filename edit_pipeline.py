@@ -0,0 +1,229 @@
+"""非破壊の画像編集
+
+反転・回転・トリミング・リサイズの操作を EditStack に記録し、画像には書き出すときに
+まとめて適用する。記録した操作は次の3段階に畳み込む。
+
+    元画像の範囲(box) → 回転・反転（1回の transpose） → 出力サイズへの縮小・拡大
+
+トリミングの範囲は元画像の座標に換算して保持するため、回転やリサイズの後に
+トリミングしても、実際の処理は「切り出してから縮小」の順になる。反転と回転は
+何回重ねても1回の transpose になる。編集中の表示は縮小したプロキシ画像に同じ処理を
+適用して作る。
+
+取り消し・やり直しの履歴は操作の列として持ち、状態は操作を先頭から畳み込み直して
+求める。全解像度の画像は履歴に含めず、各段階のプレビュー画像だけを容量の上限付きで保持する。
+"""
+from collections import OrderedDict
+
+from PIL import Image
+
+from image_saver import collect_metadata, save_image
+from preview_loader import fit_size
+
+# (回転数, 反転) -> transpose の種類
+# 状態 (r, f) は「左右反転(f=1のとき) → 反時計回りに90度 × r」を表す
+_TRANSPOSE_METHODS = {
+    (0, 0): None,
+    (1, 0): Image.Transpose.ROTATE_90,
+    (2, 0): Image.Transpose.ROTATE_180,
+    (3, 0): Image.Transpose.ROTATE_270,
+    (0, 1): Image.Transpose.FLIP_LEFT_RIGHT,
+    (1, 1): Image.Transpose.TRANSPOSE,
+    (2, 1): Image.Transpose.FLIP_TOP_BOTTOM,
+    (3, 1): Image.Transpose.TRANSVERSE,
+}
+
+# 操作名（元のファイル名に付ける接尾辞にも使う）
+OPERATIONS = ("flip_h", "flip_v", "rotate_l", "rotate_r", "crop", "resize")
+
+# 履歴のプレビュー画像に使うメモリの上限
+DEFAULT_SNAPSHOT_BYTES = 32 * 1024 * 1024
+
+
+def _map_point(x, y, size, rotation, flip):
+    """(x, y) を回転・反転後の座標に変換する（size は変換前の大きさ）"""
+    width, height = size
+    if flip:
+        x = width - x
+    for _ in range(rotation):
+        x, y, width, height = y, width - x, height, width
+    return x, y
+
+
+class EditStack:
+    """元画像に対する編集操作の列と、それを畳み込んだ結果"""
+
+    def __init__(self, source_size, max_snapshot_bytes=DEFAULT_SNAPSHOT_BYTES):
+        self.source_size = source_size
+        self.operations = []  # (操作名, 引数) のリスト
+        self.redo_operations = []  # 取り消した操作（最後に取り消したものが末尾）
+        self.max_snapshot_bytes = max_snapshot_bytes
+        self.snapshots = OrderedDict()  # (操作数, 表示サイズ) -> プレビュー画像（LRU）
+        self.snapshot_bytes = 0
+        self._reset()
+
+    def _reset(self):
+        self.box = (0.0, 0.0, float(self.source_size[0]), float(self.source_size[1]))
+        self.rotation = 0
+        self.flip = 0
+        self.size = self.source_size  # 出力サイズ（回転後の向き）
+
+    @property
+    def is_identity(self):
+        return not self.operations
+
+    @property
+    def can_undo(self):
+        return bool(self.operations)
+
+    @property
+    def can_redo(self):
+        return bool(self.redo_operations)
+
+    def oriented_box_size(self):
+        width, height = self.box[2] - self.box[0], self.box[3] - self.box[1]
+        return (height, width) if self.rotation % 2 else (width, height)
+
+    def apply(self, operation, argument=None):
+        """操作を1つ追加する
+
+        crop の引数は現在の出力座標での (left, top, right, bottom)、
+        resize の引数は新しい (幅, 高さ)。
+        """
+        if operation not in OPERATIONS:
+            raise ValueError(f"Unknown edit operation: {operation}")
+        self._apply(operation, argument)
+        self.operations.append((operation, argument))
+        # 新しい操作を行うと、やり直し用の履歴とそれ以降のプレビューは使えなくなる
+        self.redo_operations.clear()
+        self._discard_snapshots(len(self.operations))
+
+    def undo(self):
+        """最後の操作を取り消す（取り消せなければ False）"""
+        if not self.operations:
+            return False
+        self.redo_operations.append(self.operations.pop())
+        self._reset()
+        for operation, argument in self.operations:
+            self._apply(operation, argument)
+        return True
+
+    def redo(self):
+        """取り消した操作をやり直す（やり直せなければ False）"""
+        if not self.redo_operations:
+            return False
+        operation, argument = self.redo_operations.pop()
+        self._apply(operation, argument)
+        self.operations.append((operation, argument))
+        return True
+
+    def _apply(self, operation, argument):
+        if operation == "flip_h":
+            # F・R^r = R^-r・F
+            self.rotation, self.flip = -self.rotation % 4, 1 - self.flip
+        elif operation == "flip_v":
+            # 上下反転 = R^2・F
+            self.rotation, self.flip = (2 - self.rotation) % 4, 1 - self.flip
+        elif operation in ("rotate_l", "rotate_r"):
+            self.rotation = (self.rotation + (1 if operation == "rotate_l" else -1)) % 4
+            self.size = (self.size[1], self.size[0])
+        elif operation == "crop":
+            self._crop(argument)
+        else:  # resize
+            width, height = argument
+            if width <= 0 or height <= 0:
+                raise ValueError("Size must be positive")
+            self.size = (int(width), int(height))
+
+    def _crop(self, rect):
+        left, top, right, bottom = rect
+        left, right = sorted((max(0, left), min(self.size[0], right)))
+        top, bottom = sorted((max(0, top), min(self.size[1], bottom)))
+        if right - left < 1 or bottom - top < 1:
+            raise ValueError("Crop area is empty")
+
+        # 出力座標 → 回転後の元画像座標 → 回転前の範囲内の座標
+        oriented_size = self.oriented_box_size()
+        scale_x = oriented_size[0] / self.size[0]
+        scale_y = oriented_size[1] / self.size[1]
+        if self.flip:
+            inverse = (self.rotation, 1)  # 反転を含む変換は自身が逆変換
+        else:
+            inverse = (-self.rotation % 4, 0)
+        corners = [_map_point(x * scale_x, y * scale_y, oriented_size, *inverse)
+                   for x, y in ((left, top), (right, bottom))]
+        xs = sorted(x for x, _ in corners)
+        ys = sorted(y for _, y in corners)
+        x0, y0 = self.box[0], self.box[1]
+        self.box = (x0 + xs[0], y0 + ys[0], x0 + xs[1], y0 + ys[1])
+        self.size = (int(round(right - left)), int(round(bottom - top)))
+
+    def render(self, image, size=None):
+        """image（元画像またはその縮小版）に編集を適用する
+
+        size を省略すると出力サイズで作る。縮小版を渡した場合は範囲を比率で換算する。
+        """
+        size = size or self.size
+        scale_x = image.size[0] / self.source_size[0]
+        scale_y = image.size[1] / self.source_size[1]
+        box = (self.box[0] * scale_x, self.box[1] * scale_y,
+               self.box[2] * scale_x, self.box[3] * scale_y)
+        # 回転前の向きでの大きさ（縮小・拡大は画素数の少ない回転前に行う）
+        resized = (size[1], size[0]) if self.rotation % 2 else tuple(size)
+
+        integral = all(float(value).is_integer() for value in box)
+        if integral and resized == (box[2] - box[0], box[3] - box[1]):
+            if box != (0, 0, image.size[0], image.size[1]):
+                image = image.crop(tuple(int(value) for value in box))
+        else:
+            image = image.resize(resized, Image.Resampling.LANCZOS, box=box)
+
+        method = _TRANSPOSE_METHODS[(self.rotation, self.flip)]
+        if method is not None:
+            image = image.transpose(method)
+        return image
+
+    def render_preview(self, proxy, target):
+        """プロキシ画像から target に収まるプレビューを作る"""
+        return self.render(proxy, fit_size(self.size, target))
+
+    def preview(self, proxy, target):
+        """現在の段階のプレビュー（取り消し・やり直しで戻った段階は保持したものを使う）"""
+        key = (len(self.operations), tuple(target))
+        snapshot = self.snapshots.get(key)
+        if snapshot is not None:
+            self.snapshots.move_to_end(key)
+            return snapshot
+        snapshot = self.render_preview(proxy, target)
+        self.snapshots[key] = snapshot
+        self.snapshot_bytes += _image_bytes(snapshot)
+        # 上限を超えたら古いものから破棄する（破棄した段階は必要になったら作り直す）
+        while self.snapshot_bytes > self.max_snapshot_bytes and len(self.snapshots) > 1:
+            _, old = self.snapshots.popitem(last=False)
+            self.snapshot_bytes -= _image_bytes(old)
+        return snapshot
+
+    def _discard_snapshots(self, step):
+        """step 番目以降の段階のプレビューを破棄する"""
+        for key in [key for key in self.snapshots if key[0] >= step]:
+            self.snapshot_bytes -= _image_bytes(self.snapshots.pop(key))
+
+    def suffix(self):
+        """保存時のファイル名に付ける接尾辞（例: rotate_r_crop）"""
+        return "_".join(dict.fromkeys(operation for operation, _ in self.operations)) or "edited"
+
+
+def _image_bytes(image):
+    return image.size[0] * image.size[1] * len(image.getbands())
+
+
+def export_edits(source_path, stack, output_path):
+    """元画像を全解像度で1回だけ処理して保存する（メタデータは引き継ぐ）"""
+    image = Image.open(source_path)
+    if image.format == "JPEG":
+        # 出力が元画像より十分小さければ、JPEGは縮小スケールでデコードする
+        box_width, box_height = stack.oriented_box_size()
+        ratio = min(max(stack.size[0] / box_width, stack.size[1] / box_height), 1)
+        image.draft("RGB" if image.mode == "RGB" else None,
+                    (int(stack.source_size[0] * ratio) + 1, int(stack.source_size[1] * ratio) + 1))
+    save_image(stack.render(image), output_path, collect_metadata(source_path))
@@ -1,15 +1,37 @@
+import sys
+
+# "batch" サブコマンドはGUIのライブラリを読み込まずにコマンドライン版で実行する
+#   python enhanced_image_viewer.py batch convert|organize|metadata ...
+if __name__ == "__main__" and sys.argv[1:2] == ["batch"]:
+    from batch_cli import main
+    sys.exit(main(sys.argv[2:]))
+
 import tkinter as tk
 from tkinterdnd2 import DND_FILES, TkinterDnD
 import csv
 from PIL import Image, ImageTk, ExifTags
-import re
 import os
 import json
-import shutil
+import re
 import subprocess
+import multiprocessing
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import pyperclip
 from tkinter import messagebox, Menu, filedialog, ttk, simpledialog
+from folder_scanner import iter_image_dir_entries
+from metadata_index import MetadataIndex
+from thumbnail_cache import ThumbnailCache
+from preview_loader import fit_size, load_coarse_preview, load_preview
+from parameters_parser import format_parameters_text, parse_parameters, parse_settings
+from metadata_writer import write_metadata
+from edit_pipeline import EditStack, export_edits
+from batch_engine import (BatchEngine, ProgressStats, default_worker_count, format_duration, iter_inputs,
+                          plan_organize, start_counting, track_input_sizes)
+from organize_template import FilterExpression, OrganizeTemplate
 
 # プロンプト要素を分割して表示するためのクラス
 class PromptElementFrame(tk.Frame):
@@ -26,7 +48,12 @@ class PromptElementFrame(tk.Frame):
     def copy_text(self, text):
         pyperclip.copy(text)
 
+# メタデータがない場合の表示（編集時は空として扱う）
+NO_VALUE_TEXTS = ("N/A", "No Prompt Found", "No Negative Prompt Found", "No Other Parameters Found")
+
 class BatchProcessingWindow:
+    POLL_INTERVAL_MS = 100  # 進捗表示の更新間隔（10Hz）
+
     def __init__(self, parent):
         self.window = tk.Toplevel(parent)
         self.window.title("Batch Processing")
@@ -43,7 +70,7 @@ class BatchProcessingWindow:
         self.output_path = tk.StringVar()
         
         # 処理オプション
-        self.process_type = tk.StringVar(value="convert")  # convert または organize
+        self.process_type = tk.StringVar(value="convert")  # convert, organize, metadata
         
         # コンバートオプション
         self.convert_format = tk.StringVar(value="PNG")
@@ -52,6 +79,17 @@ class BatchProcessingWindow:
         
         # 整理オプション
         self.organize_by = tk.StringVar(value="model")  # model, vae, date, size
+        self.organize_mode = tk.StringVar(value="copy")  # copy, move, hardlink, symlink, reflink
+        self.organize_template = tk.StringVar(value="{model}/{sampler}")
+        self.organize_filter = tk.StringVar()
+        self.skip_identical = tk.BooleanVar(value=True)
+        self.link_identical = tk.BooleanVar(value=False)
+
+        # メタデータ編集オプション
+        self.metadata_action = tk.StringVar(value="replace")  # replace, strip
+        self.find_pattern = tk.StringVar()
+        self.replace_with = tk.StringVar()
+        self.dry_run = tk.BooleanVar(value=True)
         
         self.include_model = tk.BooleanVar(value=False)
         self.model_position = tk.StringVar(value="after")
@@ -62,6 +100,22 @@ class BatchProcessingWindow:
 
         self.output_type = tk.StringVar(value="same_as_input")
         self.subfolder_name = tk.StringVar(value="output")
+
+        # 走査の絞り込み（パターンは ; 区切り）
+        self.include_patterns = tk.StringVar()
+        self.exclude_patterns = tk.StringVar()
+        self.max_depth = tk.StringVar()
+
+        # 再実行時の省略
+        self.resume = tk.BooleanVar(value=True)
+        self.skip_up_to_date = tk.BooleanVar(value=False)
+
+        # 並列処理
+        self.worker_count = tk.StringVar(value=str(default_worker_count()))
+        self.engine = None
+        self.stats = None
+        self.progress_queue = None
+        self.close_requested = False
         
         self.setup_ui()
 
@@ -90,6 +144,16 @@ class BatchProcessingWindow:
         ttk.Label(input_frame, text="Input Folder:").pack(side=tk.LEFT, padx=5)
         ttk.Entry(input_frame, textvariable=self.input_path).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
         ttk.Button(input_frame, text="Browse", command=self.select_input_folder).pack(side=tk.LEFT, padx=5)
+
+        # 走査の絞り込み
+        filter_frame = ttk.Frame(path_frame)
+        filter_frame.pack(fill=tk.X, pady=2)
+        ttk.Label(filter_frame, text="Include:").pack(side=tk.LEFT, padx=5)
+        ttk.Entry(filter_frame, textvariable=self.include_patterns).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        ttk.Label(filter_frame, text="Exclude:").pack(side=tk.LEFT, padx=5)
+        ttk.Entry(filter_frame, textvariable=self.exclude_patterns).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        ttk.Label(filter_frame, text="Max Depth:").pack(side=tk.LEFT, padx=5)
+        ttk.Entry(filter_frame, textvariable=self.max_depth, width=5).pack(side=tk.LEFT, padx=5)
         
         # Output Folder オプション
         output_option_frame = ttk.Frame(path_frame)
@@ -129,6 +193,9 @@ class BatchProcessingWindow:
         ttk.Radiobutton(process_frame, text="Organize Files", 
                     variable=self.process_type, value="organize",
                     command=self.update_options_visibility).pack(anchor=tk.W, padx=5, pady=2)
+        ttk.Radiobutton(process_frame, text="Edit Metadata", 
+                    variable=self.process_type, value="metadata",
+                    command=self.update_options_visibility).pack(anchor=tk.W, padx=5, pady=2)
 
         # コンバートオプションフレーム
         self.convert_options_frame = ttk.LabelFrame(self.window, text="Convert Options")
@@ -206,6 +273,49 @@ class BatchProcessingWindow:
                     variable=self.organize_by, value="date").pack(anchor=tk.W, padx=5, pady=2)
         ttk.Radiobutton(self.organize_options_frame, text="By Size", 
                     variable=self.organize_by, value="size").pack(anchor=tk.W, padx=5, pady=2)
+
+        # テンプレートと条件式（例: {model}/{sampler}/{width}x{height}、steps >= 30 and cfg < 8）
+        template_frame = ttk.Frame(self.organize_options_frame)
+        template_frame.pack(fill=tk.X, padx=5, pady=2)
+        ttk.Radiobutton(template_frame, text="By Template:",
+                        variable=self.organize_by, value="template").pack(side=tk.LEFT)
+        ttk.Entry(template_frame, textvariable=self.organize_template).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        filter_frame = ttk.Frame(self.organize_options_frame)
+        filter_frame.pack(fill=tk.X, padx=5, pady=2)
+        ttk.Label(filter_frame, text="Filter:").pack(side=tk.LEFT, padx=5)
+        ttk.Entry(filter_frame, textvariable=self.organize_filter).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        ttk.Button(filter_frame, text="Preview Plan...", command=self.preview_plan).pack(side=tk.LEFT, padx=5)
+
+        # 配置方法（リンク・移動はデータをコピーしない。使えない場合はコピーする）
+        mode_frame = ttk.Frame(self.organize_options_frame)
+        mode_frame.pack(anchor=tk.W, padx=5, pady=2)
+        ttk.Label(mode_frame, text="Method:").pack(side=tk.LEFT, padx=5)
+        for text, value in (("Copy", "copy"), ("Move", "move"), ("Hard Link", "hardlink"),
+                            ("Symbolic Link", "symlink"), ("Reflink (CoW)", "reflink")):
+            ttk.Radiobutton(mode_frame, text=text, variable=self.organize_mode,
+                            value=value).pack(side=tk.LEFT, padx=5)
+
+        # 同じ内容のファイルの扱い（コピーする場合のみ）
+        ttk.Checkbutton(self.organize_options_frame, text="Skip files already at the destination with identical content",
+                        variable=self.skip_identical).pack(anchor=tk.W, padx=5, pady=2)
+        ttk.Checkbutton(self.organize_options_frame, text="Hard link to identical files in the output folder instead of copying",
+                        variable=self.link_identical).pack(anchor=tk.W, padx=5, pady=2)
+
+        # メタデータ編集オプションフレーム（画素は再エンコードしない）
+        self.metadata_options_frame = ttk.LabelFrame(self.window, text="Metadata Options")
+
+        replace_frame = ttk.Frame(self.metadata_options_frame)
+        replace_frame.pack(fill=tk.X, padx=5, pady=2)
+        ttk.Radiobutton(replace_frame, text="Find/Replace (regex):",
+                    variable=self.metadata_action, value="replace").pack(side=tk.LEFT, padx=5)
+        ttk.Entry(replace_frame, textvariable=self.find_pattern).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        ttk.Label(replace_frame, text="→").pack(side=tk.LEFT)
+        ttk.Entry(replace_frame, textvariable=self.replace_with).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+
+        ttk.Radiobutton(self.metadata_options_frame, text="Strip generation parameters",
+                    variable=self.metadata_action, value="strip").pack(anchor=tk.W, padx=10, pady=2)
+        ttk.Checkbutton(self.metadata_options_frame, text="Dry run (only count files that would change)",
+                        variable=self.dry_run).pack(anchor=tk.W, padx=10, pady=2)
         
         # 進行状況フレーム
         progress_frame = ttk.LabelFrame(self.window, text="Progress")
@@ -218,8 +328,25 @@ class BatchProcessingWindow:
         self.status_var = tk.StringVar(value="Ready")
         ttk.Label(progress_frame, textvariable=self.status_var).pack(padx=5, pady=5)
         
+        # 並列実行オプション
+        workers_frame = ttk.Frame(progress_frame)
+        workers_frame.pack(anchor=tk.W, padx=5, pady=2)
+        ttk.Label(workers_frame, text="Workers:").pack(side=tk.LEFT, padx=5)
+        ttk.Spinbox(workers_frame, from_=1, to=max(64, default_worker_count()),
+                    textvariable=self.worker_count, width=5).pack(side=tk.LEFT, padx=5)
+        ttk.Checkbutton(progress_frame, text="Skip files already processed (resume from journal)",
+                        variable=self.resume).pack(anchor=tk.W, padx=5, pady=2)
+        ttk.Checkbutton(progress_frame, text="Skip files whose output is newer than the input",
+                        variable=self.skip_up_to_date).pack(anchor=tk.W, padx=5, pady=2)
+
         # 実行ボタン
-        ttk.Button(self.window, text="Start Processing", command=self.start_processing).pack(pady=10)
+        button_frame = ttk.Frame(self.window)
+        button_frame.pack(pady=10)
+        self.start_button = ttk.Button(button_frame, text="Start Processing", command=self.start_processing)
+        self.start_button.pack(side=tk.LEFT, padx=5)
+        self.cancel_button = ttk.Button(button_frame, text="Cancel", command=self.cancel_processing,
+                                        state="disabled")
+        self.cancel_button.pack(side=tk.LEFT, padx=5)
         
         # 初期表示状態の設定
         self.update_options_visibility()
@@ -228,17 +355,28 @@ class BatchProcessingWindow:
         if self.process_type.get() == "convert":
             self.convert_options_frame.pack(fill=tk.X, padx=5, pady=5)
             self.organize_options_frame.pack_forget()
+            self.metadata_options_frame.pack_forget()
             # リネームオプションの表示/非表示
             if self.enable_rename.get():
                 self.rename_options_frame.pack(anchor=tk.W, padx=20, pady=2)
             else:
                 self.rename_options_frame.pack_forget()
+        elif self.process_type.get() == "metadata":
+            self.convert_options_frame.pack_forget()
+            self.organize_options_frame.pack_forget()
+            self.metadata_options_frame.pack(fill=tk.X, padx=5, pady=5)
         else:  # organize
             self.convert_options_frame.pack_forget()
+            self.metadata_options_frame.pack_forget()
             self.organize_options_frame.pack(fill=tk.X, padx=5, pady=5)
             
     def on_closing(self):
         self.window.grab_release()  # モーダル状態を解除
+        if self.engine:
+            # 処理中は停止を要求し、ループ終了後にウィンドウを閉じる
+            self.close_requested = True
+            self.engine.cancel()
+            return
         self.window.destroy()
 
     def update_output_visibility(self):
@@ -256,14 +394,45 @@ class BatchProcessingWindow:
             self.custom_output_frame.pack(fill=tk.X, pady=2)
 
     def start_processing(self):
+        if self.engine:  # 処理中
+            return
+
+        options = self.prepare_options()
+        if options is None:
+            return
+
+        try:
+            workers = int(self.worker_count.get())
+            if workers <= 0:
+                raise ValueError
+        except ValueError:
+            messagebox.showerror("Error", "Please enter a valid number of workers")
+            return
+
+        self.engine = BatchEngine(options["process_type"], options, workers)
+        self.stats = ProgressStats(scanning=True)
+        self.progress_var.set(0)
+        self.status_var.set("Scanning input folder...")
+        self.start_button.config(state="disabled")
+        self.cancel_button.config(state="normal")
+
+        # 処理は別スレッドで行い、進捗はキュー経由で定期的に反映する
+        self.progress_queue = queue.Queue()
+        threading.Thread(target=self.run_batch,
+                         args=(self.engine, self.input_path.get(), self.progress_queue),
+                         daemon=True).start()
+        self.window.after(self.POLL_INTERVAL_MS, self.poll_progress)
+
+    def prepare_options(self, create_output=True):
+        """入力を確認して処理オプションを返す（不正な入力はエラーを表示して None を返す）"""
         # 入力フォルダーのチェック
         if not self.input_path.get():
             messagebox.showerror("Error", "Please select input folder")
-            return
-        
+            return None
+
         if not os.path.exists(self.input_path.get()):
             messagebox.showerror("Error", "Input folder does not exist")
-            return
+            return None
         
         # 出力フォルダーの設定
         output_type = self.output_type.get()
@@ -273,161 +442,690 @@ class BatchProcessingWindow:
             subfolder = self.subfolder_name.get().strip()
             if not subfolder:
                 messagebox.showerror("Error", "Please enter subfolder name")
-                return
+                return None
             self.output_path.set(os.path.join(self.input_path.get(), subfolder))
         else:  # custom
             if not self.output_path.get():
                 messagebox.showerror("Error", "Please select output folder")
-                return
-        
+                return None
+
         # 出力フォルダーの作成
-        if not os.path.exists(self.output_path.get()):
+        if create_output and not os.path.exists(self.output_path.get()):
             try:
                 os.makedirs(self.output_path.get())
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to create output folder: {str(e)}")
-                return
+                return None
 
-        # 処理対象のファイルを取得
-        image_files = []
-        for root, _, files in os.walk(self.input_path.get()):
-            for file in files:
-                if file.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')):
-                    image_files.append(os.path.join(root, file))
+        max_depth = self.max_depth.get().strip()
+        if max_depth and not max_depth.isdigit():
+            messagebox.showerror("Error", "Please enter a valid max depth (empty for no limit)")
+            return None
+
+        # 処理オプションの取得
+        try:
+            options = self.collect_options()
+        except ValueError:
+            messagebox.showerror("Error", "Please enter a valid number of digits")
+            return None
+        if options["process_type"] == "metadata" and options["metadata_action"] == "replace":
+            try:
+                re.compile(options["find_pattern"])
+            except re.error as e:
+                messagebox.showerror("Error", f"Invalid regular expression: {str(e)}")
+                return None
+        if options["process_type"] == "organize":
+            try:
+                if options["organize_by"] == "template":
+                    OrganizeTemplate(options["organize_template"])
+                if options["organize_filter"]:
+                    FilterExpression(options["organize_filter"])
+            except ValueError as e:
+                messagebox.showerror("Error", str(e))
+                return None
+        return options
 
-        if not image_files:
-            messagebox.showinfo("Info", "No image files found in input folder")
+    def preview_plan(self):
+        """整理の配置先を計算して表示する（ファイルは動かさない）"""
+        if self.engine:  # 処理中
             return
+        options = self.prepare_options(create_output=False)
+        if options is None:
+            return
+        input_path = self.input_path.get()
+        self.status_var.set("Planning...")
+        result = queue.Queue()
 
-        total_files = len(image_files)
-        
-        for i, file_path in enumerate(image_files):
+        def plan():
+            try:
+                result.put(("done", plan_organize(input_path, options)))
+            except Exception as e:
+                result.put(("error", str(e)))
+
+        def poll():
             try:
-                # 進捗状況の更新
-                progress = (i + 1) / total_files * 100
-                self.progress_var.set(progress)
-                self.status_var.set(f"Processing {i+1}/{total_files}: {os.path.basename(file_path)}")
-                self.window.update()
+                status, value = result.get_nowait()
+            except queue.Empty:
+                self.window.after(self.POLL_INTERVAL_MS, poll)
+                return
+            self.status_var.set("Ready")
+            if status == "done":
+                OrganizePlanWindow(self.window, value, options["output_path"], self.start_processing)
+            else:
+                messagebox.showerror("Error", f"Error planning: {value}", parent=self.window)
 
-                if self.process_type.get() == "convert":
-                    self.process_convert_file(file_path, i)  # インデックスiを渡す
-                else:  # organize
-                    self.process_organize_file(file_path)
+        threading.Thread(target=plan, daemon=True).start()
+        self.window.after(self.POLL_INTERVAL_MS, poll)
 
-            except Exception as e:
-                messagebox.showerror("Error", f"Error processing {file_path}: {str(e)}")
+    def run_batch(self, engine, input_path, progress_queue):
+        """バックグラウンドスレッドで実行（Tkには触れない）"""
+        try:
+            # 見つけたファイルから順に処理する（総数は別スレッドで数えながら更新する）
+            start_counting(input_path, engine.options,
+                           lambda count, finished: progress_queue.put(("total", count, finished)),
+                           engine.cancel_event)
+            sizes = {}
+            for _, file_path, _, error, status in engine.run_items(
+                    track_input_sizes(iter_inputs(input_path, engine.options), sizes)):
+                nbytes = sizes.pop(file_path, 0) if status != "skipped" else 0
+                progress_queue.put(("file", file_path, nbytes, error))
+        except Exception as e:
+            progress_queue.put(("failed", str(e)))
+        finally:
+            progress_queue.put(("done",))
+
+    def poll_progress(self):
+        """キューに溜まった進捗をまとめて取り出し、表示を1回だけ更新する"""
+        finished = False
+        last_file = None
+        failure = None
+        try:
+            while True:
+                event = self.progress_queue.get_nowait()
+                if event[0] == "total":
+                    self.stats.set_total(event[1], event[2])
+                elif event[0] == "file":
+                    _, last_file, nbytes, error = event
+                    self.stats.update(nbytes, error)
+                elif event[0] == "failed":
+                    failure = event[1]
+                else:  # done
+                    finished = True
+        except queue.Empty:
+            pass
+
+        if last_file:
+            snapshot = self.stats.snapshot()
+            if snapshot["total"]:
+                self.progress_var.set(snapshot["done"] / snapshot["total"] * 100)
+            total = f"{snapshot['total']}+" if snapshot["scanning"] else snapshot["total"]
+            self.status_var.set(
+                f"Processing {snapshot['done']}/{total}: {os.path.basename(last_file)}\n"
+                f"{snapshot['files_per_sec']:.1f} files/s, {snapshot['mb_per_sec']:.1f} MB/s, "
+                f"ETA {format_duration(snapshot['eta'])}, errors: {snapshot['errors']}")
+
+        if finished:
+            self.finish_processing(failure)
+        else:
+            self.window.after(self.POLL_INTERVAL_MS, self.poll_progress)
 
-        messagebox.showinfo("Success", "Processing completed!")
+    def finish_processing(self, failure=None):
+        engine = self.engine
+        self.engine = None
 
-    def process_convert_file(self, file_path, index):
-        # 画像を開く
-        image = Image.open(file_path)
-        output_format = self.convert_format.get()
-        
-        # 出力ファイル名の生成
-        if self.enable_rename.get():
-            output_filename = self.generate_new_filename(file_path, image, index)
+        if self.close_requested:
+            self.window.destroy()
+            return
+
+        self.start_button.config(state="normal")
+        self.cancel_button.config(state="disabled")
+
+        if failure:
+            messagebox.showerror("Error", f"Batch processing failed: {failure}", parent=self.window)
+        elif self.stats.done == 0 and not engine.cancelled:
+            self.status_var.set("Ready")
+            messagebox.showinfo("Info", "No image files found in input folder", parent=self.window)
         else:
-            output_filename = os.path.basename(file_path)
-        
-        # 拡張子の変更
-        base_name = os.path.splitext(output_filename)[0]
-        output_filename = f"{base_name}.{output_format.lower()}"
-        output_path = os.path.join(self.output_path.get(), output_filename)
-
-        # JPEGの場合は背景を白にして保存
-        if output_format == "JPEG":
-            if image.mode in ('RGBA', 'LA'):
-                background = Image.new('RGB', image.size, (255, 255, 255))
-                background.paste(image, mask=image.split()[-1])
-                background.save(output_path, format=output_format, quality=95)
+            self.show_results(engine)
+
+    def cancel_processing(self):
+        if self.engine:
+            self.engine.cancel()
+            self.status_var.set("Cancelling...")
+
+    def collect_options(self):
+        """Tk変数から処理オプションを取り出す（ワーカープロセスへ渡すため）"""
+        return {
+            "output_path": self.output_path.get(),
+            "convert_format": self.convert_format.get(),
+            "enable_rename": self.enable_rename.get(),
+            "base_name": self.custom_name_entry.get().strip(),
+            "include_model": self.include_model.get(),
+            "model_position": self.model_position.get(),
+            "include_date": self.include_date.get(),
+            "date_position": self.date_position.get(),
+            "include_number": self.include_number.get(),
+            "number_digits": int(self.number_digits.get()),
+            "organize_by": self.organize_by.get(),
+            "organize_mode": self.organize_mode.get(),
+            "organize_template": self.organize_template.get().strip(),
+            "organize_filter": self.organize_filter.get().strip(),
+            "skip_identical": self.skip_identical.get(),
+            "link_identical": self.link_identical.get(),
+            "process_type": self.process_type.get(),
+            "metadata_action": self.metadata_action.get(),
+            "find_pattern": self.find_pattern.get(),
+            "replace_with": self.replace_with.get(),
+            "dry_run": self.process_type.get() == "metadata" and self.dry_run.get(),
+            # 入力フォルダーへ出力する場合は元のファイルを書き換える
+            "in_place": self.output_type.get() == "same_as_input",
+            "include_patterns": self.split_patterns(self.include_patterns.get()),
+            "exclude_patterns": self.split_patterns(self.exclude_patterns.get()),
+            "max_depth": int(self.max_depth.get()) if self.max_depth.get().strip() else None,
+            "resume": self.resume.get(),
+            "skip_up_to_date": self.skip_up_to_date.get(),
+        }
+
+    @staticmethod
+    def split_patterns(text):
+        return [pattern.strip() for pattern in text.split(";") if pattern.strip()]
+
+    def show_results(self, engine):
+        """処理結果をまとめて表示（ファイルごとのエラーは一覧にする）"""
+        if engine.cancelled:
+            self.status_var.set("Cancelled")
+            title = "Cancelled"
+            message = "Processing was cancelled."
+        else:
+            title = "Success"
+            message = "Processing completed!"
+        if engine.process_type == "metadata":
+            if engine.options["dry_run"]:
+                message += f"\n\n{engine.output_count} file(s) would change."
             else:
-                image.save(output_path, format=output_format, quality=95)
+                message += f"\n\n{engine.output_count} file(s) updated."
+        if engine.skipped_count:
+            message += f"\n{engine.skipped_count} file(s) skipped (already processed or up to date)."
+
+        if engine.errors:
+            lines = [f"{os.path.basename(path)}: {error}" for path, error in engine.errors[:10]]
+            if len(engine.errors) > 10:
+                lines.append(f"... and {len(engine.errors) - 10} more")
+            message += f"\n\n{len(engine.errors)} file(s) failed:\n" + "\n".join(lines)
+            messagebox.showwarning(title, message, parent=self.window)
         else:
-            image.save(output_path, format=output_format)
-
-    def process_organize_file(self, file_path):
-        # 画像を開いてメタデータを取得
-        image = Image.open(file_path)
-        organize_by = self.organize_by.get()
-        
-        # 整理方法に基づいてサブフォルダを決定
-        if organize_by == "model":
-            info = image.info.get("parameters", "")
-            model_match = re.search(r"Model:\s*(.*?)(,|$)", info)
-            subfolder = model_match.group(1).split('_')[0] if model_match else "Unknown"
-        elif organize_by == "vae":
-            info = image.info.get("parameters", "")
-            vae_match = re.search(r"VAE:\s*(.*?)(,|$)", info)
-            subfolder = vae_match.group(1).split('_')[0] if vae_match else "Unknown"
-        elif organize_by == "date":
-            creation_time = os.path.getctime(file_path)
-            subfolder = datetime.fromtimestamp(creation_time).strftime("%Y-%m")
-        else:  # size
-            width, height = image.size
-            ratio = width / height
-            if 0.9 <= ratio <= 1.1:
-                subfolder = "Square"
-            elif ratio > 1.1:
-                subfolder = "Landscape"
+            messagebox.showinfo(title, message, parent=self.window)
+
+class OrganizePlanWindow:
+    """整理の配置先のプレビュー（フォルダごとの件数と、各フォルダのファイルの一部）"""
+    SAMPLE_FILES = 20  # フォルダごとに表示するファイル数
+
+    def __init__(self, parent, plan, output_folder, on_start):
+        self.window = tk.Toplevel(parent)
+        self.window.title("Organize Plan")
+        self.window.geometry("700x600")
+        self.window.transient(parent)
+        self.on_start = on_start
+
+        groups = {}
+        errors = []
+        for file_path, output_path in plan:
+            if output_path is None:
+                errors.append(file_path)
             else:
-                subfolder = "Portrait"
+                folder = os.path.relpath(os.path.dirname(output_path), output_folder)
+                groups.setdefault(folder, []).append(file_path)
+
+        tree_frame = ttk.Frame(self.window)
+        tree_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        tree = ttk.Treeview(tree_frame, columns=("count",))
+        tree.heading("#0", text="Folder")
+        tree.heading("count", text="Files")
+        tree.column("#0", width=550)
+        tree.column("count", width=80, stretch=False, anchor=tk.E)
+        scrollbar = ttk.Scrollbar(tree_frame, orient=tk.VERTICAL, command=tree.yview)
+        tree.configure(yscrollcommand=scrollbar.set)
+        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
 
-        # サブフォルダの作成と移動
-        subfolder_path = os.path.join(self.output_path.get(), subfolder)
-        os.makedirs(subfolder_path, exist_ok=True)
-        
-        output_path = os.path.join(subfolder_path, os.path.basename(file_path))
-        shutil.copy2(file_path, output_path)
+        # 件数が多くても一覧が重くならないよう、ファイルは一部だけ表示する
+        for folder, files in sorted(groups.items()):
+            item = tree.insert("", tk.END, text=folder, values=(len(files),))
+            for file_path in files[:self.SAMPLE_FILES]:
+                tree.insert(item, tk.END, text=os.path.basename(file_path))
+            if len(files) > self.SAMPLE_FILES:
+                tree.insert(item, tk.END, text=f"... and {len(files) - self.SAMPLE_FILES} more")
+        if errors:
+            item = tree.insert("", tk.END, text="(unreadable)", values=(len(errors),))
+            for file_path in errors[:self.SAMPLE_FILES]:
+                tree.insert(item, tk.END, text=os.path.basename(file_path))
+
+        summary = f"{len(plan) - len(errors)} files into {len(groups)} folders under {output_folder}"
+        ttk.Label(self.window, text=summary).pack(fill=tk.X, padx=5)
+        button_frame = ttk.Frame(self.window)
+        button_frame.pack(pady=5)
+        ttk.Button(button_frame, text="Start Processing", command=self.start).pack(side=tk.LEFT, padx=5)
+        ttk.Button(button_frame, text="Close", command=self.window.destroy).pack(side=tk.LEFT, padx=5)
+
+    def start(self):
+        self.window.destroy()
+        self.on_start()
+
+
+class ThumbnailGridWindow:
+    """フォルダ内の画像をサムネイルの一覧で表示するウィンドウ
+
+    表示範囲付近のセルだけにキャンバス項目と PhotoImage を作成し、サムネイルは
+    バックグラウンドのスレッドで縮小する。PhotoImage は件数上限付きのLRUで保持するため、
+    何万枚のフォルダをスクロールしてもメモリ使用量は一定に保たれる。
+    """
+    THUMBNAIL_SIZE = 160
+    CELL_WIDTH = 180
+    CELL_HEIGHT = 200
+    PRELOAD_ROWS = 2  # 表示範囲の上下に先読みする行数
+    MAX_PHOTO_IMAGES = 400  # 保持するPhotoImageの上限
+    LOADER_THREADS = 4
+    POLL_INTERVAL_MS = 50
+
+    def __init__(self, parent, on_select, thumbnail_cache, folder=None):
+        self.window = tk.Toplevel(parent)
+        self.window.title("Thumbnails")
+        self.window.geometry("960x700")
+        self.window.protocol("WM_DELETE_WINDOW", self.on_closing)
+        self.on_select = on_select
+        self.thumbnail_cache = thumbnail_cache
+
+        self.paths = []
+        self.photos = OrderedDict()  # パス -> PhotoImage（LRU）
+        self.cells = {}  # インデックス -> (画像項目, 文字項目)
+        self.cell_by_path = {}
+        self.layout_columns = None
+        self.visible_paths = set()  # 先読み分を含む表示範囲のパス
+        self.requested = set()  # 読み込み中のパス
+        self.selection_rect = None
+        self.closed = False
+        self.scan_id = 0
+
+        self.results = queue.Queue()
+        self.loader = ThreadPoolExecutor(max_workers=self.LOADER_THREADS)
+
+        self.folder_var = tk.StringVar(value=folder or "")
+        self.status_var = tk.StringVar(value="Select a folder")
+        self.setup_ui()
+
+        self.window.after(self.POLL_INTERVAL_MS, self.poll_results)
+        if folder:
+            self.load_folder(folder)
+
+    def setup_ui(self):
+        # フォルダ選択
+        folder_frame = ttk.Frame(self.window)
+        folder_frame.pack(fill=tk.X, padx=5, pady=5)
+        ttk.Label(folder_frame, text="Folder:").pack(side=tk.LEFT, padx=5)
+        ttk.Entry(folder_frame, textvariable=self.folder_var).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        ttk.Button(folder_frame, text="Browse", command=self.select_folder).pack(side=tk.LEFT, padx=5)
+
+        # サムネイル表示キャンバス
+        grid_frame = ttk.Frame(self.window)
+        grid_frame.pack(fill=tk.BOTH, expand=True, padx=5)
+        self.canvas = tk.Canvas(grid_frame, bg="white", highlightthickness=0)
+        scrollbar = ttk.Scrollbar(grid_frame, orient="vertical", command=self.on_scrollbar)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.canvas.configure(yscrollcommand=scrollbar.set, yscrollincrement=20)
+
+        self.canvas.bind("<Configure>", lambda event: self.refresh())
+        self.canvas.bind("<Button-1>", self.on_click)
+        self.canvas.bind("<MouseWheel>", self.on_mousewheel)  # Windows/Mac
+        self.canvas.bind("<Button-4>", lambda event: self.scroll(-3))  # Linux
+        self.canvas.bind("<Button-5>", lambda event: self.scroll(3))
+
+        ttk.Label(self.window, textvariable=self.status_var).pack(anchor=tk.W, padx=10, pady=2)
+
+    def select_folder(self):
+        folder = filedialog.askdirectory(parent=self.window)
+        if folder:
+            self.folder_var.set(folder)
+            self.load_folder(folder)
+
+    def load_folder(self, folder):
+        """フォルダを別スレッドで走査し、見つかった順に一覧へ追加する"""
+        self.scan_id += 1
+        self.paths = []
+        self.clear_cells()
+        self.canvas.yview_moveto(0)
+        self.status_var.set("Scanning...")
+        threading.Thread(target=self.scan_folder, args=(folder, self.scan_id), daemon=True).start()
+
+    def scan_folder(self, folder, scan_id):
+        batch = []
+        for entry in iter_image_dir_entries(folder):
+            if self.closed or scan_id != self.scan_id:
+                return
+            batch.append(entry.path)
+            if len(batch) >= 500:
+                self.results.put(("paths", scan_id, batch))
+                batch = []
+        self.results.put(("paths", scan_id, batch))
+        self.results.put(("scan_done", scan_id, None))
+
+    def load_thumbnail(self, path):
+        """ワーカースレッドで実行。表示範囲から外れたものは読み込まない"""
+        if self.closed or path not in self.visible_paths:
+            self.results.put(("thumbnail", path, None))
+            return
+        try:
+            thumbnail = self.thumbnail_cache.get_thumbnail(path, self.THUMBNAIL_SIZE)
+        except Exception:
+            thumbnail = None
+        self.results.put(("thumbnail", path, thumbnail))
+
+    def poll_results(self):
+        if self.closed:
+            return
+        updated = False
+        try:
+            while True:
+                kind, key, value = self.results.get_nowait()
+                if kind == "thumbnail":
+                    self.requested.discard(key)
+                    if value is not None:
+                        self.add_photo(key, value)
+                elif key == self.scan_id:
+                    if kind == "paths":
+                        self.paths.extend(value)
+                        updated = True
+                    else:  # scan_done
+                        self.status_var.set(f"{len(self.paths)} images")
+        except queue.Empty:
+            pass
+        if updated:
+            self.status_var.set(f"Scanning... {len(self.paths)} images")
+            self.refresh()
+        self.window.after(self.POLL_INTERVAL_MS, self.poll_results)
+
+    def add_photo(self, path, thumbnail):
+        photo = ImageTk.PhotoImage(thumbnail)
+        self.photos[path] = photo
+        index = self.cell_by_path.get(path)
+        if index is not None:
+            self.canvas.itemconfigure(self.cells[index][0], image=photo)
+
+        # 表示範囲外の古いものから破棄する
+        for old_path in list(self.photos):
+            if len(self.photos) <= self.MAX_PHOTO_IMAGES:
+                break
+            if old_path not in self.visible_paths:
+                del self.photos[old_path]
+
+    def clear_cells(self):
+        self.canvas.delete("all")
+        self.cells.clear()
+        self.cell_by_path.clear()
+        self.selection_rect = None
+
+    def refresh(self):
+        """表示範囲のセルだけを作成し、範囲外のセルを削除する"""
+        width = max(self.canvas.winfo_width(), self.CELL_WIDTH)
+        columns = max(1, width // self.CELL_WIDTH)
+        rows = (len(self.paths) + columns - 1) // columns
+        self.canvas.configure(scrollregion=(0, 0, columns * self.CELL_WIDTH, rows * self.CELL_HEIGHT))
+
+        if columns != self.layout_columns:
+            self.clear_cells()
+            self.layout_columns = columns
+
+        top = self.canvas.canvasy(0)
+        bottom = self.canvas.canvasy(self.canvas.winfo_height())
+        first_row = max(0, int(top // self.CELL_HEIGHT) - self.PRELOAD_ROWS)
+        last_row = min(rows - 1, int(bottom // self.CELL_HEIGHT) + self.PRELOAD_ROWS)
+        wanted = range(first_row * columns, min(len(self.paths), (last_row + 1) * columns))
+
+        for index in list(self.cells):
+            if index not in wanted:
+                for item in self.cells.pop(index):
+                    self.canvas.delete(item)
+                del self.cell_by_path[self.paths[index]]
+
+        self.visible_paths = {self.paths[index] for index in wanted}
+        for index in wanted:
+            if index not in self.cells:
+                self.create_cell(index, columns)
+
+    def create_cell(self, index, columns):
+        path = self.paths[index]
+        row, column = divmod(index, columns)
+        x = column * self.CELL_WIDTH + self.CELL_WIDTH // 2
+        y = row * self.CELL_HEIGHT + 8 + self.THUMBNAIL_SIZE // 2
+
+        photo = self.photos.get(path)
+        if photo is not None:
+            self.photos.move_to_end(path)
+        elif path not in self.requested:
+            self.requested.add(path)
+            self.loader.submit(self.load_thumbnail, path)
+
+        image_item = self.canvas.create_image(x, y, image=photo or "")
+        name = os.path.basename(path)
+        if len(name) > 24:
+            name = name[:21] + "..."
+        text_item = self.canvas.create_text(x, y + self.THUMBNAIL_SIZE // 2 + 12, text=name,
+                                            font=("Meiryo", 8))
+        self.cells[index] = (image_item, text_item)
+        self.cell_by_path[path] = index
+
+    def on_scrollbar(self, *args):
+        self.canvas.yview(*args)
+        self.refresh()
+
+    def scroll(self, units):
+        self.canvas.yview_scroll(units, "units")
+        self.refresh()
+
+    def on_mousewheel(self, event):
+        self.scroll(-3 if event.delta > 0 else 3)
+
+    def on_click(self, event):
+        if not self.layout_columns:
+            return
+        x = self.canvas.canvasx(event.x)
+        y = self.canvas.canvasy(event.y)
+        column = int(x // self.CELL_WIDTH)
+        index = int(y // self.CELL_HEIGHT) * self.layout_columns + column
+        if column >= self.layout_columns or not 0 <= index < len(self.paths):
+            return
+
+        # 選択枠の表示
+        row, column = divmod(index, self.layout_columns)
+        box = (column * self.CELL_WIDTH + 2, row * self.CELL_HEIGHT + 2,
+               (column + 1) * self.CELL_WIDTH - 2, (row + 1) * self.CELL_HEIGHT - 2)
+        if self.selection_rect is None:
+            self.selection_rect = self.canvas.create_rectangle(*box, outline="#3a7bd5", width=2)
+        else:
+            self.canvas.coords(self.selection_rect, *box)
+
+        self.on_select(self.paths[index])
+
+    def on_closing(self):
+        self.closed = True
+        self.loader.shutdown(wait=False)
+        self.window.destroy()
+
+class PromptSearchWindow:
+    """メタデータインデックスのプロンプトを全文検索するウィンドウ（ダブルクリックで画像を開く）"""
+    MAX_RESULTS = 200
+    TITLE = "Search Prompts"
+    SCORE_KEY = "score"
+    SCORE_HEADING = "Score"
+
+    def __init__(self, parent, metadata_index, on_select):
+        self.window = tk.Toplevel(parent)
+        self.window.title(self.TITLE)
+        self.window.geometry("900x600")
+        self.metadata_index = metadata_index
+        self.on_select = on_select
+
+        self.query_var = tk.StringVar()
+        self.folder_var = tk.StringVar()
+        self.status_var = tk.StringVar(value='e.g. "long hair" tag:smile -hat')
+        self.setup_ui()
+
+    def setup_ui(self):
+        query_frame = ttk.Frame(self.window)
+        query_frame.pack(fill=tk.X, padx=5, pady=5)
+        ttk.Label(query_frame, text="Query:").pack(side=tk.LEFT, padx=5)
+        query_entry = ttk.Entry(query_frame, textvariable=self.query_var)
+        query_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        query_entry.bind("<Return>", lambda e: self.search())
+        query_entry.focus_set()
+        ttk.Button(query_frame, text="Search", command=self.search).pack(side=tk.LEFT, padx=5)
+
+        folder_frame = ttk.Frame(self.window)
+        folder_frame.pack(fill=tk.X, padx=5)
+        ttk.Label(folder_frame, text="Folder (optional):").pack(side=tk.LEFT, padx=5)
+        ttk.Entry(folder_frame, textvariable=self.folder_var).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        ttk.Button(folder_frame, text="Browse", command=self.select_folder).pack(side=tk.LEFT, padx=5)
+
+        # 検索結果
+        result_frame = ttk.Frame(self.window)
+        result_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.tree = ttk.Treeview(result_frame, columns=("score", "path", "prompt"), show="headings")
+        self.tree.heading("score", text=self.SCORE_HEADING)
+        self.tree.heading("path", text="File")
+        self.tree.heading("prompt", text="Prompt")
+        self.tree.column("score", width=60, stretch=False, anchor=tk.E)
+        self.tree.column("path", width=250)
+        self.tree.column("prompt", width=550)
+        scrollbar = ttk.Scrollbar(result_frame, orient=tk.VERTICAL, command=self.tree.yview)
+        self.tree.configure(yscrollcommand=scrollbar.set)
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.tree.bind("<Double-1>", self.open_selected)
 
-    def generate_new_filename(self, file_path, image, index):
-        # ベース名を取得
-        base_name = self.custom_name_entry.get().strip()
-        if not base_name:
-            base_name = os.path.splitext(os.path.basename(file_path))[0]
+        ttk.Label(self.window, textvariable=self.status_var).pack(fill=tk.X, padx=5, pady=(0, 5))
+
+    def select_folder(self):
+        folder = filedialog.askdirectory(parent=self.window)
+        if folder:
+            self.folder_var.set(folder)
 
-        # 連番を生成
-        if self.include_number.get():
-            digits = int(self.number_digits.get())
-            number = str(index).zfill(digits)
+    def search(self):
+        query = self.query_var.get().strip()
+        if not query:
+            return
+        try:
+            results = self.find_results(query, self.folder_var.get().strip() or None)
+        except Exception as e:
+            messagebox.showerror("Error", f"Error searching prompts: {str(e)}", parent=self.window)
+            return
+        self.tree.delete(*self.tree.get_children())
+        for record in results:
+            prompt = " ".join((record["prompt"] or "").split())
+            self.tree.insert("", tk.END, iid=record["path"],
+                             values=(f"{record[self.SCORE_KEY]:.2f}", os.path.basename(record["path"]), prompt))
+        if results:
+            self.status_var.set(f"{len(results)} images (double-click to open)")
         else:
-            number = ""
-
-        # モデル名を取得
-        model_name = ""
-        if self.include_model.get():
-            info = image.info.get("parameters", "")
-            model_match = re.search(r"Model:\s*(.*?)(,|$)", info)
-            if model_match:
-                model_name = model_match.group(1).split('_')[0]
-
-        # 日付を取得
-        date_str = ""
-        if self.include_date.get():
-            date_str = datetime.now().strftime("%Y%m%d")
-
-        # 名前の組み立て
-        elements = []
-        
-        # 前置要素
-        if self.include_model.get() and self.model_position.get() == "before" and model_name:
-            elements.append(model_name)
-        if self.include_date.get() and self.date_position.get() == "before" and date_str:
-            elements.append(date_str)
-        
-        # ベース名と連番
-        if base_name:
-            elements.append(base_name)
-        if number:
-            elements.append(number)
-        
-        # 後置要素
-        if self.include_model.get() and self.model_position.get() == "after" and model_name:
-            elements.append(model_name)
-        if self.include_date.get() and self.date_position.get() == "after" and date_str:
-            elements.append(date_str)
-        
-        return "_".join(elements)
+            self.status_var.set("No matches. Run Batch > Update Metadata Index... to index a folder")
+
+    def find_results(self, query, folder):
+        return self.metadata_index.search_prompts(query, folder=folder, limit=self.MAX_RESULTS)
+
+    def open_selected(self, event=None):
+        selection = self.tree.selection()
+        if selection:
+            self.on_select(selection[0])
+
+
+class SimilarPromptsWindow(PromptSearchWindow):
+    """プロンプトの要素が似ている画像の一覧（検索欄のプロンプトと比較する）"""
+    TITLE = "Similar Prompts"
+    SCORE_KEY = "similarity"
+    SCORE_HEADING = "Similarity"
+
+    def __init__(self, parent, metadata_index, on_select, prompt, exclude_path=None):
+        self.exclude_path = exclude_path
+        super().__init__(parent, metadata_index, on_select)
+        self.query_var.set(prompt)
+        self.search()
+
+    def find_results(self, query, folder):
+        results = self.metadata_index.similar_prompts(query, folder=folder, limit=self.MAX_RESULTS + 1)
+        return [record for record in results if record["path"] != self.exclude_path][:self.MAX_RESULTS]
+
+
+class PromptFamiliesWindow:
+    """プロンプトが似ている画像の家族の一覧（ダブルクリックで画像を開く）"""
+
+    def __init__(self, parent, families, on_select):
+        self.window = tk.Toplevel(parent)
+        self.window.title("Prompt Families")
+        self.window.geometry("700x600")
+        self.on_select = on_select
+
+        tree_frame = ttk.Frame(self.window)
+        tree_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.tree = ttk.Treeview(tree_frame, show="tree")
+        scrollbar = ttk.Scrollbar(tree_frame, orient=tk.VERTICAL, command=self.tree.yview)
+        self.tree.configure(yscrollcommand=scrollbar.set)
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.tree.bind("<Double-1>", self.open_selected)
+
+        for number, paths in enumerate(families, 1):
+            family = self.tree.insert("", tk.END, text=f"Family {number} ({len(paths)} images)")
+            for path in paths:
+                self.tree.insert(family, tk.END, iid=path, text=path)
+        ttk.Label(self.window, text=f"{len(families)} families").pack(fill=tk.X, padx=5, pady=(0, 5))
+
+    def open_selected(self, event=None):
+        selection = self.tree.selection()
+        if selection and not self.tree.get_children(selection[0]):
+            self.on_select(selection[0])
+
+class DuplicatesWindow:
+    """見た目がほぼ同じ画像のグループの一覧（先頭が残す画像。ダブルクリックで画像を開く）"""
+
+    def __init__(self, parent, clusters, on_select):
+        self.window = tk.Toplevel(parent)
+        self.window.title("Duplicate Images")
+        self.window.geometry("800x600")
+        self.on_select = on_select
+
+        tree_frame = ttk.Frame(self.window)
+        tree_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.tree = ttk.Treeview(tree_frame, columns=("action", "resolution", "metadata"))
+        self.tree.heading("#0", text="File")
+        self.tree.heading("action", text="Action")
+        self.tree.heading("resolution", text="Resolution")
+        self.tree.heading("metadata", text="Metadata")
+        self.tree.column("#0", width=450)
+        self.tree.column("action", width=80, stretch=False)
+        self.tree.column("resolution", width=100, stretch=False)
+        self.tree.column("metadata", width=80, stretch=False)
+        scrollbar = ttk.Scrollbar(tree_frame, orient=tk.VERTICAL, command=self.tree.yview)
+        self.tree.configure(yscrollcommand=scrollbar.set)
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.tree.bind("<Double-1>", self.open_selected)
+
+        duplicates = 0
+        for number, records in enumerate(clusters, 1):
+            group = self.tree.insert("", tk.END, text=f"Group {number} ({len(records)} images)", open=True)
+            for position, record in enumerate(records):
+                self.tree.insert(group, tk.END, iid=record["path"], text=record["path"], values=(
+                    "keep" if position == 0 else "duplicate",
+                    f"{record['width']}x{record['height']}",
+                    "yes" if record["parameters"] else "no"))
+            duplicates += len(records) - 1
+        ttk.Label(self.window, text=f"{len(clusters)} groups, {duplicates} duplicates").pack(
+            fill=tk.X, padx=5, pady=(0, 5))
+
+    def open_selected(self, event=None):
+        selection = self.tree.selection()
+        if selection and not self.tree.get_children(selection[0]):
+            self.on_select(selection[0])
+
 
 class FavoritePromptsManager:
     def __init__(self, parent):
@@ -667,6 +1365,11 @@ class FavoritePromptsManager:
             self.prompt_listbox.insert(tk.END, name)
 
 class ImageMetadataViewer:
+    PREVIEW_SIZE = (200, 200)
+    EDIT_PROXY_SIZE = (1024, 1024)  # 編集中のプレビューに使う縮小画像の大きさ
+    CROP_CANVAS_SIZE = (780, 500)
+    PREVIEW_POLL_MS = 50
+
     def __init__(self, root):
         self.root = root
         self.root.title("Enhanced AI Image Metadata Viewer")
@@ -683,22 +1386,68 @@ class ImageMetadataViewer:
         self.prompt_text = tk.StringVar()
         self.negative_prompt_text = tk.StringVar()
         self.other_parameters_text = tk.StringVar()
+        self.edit_status_text = tk.StringVar()
+
+        # 保存前の編集（元画像は書き出すまで変更しない）
+        self.edit_stack = EditStack((1, 1))
+        self.edit_proxy = None
+
+        # メタデータのインデックス（表示のたびに画像を解析しないため）
+        self.metadata_index = MetadataIndex()
+        self.thumbnail_cache = ThumbnailCache()
+
+        # 正確なプレビューは別スレッドで作る（表示先ごとに最新の要求だけを処理する）
+        self.preview_loader = ThreadPoolExecutor(max_workers=1)
+        self.preview_results = queue.Queue()
+        self.preview_tokens = {}
     
         self.setup_ui()
         self.create_menu()
+        self.root.after(self.PREVIEW_POLL_MS, self.poll_previews)
+
+    def request_preview(self, slot, path, target, on_ready):
+        """粗いプレビューをすぐに on_ready に渡し、正確なプレビューは完成してから渡す
+
+        粗いプレビューを作れない場合は None を渡す。戻り値は元画像のサイズ。
+        """
+        token = self.preview_tokens.get(slot, 0) + 1
+        self.preview_tokens[slot] = token
+        coarse, original_size = load_coarse_preview(path, target, self.thumbnail_cache)
+        on_ready(coarse)
+        self.preview_loader.submit(self.load_preview_job, slot, token, path, target, on_ready)
+        return original_size
+
+    def load_preview_job(self, slot, token, path, target, on_ready):
+        # 読み込み待ちの間に次の画像が選ばれていれば何もしない
+        if self.preview_tokens.get(slot) != token:
+            return
+        try:
+            preview, _ = load_preview(path, target, self.thumbnail_cache)
+        except Exception:
+            return
+        self.preview_results.put((slot, token, on_ready, preview))
+
+    def poll_previews(self):
+        try:
+            while True:
+                slot, token, on_ready, preview = self.preview_results.get_nowait()
+                if self.preview_tokens.get(slot) == token:
+                    on_ready(preview)
+        except queue.Empty:
+            pass
+        self.root.after(self.PREVIEW_POLL_MS, self.poll_previews)
+
+    def show_preview(self, preview):
+        if preview is None:
+            self.image_label.config(image="")
+            self.image_label.image = None
+            return
+        img_tk = ImageTk.PhotoImage(preview)
+        self.image_label.config(image=img_tk)
+        self.image_label.image = img_tk
 
     def format_parameters(self, params_text):
-        formatted_params = {}
-        for param in params_text.split(", "):
-            if ": " in param:
-                key, value = param.split(": ", 1)
-                formatted_params[key.strip()] = value.strip()
-        
-        formatted_text = ""
-        for key, value in formatted_params.items():
-            formatted_text += f"{key}: {value}\n"
-        
-        return formatted_text
+        return "".join(f"{key}: {value}\n" for key, value in parse_settings(params_text).items())
 
     def on_minimize(self, event):
         if event.widget is self.root:
@@ -716,6 +1465,7 @@ class ImageMetadataViewer:
         # File menu
         file_menu = Menu(menubar, tearoff=0)
         menubar.add_cascade(label="File", menu=file_menu)
+        file_menu.add_command(label="Browse Folder...", command=self.show_thumbnail_grid)
         file_menu.add_command(label="Open containing folder", command=self.open_containing_folder)
         file_menu.add_separator()
         file_menu.add_command(label="Exit", command=self.root.quit)
@@ -723,6 +1473,12 @@ class ImageMetadataViewer:
         # Edit menu
         edit_menu = Menu(menubar, tearoff=0)
         menubar.add_cascade(label="Edit", menu=edit_menu)
+        edit_menu.add_command(label="Undo", accelerator="Ctrl+Z", command=self.undo_edit)
+        edit_menu.add_command(label="Redo", accelerator="Ctrl+Y", command=self.redo_edit)
+        edit_menu.add_separator()
+        self.root.bind("<Control-z>", self.undo_edit)
+        self.root.bind("<Control-y>", self.redo_edit)
+        self.root.bind("<Control-Z>", self.redo_edit)  # Ctrl+Shift+Z
         
         # Transform submenu
         transform_menu = Menu(edit_menu, tearoff=0)
@@ -742,6 +1498,11 @@ class ImageMetadataViewer:
         # リサイズとトリミング
         edit_menu.add_command(label="Resize...", command=self.show_resize_dialog)
         edit_menu.add_command(label="Crop...", command=self.show_crop_dialog)
+
+        # 編集結果の保存と破棄
+        edit_menu.add_separator()
+        edit_menu.add_command(label="Save Edited Image...", command=self.save_edited_image)
+        edit_menu.add_command(label="Revert Edits", command=self.revert_edits)
         
         # メタデータ編集
         edit_menu.add_separator()
@@ -756,59 +1517,73 @@ class ImageMetadataViewer:
         batch_menu = Menu(menubar, tearoff=0)
         menubar.add_cascade(label="Batch", menu=batch_menu)
         batch_menu.add_command(label="Batch Process", command=self.show_batch_processor)
+        batch_menu.add_command(label="Update Metadata Index...", command=self.update_metadata_index)
+        batch_menu.add_command(label="Search Prompts...", command=self.show_prompt_search)
+        batch_menu.add_command(label="Find Similar Prompts", command=self.show_similar_prompts)
+        batch_menu.add_command(label="Prompt Families...", command=self.show_prompt_families)
+        batch_menu.add_command(label="Find Duplicates...", command=self.show_duplicates)
 
     def flip_horizontal(self):
-        if not self.current_file_path:
-            messagebox.showinfo("Info", "No image is loaded")
-            return
-        try:
-            image = Image.open(self.current_file_path)
-            flipped = image.transpose(Image.FLIP_LEFT_RIGHT)
-            self.save_edited_image(flipped, "flipped_h")
-        except Exception as e:
-            messagebox.showerror("Error", f"Error flipping image: {str(e)}")
+        self.apply_edit("flip_h")
 
     def flip_vertical(self):
-        if not self.current_file_path:
-            messagebox.showinfo("Info", "No image is loaded")
-            return
-        try:
-            image = Image.open(self.current_file_path)
-            flipped = image.transpose(Image.FLIP_TOP_BOTTOM)
-            self.save_edited_image(flipped, "flipped_v")
-        except Exception as e:
-            messagebox.showerror("Error", f"Error flipping image: {str(e)}")
+        self.apply_edit("flip_v")
 
     def rotate_right(self):
-        if not self.current_file_path:
-            messagebox.showinfo("Info", "No image is loaded")
-            return
-        try:
-            image = Image.open(self.current_file_path)
-            rotated = image.rotate(-90, expand=True)
-            self.save_edited_image(rotated, "rotated_r")
-        except Exception as e:
-            messagebox.showerror("Error", f"Error rotating image: {str(e)}")
+        self.apply_edit("rotate_r")
 
     def rotate_left(self):
+        self.apply_edit("rotate_l")
+
+    def get_edit_proxy(self):
+        """編集のプレビューに使う縮小画像（初回の編集時に読み込む）"""
+        if self.edit_proxy is None:
+            self.edit_proxy, _ = load_preview(self.current_file_path, self.EDIT_PROXY_SIZE,
+                                              self.thumbnail_cache)
+        return self.edit_proxy
+
+    def apply_edit(self, operation, argument=None):
+        """編集操作を記録してプレビューを更新する（画像ファイルは書き出すまで変更しない）"""
         if not self.current_file_path:
             messagebox.showinfo("Info", "No image is loaded")
             return
         try:
-            image = Image.open(self.current_file_path)
-            rotated = image.rotate(90, expand=True)
-            self.save_edited_image(rotated, "rotated_l")
+            self.edit_stack.apply(operation, argument)
+            self.show_edit_preview()
         except Exception as e:
-            messagebox.showerror("Error", f"Error rotating image: {str(e)}")
+            messagebox.showerror("Error", f"Error editing image: {str(e)}")
+
+    def show_edit_preview(self):
+        # 読み込み中の元画像のプレビューで上書きされないようにする
+        self.preview_tokens["display"] = self.preview_tokens.get("display", 0) + 1
+        self.show_preview(self.edit_stack.preview(self.get_edit_proxy(), self.PREVIEW_SIZE))
+        width, height = self.edit_stack.size
+        if self.edit_stack.is_identity:
+            self.edit_status_text.set("")
+        else:
+            self.edit_status_text.set(f"Edited: {len(self.edit_stack.operations)} operation(s), "
+                                      f"{width} x {height} pixels (not saved)")
+
+    def undo_edit(self, event=None):
+        if self.current_file_path and self.edit_stack.undo():
+            self.show_edit_preview()
+
+    def redo_edit(self, event=None):
+        if self.current_file_path and self.edit_stack.redo():
+            self.show_edit_preview()
+
+    def revert_edits(self):
+        if not self.current_file_path or self.edit_stack.is_identity:
+            return
+        self.display_metadata(self.current_file_path)
 
     def show_resize_dialog(self):
         if not self.current_file_path:
             messagebox.showinfo("Info", "No image is loaded")
             return
             
-        # 現在の画像サイズを取得
-        image = Image.open(self.current_file_path)
-        original_width, original_height = image.size
+        # 編集後の画像サイズを取得
+        original_width, original_height = self.edit_stack.size
         
         # ダイアログウィンドウの作成
         dialog = tk.Toplevel(self.root)
@@ -873,9 +1648,8 @@ class ImageMetadataViewer:
                 new_height = int(height_var.get())
                 if new_width <= 0 or new_height <= 0:
                     raise ValueError("Size must be positive")
-                resized = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                self.save_edited_image(resized, "resized")
                 dialog.destroy()
+                self.apply_edit("resize", (new_width, new_height))
             except ValueError as e:
                 messagebox.showerror("Error", "Please enter valid numbers")
         
@@ -894,7 +1668,15 @@ class ImageMetadataViewer:
                 element_frame = PromptElementFrame(frame, element)
                 element_frame.pack(side=tk.LEFT, padx=2, pady=2)
 
-    def save_edited_image(self, edited_image, suffix):
+    def save_edited_image(self):
+        if not self.current_file_path:
+            messagebox.showinfo("Info", "No image is loaded")
+            return
+        if self.edit_stack.is_identity:
+            messagebox.showinfo("Info", "There are no edits to save")
+            return
+        suffix = self.edit_stack.suffix()
+
         # オリジナルのファイルパスから情報を取得
         original_dir = os.path.dirname(self.current_file_path)
         original_name = os.path.splitext(os.path.basename(self.current_file_path))[0]
@@ -918,24 +1700,8 @@ class ImageMetadataViewer:
         
         if save_path:
             try:
-                # 画像を保存
-                if save_path.lower().endswith('.jpg') or save_path.lower().endswith('.jpeg'):
-                    # JPEGの場合は背景を白にして保存
-                    if edited_image.mode in ('RGBA', 'LA'):
-                        background = Image.new('RGB', edited_image.size, (255, 255, 255))
-                        background.paste(edited_image, mask=edited_image.split()[-1])
-                        background.save(save_path, quality=95)
-                    else:
-                        edited_image.save(save_path, quality=95)
-                else:
-                    edited_image.save(save_path)
-                
-                # メタデータの保持
-                if "parameters" in Image.open(self.current_file_path).info:
-                    original_metadata = Image.open(self.current_file_path).info["parameters"]
-                    with Image.open(save_path) as img:
-                        img.info["parameters"] = original_metadata
-                        img.save(save_path)
+                # 全解像度の画像に編集をまとめて適用し、1回のエンコードで保存
+                export_edits(self.current_file_path, self.edit_stack, save_path)
                 
                 messagebox.showinfo("Success", "Image saved successfully!")
                 
@@ -949,6 +1715,103 @@ class ImageMetadataViewer:
     def show_batch_processor(self):
         BatchProcessingWindow(self.root)
 
+    def show_prompt_search(self):
+        PromptSearchWindow(self.root, self.metadata_index, self.open_image)
+
+    def show_similar_prompts(self):
+        prompt = self.prompt_text.get()
+        if not self.current_file_path or prompt in ("", "No Prompt Found", "No AI parameters found"):
+            messagebox.showinfo("Info", "No prompt is loaded")
+            return
+        SimilarPromptsWindow(self.root, self.metadata_index, self.open_image, prompt,
+                             exclude_path=os.path.abspath(self.current_file_path))
+
+    def show_prompt_families(self):
+        """インデックス済みの全画像をプロンプトの家族にまとめて表示"""
+        result = queue.Queue()
+
+        def cluster():
+            try:
+                with MetadataIndex() as metadata_index:
+                    result.put(("done", metadata_index.prompt_families()))
+            except Exception as e:
+                result.put(("error", str(e)))
+
+        def poll():
+            try:
+                status, value = result.get_nowait()
+            except queue.Empty:
+                self.root.after(200, poll)
+                return
+            if status == "done":
+                PromptFamiliesWindow(self.root, value, self.open_image)
+            else:
+                messagebox.showerror("Error", f"Error grouping prompts: {value}")
+
+        threading.Thread(target=cluster, daemon=True).start()
+        self.root.after(200, poll)
+
+    def show_duplicates(self):
+        """フォルダ内の見た目がほぼ同じ画像をまとめて表示"""
+        folder = filedialog.askdirectory(parent=self.root)
+        if not folder:
+            return
+
+        result = queue.Queue()
+
+        def find():
+            try:
+                with MetadataIndex() as metadata_index:
+                    metadata_index.scan(folder)
+                    metadata_index.update_hashes(folder)
+                    result.put(("done", metadata_index.find_duplicates(folder)))
+            except Exception as e:
+                result.put(("error", str(e)))
+
+        def poll():
+            try:
+                status, value = result.get_nowait()
+            except queue.Empty:
+                self.root.after(200, poll)
+                return
+            if status == "done":
+                DuplicatesWindow(self.root, value, self.open_image)
+            else:
+                messagebox.showerror("Error", f"Error finding duplicates: {value}")
+
+        threading.Thread(target=find, daemon=True).start()
+        self.root.after(200, poll)
+
+    def update_metadata_index(self):
+        """フォルダをスキャンしてメタデータのインデックスを更新"""
+        folder = filedialog.askdirectory(parent=self.root)
+        if not folder:
+            return
+
+        result = queue.Queue()
+
+        def scan():
+            # sqlite3の接続はスレッドごとに作成する
+            try:
+                with MetadataIndex() as metadata_index:
+                    result.put(("done", len(metadata_index.scan(folder))))
+            except Exception as e:
+                result.put(("error", str(e)))
+
+        def poll():
+            try:
+                status, value = result.get_nowait()
+            except queue.Empty:
+                self.root.after(200, poll)
+                return
+            if status == "done":
+                messagebox.showinfo("Success", f"Indexed {value} images in {folder}")
+            else:
+                messagebox.showerror("Error", f"Error updating index: {value}")
+
+        threading.Thread(target=scan, daemon=True).start()
+        self.root.after(200, poll)
+
     def show_metadata_editor(self):
         if not self.current_file_path:
             messagebox.showinfo("Info", "No image is loaded")
@@ -1003,38 +1866,38 @@ class ImageMetadataViewer:
 
         def save_metadata():
             try:
-                # メタデータを構築
-                parameters = prompt_text.get("1.0", "end-1c")
-                parameters += "\nNegative prompt: " + neg_prompt_text.get("1.0", "end-1c")
-                if other_params_text.get("1.0", "end-1c").strip():
-                    parameters += "\n" + other_params_text.get("1.0", "end-1c")
-
-                # モデルとVAEの情報を更新
-                if "Model:" not in parameters:
-                    parameters = f"Model: {model_var.get()}, " + parameters
-                if "VAE:" not in parameters:
-                    parameters = f"VAE: {vae_var.get()}, " + parameters
-
-                # 画像を開いてメタデータを更新
-                image = Image.open(self.current_file_path)
-                image.info["parameters"] = parameters
-
-                # 保存先を選択
+                # 未設定を表す表示用の文字列は保存しない
+                def field(value):
+                    value = value.strip()
+                    return "" if value in NO_VALUE_TEXTS else value
+
+                # 設定行を解析し、ModelとVAEは入力欄の値で置き換える
+                settings = parse_settings(field(other_params_text.get("1.0", "end-1c")))
+                for key, var in (("Model", model_var), ("VAE", vae_var)):
+                    if field(var.get()):
+                        settings[key] = field(var.get())
+                    else:
+                        settings.pop(key, None)
+                parameters = format_parameters_text(
+                    field(prompt_text.get("1.0", "end-1c")),
+                    field(neg_prompt_text.get("1.0", "end-1c")),
+                    settings)
+
+                # 保存先を選択（画素は書き換えないため、形式は元の画像と同じ）
+                extension = os.path.splitext(self.current_file_path)[1]
                 save_path = filedialog.asksaveasfilename(
                     initialdir=os.path.dirname(self.current_file_path),
                     initialfile=os.path.basename(self.current_file_path),
-                    defaultextension=os.path.splitext(self.current_file_path)[1],
+                    defaultextension=extension,
                     filetypes=[
-                        ("PNG files", "*.png"),
-                        ("JPEG files", "*.jpg;*.jpeg"),
-                        ("WEBP files", "*.webp"),
+                        (f"{extension.lstrip('.').upper()} files", f"*{extension}"),
                         ("All files", "*.*")
                     ]
                 )
 
                 if save_path:
-                    # 画像を保存
-                    image.save(save_path, pnginfo=image.info)
+                    # メタデータ部分だけを書き換えて保存
+                    write_metadata(self.current_file_path, {"parameters": parameters}, save_path)
                     messagebox.showinfo("Success", "Metadata saved successfully!")
                     
                     # 現在の画像として設定
@@ -1066,25 +1929,36 @@ class ImageMetadataViewer:
         crop_window.transient(self.root)
         crop_window.grab_set()
 
-        # 画像を読み込み
-        image = Image.open(self.current_file_path)
-        
-        # キャンバスのサイズに合わせて画像をリサイズ
-        display_size = (780, 500)  # キャンバスサイズ
-        image.thumbnail(display_size, Image.Resampling.LANCZOS)
-        photo = ImageTk.PhotoImage(image)
-
         # キャンバスの作成
-        canvas = tk.Canvas(crop_window, width=display_size[0], height=display_size[1])
+        canvas_size = self.CROP_CANVAS_SIZE
+        canvas = tk.Canvas(crop_window, width=canvas_size[0], height=canvas_size[1])
         canvas.pack(pady=5)
-        canvas.create_image(0, 0, image=photo, anchor="nw")
+        image_item = canvas.create_image(0, 0, anchor="nw")
+
+        def show_crop_preview(preview):
+            # 粗いプレビューと正確なプレビューは同じサイズなので、選択範囲はそのまま使える
+            if preview is None or not canvas.winfo_exists():
+                return
+            photo = ImageTk.PhotoImage(preview)
+            canvas.itemconfigure(image_item, image=photo)
+            crop_window.photo = photo  # 画像の参照を保持
+
+        # キャンバスのサイズに合わせた縮小画像を読み込み
+        if self.edit_stack.is_identity:
+            original_size = self.request_preview("crop", self.current_file_path, canvas_size,
+                                                 show_crop_preview)
+        else:
+            # 編集中はプロキシ画像に編集を適用して表示する（座標は編集後の画像が基準）
+            original_size = self.edit_stack.size
+            show_crop_preview(self.edit_stack.render_preview(self.get_edit_proxy(), canvas_size))
+        display_size = fit_size(original_size, canvas_size)
 
         # クロップ範囲の初期化
         crop_rect = None
         start_x = None
         start_y = None
-        scale_factor_x = image.size[0] / display_size[0]
-        scale_factor_y = image.size[1] / display_size[1]
+        scale_factor_x = original_size[0] / display_size[0]
+        scale_factor_y = original_size[1] / display_size[1]
 
         def start_crop(event):
             nonlocal start_x, start_y, crop_rect
@@ -1123,14 +1997,9 @@ class ImageMetadataViewer:
             orig_right = int(right * scale_factor_x)
             orig_bottom = int(bottom * scale_factor_y)
 
-            # クロップを実行
-            try:
-                original_image = Image.open(self.current_file_path)
-                cropped = original_image.crop((orig_left, orig_top, orig_right, orig_bottom))
-                self.save_edited_image(cropped, "cropped")
-                crop_window.destroy()
-            except Exception as e:
-                messagebox.showerror("Error", f"Error cropping image: {str(e)}")
+            # クロップを編集として記録
+            crop_window.destroy()
+            self.apply_edit("crop", (orig_left, orig_top, orig_right, orig_bottom))
 
         # マウスイベントのバインド
         canvas.bind("<ButtonPress-1>", start_crop)
@@ -1145,9 +2014,6 @@ class ImageMetadataViewer:
         ttk.Button(crop_window, text="Cancel", 
                 command=crop_window.destroy).pack(pady=5)
 
-        # 画像の参照を保持
-        crop_window.photo = photo
-
     def convert_image(self, format_):
         if not self.current_file_path:
             messagebox.showinfo("Info", "No image is loaded")
@@ -1205,9 +2071,18 @@ Other Parameters:
 
     def on_drop(self, event):
         file_path = event.data.strip('{}')
+        self.open_image(file_path)
+
+    def open_image(self, file_path):
         self.current_file_path = file_path
         self.display_metadata(file_path)
 
+    def show_thumbnail_grid(self):
+        folder = None
+        if self.current_file_path:
+            folder = os.path.dirname(self.current_file_path)
+        ThumbnailGridWindow(self.root, self.open_image, self.thumbnail_cache, folder)
+
     def show_favorites_manager(self):
         FavoritePromptsManager(self.root)
 
@@ -1233,6 +2108,10 @@ Other Parameters:
                                        font=("Meiryo", 10), bg="#f4f4f4", justify="left")
         self.image_info_label.grid(row=0, column=1, sticky="nw")
 
+        # 保存していない編集の状態
+        tk.Label(self.frame, textvariable=self.edit_status_text, font=("Meiryo", 9),
+                 fg="#c05000", bg="#f4f4f4").grid(row=1, column=0, columnspan=2, sticky="w", padx=10)
+
         # ModelとVAEの表示エリア
         model_frame = tk.Frame(self.root, bg="#f4f4f4")
         model_frame.pack(fill=tk.X, padx=10, pady=5)
@@ -1298,13 +2177,16 @@ Other Parameters:
 
     def display_metadata(self, filepath):
         try:
-            image = Image.open(filepath)
-            img_thumbnail = image.copy()
-            img_thumbnail.thumbnail((200, 200))
-            img_tk = ImageTk.PhotoImage(img_thumbnail)
+            # Image.open はヘッダーのみ読む。プレビューは粗いものを先に表示して後で差し替える
+            with Image.open(filepath) as image:
+                image_format, image_size, image_mode = image.format, image.size, image.mode
+
+            # 新しい画像を開いたら保存していない編集は破棄する
+            self.edit_stack = EditStack(image_size)
+            self.edit_proxy = None
+            self.edit_status_text.set("")
+            self.request_preview("display", filepath, self.PREVIEW_SIZE, self.show_preview)
 
-            self.image_label.config(image=img_tk)
-            self.image_label.image = img_tk
             self.image_label.drop_target_register(DND_FILES)
             self.image_label.dnd_bind('<<Drop>>', self.on_drop)
 
@@ -1317,49 +2199,48 @@ Other Parameters:
             creation_time_str = datetime.fromtimestamp(creation_time).strftime("%Y-%m-%d %H:%M:%S")
             
             image_info = f"File: {os.path.basename(filepath)}\n"
-            image_info += f"Format: {image.format}\n"
-            image_info += f"Size: {image.size[0]} x {image.size[1]} pixels\n"
+            image_info += f"Format: {image_format}\n"
+            image_info += f"Size: {image_size[0]} x {image_size[1]} pixels\n"
             image_info += f"File Size: {file_size} KB\n"
-            image_info += f"Mode: {image.mode}\n"
+            image_info += f"Mode: {image_mode}\n"
             image_info += f"Created: {creation_time_str}"
             
             self.image_info_text.set(image_info)
 
-            # AI生成パラメータの取得と表示
-            self.extract_ai_parameters(image)
+            # AI生成パラメータの取得と表示（インデックス済みなら画像を読み直さない）
+            record = self.metadata_index.lookup(filepath)
+            self.extract_ai_parameters(record["parameters"])
 
         except Exception as e:
             messagebox.showerror("Error", f"Error loading image: {str(e)}")
             self.reset_display()
 
-    def extract_ai_parameters(self, image):
-        info = image.info
-        if "parameters" in info:
-            parameters = info["parameters"]
-
-            # ModelとVAEの抽出
-            model_match = re.search(r"Model:\s*(.*?)(,|$)", parameters)
-            vae_match = re.search(r"VAE:\s*(.*?)(,|$)", parameters)
-            self.model_text.set(model_match.group(1) if model_match else "N/A")
-            self.vae_text.set(vae_match.group(1) if vae_match else "N/A")
-
-            # プロンプト等の抽出
-            prompt_match = re.search(r"^(.*?)(Negative prompt:)", parameters, re.DOTALL)
-            negative_prompt_match = re.search(r"Negative prompt:\s*(.*?)(Steps:)", parameters, re.DOTALL)
-            other_parameters_match = re.search(r"(Steps:.*)", parameters, re.DOTALL)
-
-            self.prompt_text.set(prompt_match.group(1).strip() if prompt_match else "No Prompt Found")
-            self.negative_prompt_text.set(negative_prompt_match.group(1).strip() if negative_prompt_match else "No Negative Prompt Found")
-            self.other_parameters_text.set(other_parameters_match.group(1).strip() if other_parameters_match else "No Other Parameters Found")
+    def extract_ai_parameters(self, parameters):
+        if parameters:
+            parsed = parse_parameters(parameters)
+
+            # ModelとVAE
+            self.model_text.set(parsed.model or "N/A")
+            self.vae_text.set(parsed.vae or "N/A")
+
+            # プロンプト等
+            self.prompt_text.set(parsed.prompt or "No Prompt Found")
+            self.negative_prompt_text.set(parsed.negative_prompt or "No Negative Prompt Found")
+            self.other_parameters_text.set(parsed.settings_text or "No Other Parameters Found")
         else:
             self.reset_parameters()
 
     def reset_display(self):
         self.current_file_path = None
+        self.edit_stack = EditStack((1, 1))
+        self.edit_proxy = None
+        self.edit_status_text.set("")
         self.image_info_text.set("")
         self.reset_parameters()
         self.drop_area.pack(pady=10)
         self.image_label.config(image="")
+        # 読み込み中のプレビューが後から表示されないようにする
+        self.preview_tokens["display"] = self.preview_tokens.get("display", 0) + 1
 
     def reset_parameters(self):
         self.model_text.set("N/A")
@@ -1403,6 +2284,7 @@ Other Parameters:
             messagebox.showerror("Error", f"Error converting image: {str(e)}")
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # PyInstallerでビルドした場合のワーカー起動用
     root = TkinterDnD.Tk()
     app = ImageMetadataViewer(root)
     root.mainloop()
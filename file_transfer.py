@@ -0,0 +1,76 @@
+"""ファイルの配置（コピー・移動・リンク）
+
+整理処理で出力先にファイルを置く方法を選べるようにする。リンクや同じファイルシステム内の
+移動ではデータを読み書きせず、ディレクトリの操作だけで済む。
+使えない方法（別ドライブへのハードリンク、非対応のファイルシステムでの reflink、
+権限のない環境でのシンボリックリンクなど）はコピー（移動は コピー + 削除）で代替する。
+"""
+import errno
+import os
+import shutil
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+TRANSFER_MODES = ("copy", "move", "hardlink", "symlink", "reflink")
+
+# Linux の ioctl(FICLONE)。Btrfs・XFS などでデータを共有したコピーを作る
+FICLONE = 0x40049409
+
+
+def _create_replacing(dst, create):
+    """dst の隣に一時名で作成してから置き換える（既存の出力があっても途中の状態を残さない）"""
+    temp_path = os.path.join(os.path.dirname(dst), f".{os.path.basename(dst)}.{uuid.uuid4().hex}.tmp")
+    try:
+        create(temp_path)
+        os.replace(temp_path, dst)
+    except BaseException:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _reflink(src, dst):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "reflink is not supported on this platform")
+    with open(src, "rb") as source, open(dst, "wb") as target:
+        fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+    shutil.copystat(src, dst)
+
+
+def _move(src, dst):
+    try:
+        os.replace(src, dst)  # 同じファイルシステム内なら名前の変更だけで済む
+        return "move"
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    _create_replacing(dst, lambda path: shutil.copy2(src, path))
+    os.remove(src)
+    return "copy"
+
+
+def transfer_file(src, dst, mode="copy"):
+    """src を dst に置く。実際に使った方法（代替した場合は "copy"）を返す"""
+    if mode not in TRANSFER_MODES:
+        raise ValueError(f"Unknown transfer mode: {mode}")
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return mode  # 前回リンク・移動済み
+    if mode == "move":
+        return _move(src, dst)
+    if mode != "copy":
+        create = {
+            "hardlink": lambda path: os.link(src, path),
+            "symlink": lambda path: os.symlink(os.path.abspath(src), path),
+            "reflink": lambda path: _reflink(src, path),
+        }[mode]
+        try:
+            _create_replacing(dst, create)
+            return mode
+        except (OSError, NotImplementedError):
+            pass  # この環境では使えないためコピーする
+    _create_replacing(dst, lambda path: shutil.copy2(src, path))
+    return "copy"
@@ -0,0 +1,96 @@
+"""フォルダの走査
+
+os.scandir でフォルダを1つずつ読み、見つけた画像ファイルを順に返す。一覧をリストに
+溜めないため、ファイル数が多くてもすぐに最初のファイルを返し、メモリも一定で済む。
+フォルダかどうかの判定は scandir が返す種別を使い、stat はファイルの分だけ取る
+（Windowsでは scandir の結果に含まれるため追加の呼び出しはない）。
+
+include / exclude は走査するフォルダからの相対パス（区切りは "/"）に対する glob で、
+ファイル名・フォルダ名だけとの一致でもよい（"*.png", "drafts", "2024-*/*.webp" など）。
+exclude に一致したフォルダは中を読まない。
+"""
+import os
+from fnmatch import fnmatch
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+
+# count_image_files の途中経過を知らせる間隔（ファイル数）
+COUNT_PROGRESS_INTERVAL = 1000
+
+
+def _matches(relative_path, name, patterns):
+    return any(fnmatch(relative_path, pattern) or fnmatch(name, pattern) for pattern in patterns)
+
+
+def iter_image_dir_entries(folder, include=None, exclude=None, max_depth=None, skip_dirs=()):
+    """フォルダ以下の画像ファイルの DirEntry を名前順（深さ優先）に返す
+
+    max_depth は 0 でフォルダ直下のみ、None で制限なし。skip_dirs のフォルダ（絶対パス）は読まない。
+    """
+    include = tuple(include or ())
+    exclude = tuple(exclude or ())
+    skip_dirs = {os.path.normcase(os.path.abspath(path)) for path in skip_dirs}
+    stack = [(folder, "", 0)]
+    while stack:
+        current, prefix, depth = stack.pop()
+        try:
+            with os.scandir(current) as entries:
+                entries = sorted(entries, key=lambda e: e.name)
+        except OSError:
+            continue
+        subdirs = []
+        for entry in entries:
+            relative_path = prefix + entry.name
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                continue
+            if exclude and _matches(relative_path, entry.name, exclude):
+                continue
+            if is_dir:
+                if skip_dirs and os.path.normcase(entry.path) in skip_dirs:
+                    continue
+                if max_depth is None or depth < max_depth:
+                    subdirs.append((entry.path, relative_path + "/", depth + 1))
+            elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                if include and not _matches(relative_path, entry.name, include):
+                    continue
+                yield entry
+        stack.extend(reversed(subdirs))
+
+
+def iter_image_entries(folder, include=None, exclude=None, max_depth=None, skip_dirs=(),
+                       created_before=None):
+    """フォルダ以下の画像ファイルを (パス, stat) で列挙する
+
+    created_before（time.time() の値）を指定すると、それより後に作成・置換されたファイルは除く
+    （処理中に書き出したファイルを入力として拾わないため）。
+    """
+    for entry in iter_image_dir_entries(folder, include, exclude, max_depth, skip_dirs):
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        if created_before is not None and stat.st_ctime > created_before:
+            continue
+        yield entry.path, stat
+
+
+def count_image_files(folder, include=None, exclude=None, max_depth=None, skip_dirs=(),
+                      progress=None, stop_event=None):
+    """画像ファイルの数を数える（stat は取らない）
+
+    処理と並行して総数を見積もるためのもの。progress は (見つけた数, 完了したか) で呼ばれる。
+    stop_event がセットされたら途中で終了する。
+    """
+    count = 0
+    for _ in iter_image_dir_entries(folder, include, exclude, max_depth, skip_dirs):
+        count += 1
+        if count % COUNT_PROGRESS_INTERVAL == 0:
+            if stop_event is not None and stop_event.is_set():
+                return count
+            if progress:
+                progress(count, False)
+    if progress:
+        progress(count, True)
+    return count
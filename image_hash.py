@@ -0,0 +1,134 @@
+"""知覚ハッシュ（dHash・pHash）と重複画像の検出
+
+同じシードでの再生成・アップスケール・形式の変換などでできた、ほぼ同じ画像を見つけるためのもの。
+どちらのハッシュも画像をグレースケールの小さな画像にしてから作る64ビットの値で、
+見た目が近い画像ほどハミング距離（異なるビットの数）が小さくなる。
+
+- pHash: 32x32 の画像の2次元DCTの低周波 8x8 成分が、その中央値より大きいか
+- dHash: 9x8 の画像で横に隣り合う画素の明るさの大小
+
+ハッシュの計算は複数の画像をまとめて NumPy の行列演算で行う。画像の読み込みは
+JPEG なら draft() で縮小したままデコードし、その他の形式も reduce() で小さくしてから縮小する。
+
+距離 radius 以内の組の検索には multi-index hashing を使う。ハッシュを radius + 1 個の区間に
+分けると、距離が radius 以内の2つのハッシュは少なくとも1つの区間が完全に一致する
+（鳩の巣原理）。そこで区間ごとに値が同じハッシュの組だけを調べる。
+"""
+import numpy as np
+from PIL import Image
+
+from preview_loader import reduce_factor
+from prompt_similarity import DisjointSet
+
+HASH_SIZE = 8
+PHASH_SIZE = HASH_SIZE * 4
+
+# 重複とみなす pHash の距離の上限と、確認に使う dHash の距離の上限
+DEFAULT_RADIUS = 4
+DHASH_RADIUS = 10
+
+# ハッシュをまとめて計算する枚数
+HASH_BATCH = 256
+
+
+def _dct_matrix(size):
+    k = np.arange(size)
+    matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+_DCT = _dct_matrix(PHASH_SIZE)
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def load_hash_images(path):
+    """ハッシュ用の (32x32, 9x8) のグレースケール画像（uint8 の配列）を読み込む"""
+    with Image.open(path) as image:
+        if image.format == "JPEG":
+            image.draft("L", (PHASH_SIZE, PHASH_SIZE))
+        image = image.convert("L")
+        factor = reduce_factor(image.size, (PHASH_SIZE, PHASH_SIZE))
+        if factor > 1:
+            image = image.reduce(factor)
+        small = image.resize((PHASH_SIZE, PHASH_SIZE), Image.Resampling.LANCZOS)
+    row = small.resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.LANCZOS)
+    return np.asarray(small, dtype=np.uint8), np.asarray(row, dtype=np.uint8)
+
+
+def _pack(bits):
+    """(N, 64) の真偽値を64ビットの符号なし整数の配列にする"""
+    return np.packbits(bits, axis=1).view(">u8").ravel().astype(np.uint64)
+
+
+def phash_many(images):
+    """(N, 32, 32) の画像の pHash を uint64 の配列で返す"""
+    pixels = np.asarray(images, dtype=np.float32)
+    low = (_DCT @ pixels @ _DCT.T)[:, :HASH_SIZE, :HASH_SIZE].reshape(len(pixels), -1)
+    return _pack(low > np.median(low, axis=1, keepdims=True))
+
+
+def dhash_many(images):
+    """(N, 8, 9) の画像の dHash を uint64 の配列で返す"""
+    pixels = np.asarray(images, dtype=np.int16)
+    return _pack((pixels[:, :, 1:] > pixels[:, :, :-1]).reshape(len(pixels), -1))
+
+
+def hamming_distances(hashes, other):
+    """uint64 の配列どうし（ブロードキャスト可）のハミング距離"""
+    x = np.bitwise_xor(hashes, other)
+    if hasattr(np, "bitwise_count"):  # NumPy 2.0 以降
+        return np.bitwise_count(x)
+    return _POPCOUNT[x[..., None].view(np.uint8)].sum(axis=-1, dtype=np.uint8)
+
+
+def to_signed(values):
+    """SQLite の INTEGER（符号付き64ビット）に保存できる値にする"""
+    return np.asarray(values, dtype=np.uint64).view(np.int64)
+
+
+def from_signed(values):
+    return np.asarray(values, dtype=np.int64).view(np.uint64)
+
+
+def _chunks(radius):
+    # 64ビットを radius + 1 個のなるべく等しい区間に分ける
+    count = radius + 1
+    bounds = [round(64 * i / count) for i in range(count + 1)]
+    return [(start, end - start) for start, end in zip(bounds, bounds[1:])]
+
+
+def near_pairs(hashes, radius=DEFAULT_RADIUS):
+    """ハミング距離が radius 以内の組 (i, j)（i < j）を返す（同じ組が複数回返ることがある）"""
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    for start, width in _chunks(radius):
+        keys = (hashes >> np.uint64(start)) & np.uint64((1 << width) - 1)
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        boundaries = np.flatnonzero(sorted_keys[1:] != sorted_keys[:-1]) + 1
+        for group in np.split(order, boundaries):
+            if len(group) < 2:
+                continue
+            # 大きな区間は行を分けて、距離の表が大きくなりすぎないようにする
+            for row in range(0, len(group), 1024):
+                rows = group[row:row + 1024]
+                distances = hamming_distances(hashes[rows][:, None], hashes[group][None, :])
+                i, j = np.nonzero((distances <= radius) & (rows[:, None] < group[None, :]))
+                yield from zip(rows[i].tolist(), group[j].tolist())
+
+
+def duplicate_groups(phashes, dhashes, radius=DEFAULT_RADIUS, dhash_radius=DHASH_RADIUS):
+    """pHash が radius 以内で dHash も dhash_radius 以内の画像をまとめ、添字のリストを返す"""
+    phashes = np.asarray(phashes, dtype=np.uint64)
+    dhashes = np.asarray(dhashes, dtype=np.uint64)
+    groups = DisjointSet()
+    for i, j in near_pairs(phashes, radius):
+        if hamming_distances(dhashes[i], dhashes[j]) <= dhash_radius:
+            groups.union(i, j)
+    return [sorted(group) for group in groups.groups() if len(group) >= 2]
+
+
+def keep_order(record):
+    """残す画像を先頭にする並び順（解像度が大きい → メタデータがある → ファイルが大きい）"""
+    return (-(record["width"] or 0) * (record["height"] or 0), not record.get("parameters"),
+            -(record["size"] or 0), record["path"])
@@ -0,0 +1,163 @@
+"""tkinter に依存しない画像処理のAPI
+
+スキャン・メタデータの読み込み・変換・整理をGUIなしで呼び出すためのモジュール。
+各関数はジェネレータで、1件ずつ読み込んで処理するため、ファイル数が多くても
+使用メモリは一定になる。
+
+    from image_library import iter_images, iter_metadata, convert
+
+    records = iter_metadata(iter_images("input"))
+    for result in convert(records, "output", format="WEBP", workers=8):
+        if result.error:
+            print(result.path, result.error)
+
+このモジュール（と読み込むモジュール）では tkinter・tkinterdnd2・PIL.ImageTk・pyperclip を
+読み込まないこと。
+"""
+import os
+import re
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from batch_engine import BatchEngine, make_options
+from metadata_extractors import extract_parameters
+from folder_scanner import iter_image_dir_entries
+from metadata_index import READ_THREADS, build_record
+from metadata_reader import read_image_metadata
+from organize_template import FilterExpression, OrganizeTemplate
+from parameters_parser import parse_parameters
+
+__all__ = ["BatchResult", "iter_images", "iter_metadata", "convert", "organize",
+           "edit_metadata", "read_image_metadata", "extract_parameters", "parse_parameters"]
+
+# 処理結果（output は出力先のパス。メタデータ処理で変更がなければ None）
+# status は "done"・"unchanged"・"skipped"（ジャーナルで完了済み、または出力が最新）・"error"
+BatchResult = namedtuple("BatchResult", ["index", "path", "output", "error", "status"])
+
+
+def iter_images(folder, include=None, exclude=None, max_depth=None):
+    """フォルダ以下の画像ファイルのパスを名前順に1件ずつ返す
+
+    include / exclude は glob のリスト、max_depth はサブフォルダの深さの上限（folder_scanner を参照）。
+    """
+    for entry in iter_image_dir_entries(os.path.abspath(folder), include, exclude, max_depth):
+        yield entry.path
+
+
+def _read_record(path):
+    try:
+        return build_record(path)
+    except Exception as e:
+        return {"path": path, "error": str(e)}
+
+
+def iter_metadata(paths, threads=READ_THREADS):
+    """パスの列（またはフォルダ）から、メタデータの行（dict）を入力順に返す
+
+    行のキーはメタデータインデックスと同じ。読めないファイルは "error" キーだけを持つ行になる。
+    先読みは threads の数倍までに抑える。
+    """
+    if isinstance(paths, str):
+        paths = iter_images(paths)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        for path in paths:
+            pending.append(executor.submit(_read_record, path))
+            if len(pending) >= threads * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _items(items):
+    """パス・メタデータの行・フォルダを (パス, 行 or None) の列にする"""
+    if isinstance(items, str):
+        items = iter_images(items)
+    for item in items:
+        if isinstance(item, dict):
+            # 読み込みに失敗した行は渡さず、ワーカー側で読み直してエラーにする
+            yield item["path"], None if "error" in item else item
+        else:
+            yield item, None
+
+
+def _filtered(items, expression):
+    """条件式に合う (パス, 行) だけを返す（行のないパスは読み込んでから判定する）"""
+    for path, record in items:
+        if record is None:
+            record = _read_record(path)
+            if "error" in record:
+                yield path, None  # ワーカー側で読み直してエラーにする
+                continue
+        if expression.matches(record):
+            yield path, record
+
+
+def _run(process_type, items, workers, options):
+    """オプションを確認して、処理結果を返すジェネレータを作る
+
+    不正なオプション・テンプレート・条件式・正規表現は、処理を始める前（呼び出した時点）に
+    TypeError / ValueError にする。
+    """
+    options = make_options(process_type=process_type, **options)
+    items = _items(items)
+    if process_type == "organize":
+        if options["organize_by"] == "template":
+            OrganizeTemplate(options["organize_template"])
+        if options["organize_filter"]:
+            items = _filtered(items, FilterExpression(options["organize_filter"]))
+    if process_type == "metadata" and options["metadata_action"] == "replace":
+        try:
+            re.compile(options["find_pattern"])
+        except re.error as e:
+            raise ValueError(f"Invalid regular expression: {e}") from e
+    return _run_items(process_type, items, workers, options)
+
+
+def _run_items(process_type, items, workers, options):
+    if options["output_path"] and not options["dry_run"]:
+        os.makedirs(options["output_path"], exist_ok=True)
+    engine = BatchEngine(process_type, options, workers)
+    for result in engine.run_items(items):
+        yield BatchResult(*result)
+
+
+def convert(items, output_folder, format="PNG", workers=1, dry_run=False, **options):
+    """画像を変換して output_folder に保存する
+
+    items はパス・iter_metadata() の行の列、またはフォルダ。
+    options には一括処理のオプション（enable_rename, base_name, resume, skip_up_to_date など）を
+    指定できる。resume（既定で有効）では出力フォルダのジャーナルに記録済みのファイルを処理しない。
+    """
+    return _run("convert", items, workers,
+                dict(options, output_path=output_folder, convert_format=format.upper(),
+                     dry_run=dry_run))
+
+
+def organize(items, output_folder, by="model", mode="copy", workers=1, dry_run=False, **options):
+    """画像を model・vae・date・size ごと（by="template" なら organize_template）のフォルダに置く
+
+    organize_template は "{model}/{sampler}" のようなテンプレート、organize_filter は
+    "steps >= 30" のような条件式（organize_template.py を参照）。不正なものは呼び出した時点で ValueError。
+
+    mode は "copy"・"move"・"hardlink"・"symlink"・"reflink"（使えなければコピーする）。
+    コピーでは出力先に同じ内容のファイルがあれば "skipped" とする（skip_identical=False で無効）。
+    link_identical=True なら出力フォルダ内の同じ内容のファイルへのハードリンクにする。
+    """
+    return _run("organize", items, workers,
+                dict(options, output_path=output_folder, organize_by=by, organize_mode=mode,
+                     dry_run=dry_run))
+
+
+def edit_metadata(items, output_folder=None, find=None, replace="", strip=False,
+                  workers=1, dry_run=False, **options):
+    """生成パラメータを正規表現で置換（strip=True なら削除）する
+
+    output_folder を省略すると元のファイルを書き換える。不正な正規表現は呼び出した時点で ValueError。
+    """
+    if not strip and find is None:
+        raise ValueError("Specify find or strip=True")
+    return _run("metadata", items, workers,
+                dict(options, output_path=output_folder or "", in_place=output_folder is None,
+                     metadata_action="strip" if strip else "replace",
+                     find_pattern=find or "", replace_with=replace, dry_run=dry_run))
@@ -0,0 +1,93 @@
+"""編集・変換した画像の保存
+
+画像のエンコードは1回だけ行い、元画像のメタデータ（生成パラメータ・EXIF・ICCプロファイル）は
+形式ごとの方法で同じ save() 呼び出しに渡す。
+
+- PNG: テキストチャンク（PngInfo）
+- JPEG/WEBP: EXIF の UserComment（A1111と同じ形式）
+"""
+import os
+
+from PIL import Image, PngImagePlugin
+
+from metadata_reader import read_image_metadata
+from metadata_writer import build_exif
+
+JPEG_QUALITY = 95
+
+
+def collect_metadata(source_path):
+    """元画像から引き継ぐメタデータを読み出す（画素はデコードしない）"""
+    metadata = read_image_metadata(source_path)
+    with Image.open(source_path) as image:
+        exif = image.info.get("exif")
+        icc_profile = image.info.get("icc_profile")
+    if exif and not exif.startswith(b"Exif\x00\x00"):
+        exif = b"Exif\x00\x00" + exif  # PNG/WEBPではヘッダーなしで格納されている
+    return {"text": metadata["text"], "exif": exif, "icc_profile": icc_profile}
+
+
+def format_for_path(path):
+    """拡張子から保存形式を求める"""
+    extension = os.path.splitext(path)[1].lower()
+    try:
+        return Image.registered_extensions()[extension]
+    except KeyError:
+        raise ValueError(f"Unsupported file extension: {extension}") from None
+
+
+def _flatten_for_jpeg(image):
+    """JPEGは透過に対応していないため、白背景に合成する"""
+    if image.mode == "P":
+        image = image.convert("RGBA")
+    if image.mode in ("RGBA", "LA"):
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        return background
+    if image.mode not in ("RGB", "L", "CMYK"):
+        return image.convert("RGB")
+    return image
+
+
+def save_params(format_, metadata):
+    """save() に渡すメタデータの引数を形式に合わせて作る"""
+    params = {}
+    if not metadata:
+        return params
+    if metadata.get("icc_profile"):
+        params["icc_profile"] = metadata["icc_profile"]
+    text = metadata.get("text") or {}
+    if format_ == "PNG":
+        pnginfo = PngImagePlugin.PngInfo()
+        for key, value in text.items():
+            # Latin-1で表せないテキストはiTXt（UTF-8）で保存する
+            try:
+                value.encode("latin-1")
+                pnginfo.add_text(key, value)
+            except UnicodeEncodeError:
+                pnginfo.add_itxt(key, value)
+        params["pnginfo"] = pnginfo
+        if metadata.get("exif"):
+            params["exif"] = metadata["exif"]
+    elif format_ in ("JPEG", "WEBP"):
+        try:
+            exif = build_exif(metadata.get("exif"), text.get("parameters"))
+        except Exception:
+            # 元のEXIFが解析できない場合は生成パラメータだけを保存する
+            exif = build_exif(None, text.get("parameters"))
+        if exif:
+            params["exif"] = exif
+    return params
+
+
+def save_image(image, path, metadata=None, format_=None):
+    """画像を1回のエンコードで保存する
+
+    metadata は collect_metadata() の戻り値（引き継がない場合は None）。
+    """
+    format_ = format_ or format_for_path(path)
+    params = save_params(format_, metadata)
+    if format_ == "JPEG":
+        image = _flatten_for_jpeg(image)
+        params["quality"] = JPEG_QUALITY
+    image.save(path, format=format_, **params)
@@ -0,0 +1,254 @@
+"""生成ツールごとのメタデータ抽出
+
+画像のテキストメタデータ（PNGのテキストチャンクやEXIFのUserComment）から
+生成パラメータを取り出す。対応形式は EXTRACTORS に登録された関数で判定し、
+最初に結果を返したものを採用する。
+
+ComfyUIの prompt / workflow、NovelAIの Comment はJSONで保存されている。
+workflow は数百KBになることがあるため、値が実際に必要になるまでデコードしない。
+"""
+import json
+import re
+
+from parameters_parser import format_parameters_text, format_settings_line, parse_parameters
+
+
+class LazyJSON:
+    """JSON文字列を最初に参照されたときにだけデコードする"""
+
+    __slots__ = ("raw", "_value", "_decoded")
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._value = None
+        self._decoded = False
+
+    @property
+    def value(self):
+        if not self._decoded:
+            try:
+                self._value = json.loads(self.raw)
+            except ValueError:
+                self._value = None
+            self._decoded = True
+        return self._value
+
+    @property
+    def decoded(self):
+        return self._decoded
+
+
+class _ExtractedParameters:
+    """A1111以外の形式に共通する処理（GenerationParameters と同じ属性を持つ）"""
+
+    __slots__ = ()
+
+    @property
+    def settings_text(self):
+        return format_settings_line(self.settings)
+
+    def format_settings(self):
+        return "".join(f"{key}: {value}\n" for key, value in self.settings.items())
+
+    def to_text(self):
+        return format_parameters_text(self.prompt, self.negative_prompt, self.settings)
+
+    def _build_settings(self, extra=()):
+        settings = {}
+        for key, value in (("Steps", self.steps), ("Sampler", self.sampler),
+                           ("CFG scale", self.cfg_scale), ("Seed", self.seed)):
+            if value is not None:
+                settings[key] = value
+        if self.width and self.height:
+            settings["Size"] = f"{self.width}x{self.height}"
+        if self.model:
+            settings["Model"] = self.model
+        for key, value in extra:
+            if value is not None:
+                settings[key] = value
+        return settings
+
+
+# ComfyUI の prompt(API形式) から正規表現で直接拾う項目（JSONはデコードしない）
+_COMFY_FIELDS = {
+    "model": re.compile(r'"(?:ckpt_name|unet_name)"\s*:\s*"((?:\\.|[^"\\])*)"'),
+    "vae": re.compile(r'"vae_name"\s*:\s*"((?:\\.|[^"\\])*)"'),
+    "sampler": re.compile(r'"sampler_name"\s*:\s*"((?:\\.|[^"\\])*)"'),
+    "scheduler": re.compile(r'"scheduler"\s*:\s*"((?:\\.|[^"\\])*)"'),
+    "seed": re.compile(r'"(?:noise_seed|seed)"\s*:\s*(\d+)'),
+    "steps": re.compile(r'"steps"\s*:\s*(\d+)'),
+    "cfg_scale": re.compile(r'"cfg"\s*:\s*([\d.]+)'),
+    "width": re.compile(r'"width"\s*:\s*(\d+)'),
+    "height": re.compile(r'"height"\s*:\s*(\d+)'),
+}
+_COMFY_TYPES = {"seed": int, "steps": int, "cfg_scale": float, "width": int, "height": int}
+_COMFY_SAMPLER_TYPES = ("KSampler", "KSamplerAdvanced", "SamplerCustom")
+
+
+def _unescape_json_string(value):
+    try:
+        return json.loads(f'"{value}"')
+    except ValueError:
+        return value
+
+
+class ComfyUIParameters(_ExtractedParameters):
+    """ComfyUIの prompt / workflow から取り出したパラメータ
+
+    モデル・サンプラー・シードなどは prompt の文字列から直接拾い、
+    ポジティブ/ネガティブのテキストが必要になったときだけ prompt をデコードする。
+    workflow は .workflow を参照したときにだけデコードする。
+    """
+
+    __slots__ = ("_prompt_json", "_workflow_json", "_fields", "_texts")
+
+    source = "ComfyUI"
+
+    def __init__(self, prompt_raw, workflow_raw=None):
+        self._prompt_json = LazyJSON(prompt_raw)
+        self._workflow_json = LazyJSON(workflow_raw) if workflow_raw else None
+        self._fields = {}
+        self._texts = None
+
+    def _field(self, name):
+        if name not in self._fields:
+            match = _COMFY_FIELDS[name].search(self._prompt_json.raw)
+            value = None
+            if match:
+                value = match.group(1)
+                try:
+                    value = _COMFY_TYPES[name](value) if name in _COMFY_TYPES else _unescape_json_string(value)
+                except ValueError:
+                    value = None
+            self._fields[name] = value
+        return self._fields[name]
+
+    model = property(lambda self: self._field("model"))
+    vae = property(lambda self: self._field("vae"))
+    sampler = property(lambda self: self._field("sampler"))
+    seed = property(lambda self: self._field("seed"))
+    steps = property(lambda self: self._field("steps"))
+    cfg_scale = property(lambda self: self._field("cfg_scale"))
+    width = property(lambda self: self._field("width"))
+    height = property(lambda self: self._field("height"))
+
+    @property
+    def settings(self):
+        return self._build_settings((("Scheduler", self._field("scheduler")), ("VAE", self.vae)))
+
+    @property
+    def workflow(self):
+        return self._workflow_json.value if self._workflow_json else None
+
+    def _resolve_text(self, graph, link, depth=0):
+        """KSampler の positive/negative 入力をたどってテキストを得る"""
+        if depth > 16 or not isinstance(link, list) or not link:
+            return link if isinstance(link, str) else ""
+        node = graph.get(str(link[0]))
+        if not isinstance(node, dict):
+            return ""
+        inputs = node.get("inputs", {})
+        for key in ("text", "text_g", "string", "value", "conditioning", "conditioning_1"):
+            if key in inputs:
+                return self._resolve_text(graph, inputs[key], depth + 1)
+        return ""
+
+    def _load_texts(self):
+        if self._texts is None:
+            positive = negative = ""
+            graph = self._prompt_json.value
+            if isinstance(graph, dict):
+                for node in graph.values():
+                    if isinstance(node, dict) and node.get("class_type") in _COMFY_SAMPLER_TYPES:
+                        inputs = node.get("inputs", {})
+                        positive = self._resolve_text(graph, inputs.get("positive"))
+                        negative = self._resolve_text(graph, inputs.get("negative"))
+                        break
+            self._texts = (positive.strip(), negative.strip())
+        return self._texts
+
+    @property
+    def prompt(self):
+        return self._load_texts()[0]
+
+    @property
+    def negative_prompt(self):
+        return self._load_texts()[1]
+
+
+class NovelAIParameters(_ExtractedParameters):
+    """NovelAIの Description / Comment(JSON) から取り出したパラメータ"""
+
+    __slots__ = ("_description", "_comment", "_source")
+
+    source = "NovelAI"
+
+    def __init__(self, description, comment_raw, source=None):
+        self._description = description
+        self._comment = LazyJSON(comment_raw)
+        self._source = source
+
+    def _get(self, key, type_=None):
+        comment = self._comment.value
+        value = comment.get(key) if isinstance(comment, dict) else None
+        if value is not None and type_ is not None:
+            try:
+                value = type_(value)
+            except (TypeError, ValueError):
+                value = None
+        return value
+
+    model = property(lambda self: self._source)
+    vae = property(lambda self: None)
+    sampler = property(lambda self: self._get("sampler"))
+    seed = property(lambda self: self._get("seed", int))
+    steps = property(lambda self: self._get("steps", int))
+    cfg_scale = property(lambda self: self._get("scale", float))
+    width = property(lambda self: self._get("width", int))
+    height = property(lambda self: self._get("height", int))
+
+    @property
+    def prompt(self):
+        return (self._get("prompt") or self._description or "").strip()
+
+    @property
+    def negative_prompt(self):
+        return (self._get("uc") or "").strip()
+
+    @property
+    def settings(self):
+        return self._build_settings()
+
+
+def extract_a1111(text):
+    parameters = text.get("parameters")
+    if parameters:
+        return parse_parameters(parameters)
+    return None
+
+
+def extract_comfyui(text):
+    prompt_raw = text.get("prompt")
+    if prompt_raw and prompt_raw.lstrip().startswith("{") and '"class_type"' in prompt_raw:
+        return ComfyUIParameters(prompt_raw, text.get("workflow"))
+    return None
+
+
+def extract_novelai(text):
+    comment = text.get("Comment")
+    if text.get("Software", "").startswith("NovelAI") and comment:
+        return NovelAIParameters(text.get("Description"), comment, text.get("Source"))
+    return None
+
+
+# 判定順に並べた抽出関数。独自形式を追加する場合はここに登録する
+EXTRACTORS = [extract_a1111, extract_comfyui, extract_novelai]
+
+
+def extract_parameters(text):
+    """テキストメタデータ {キー: 値} から生成パラメータを取り出す（該当なしは None）"""
+    for extractor in EXTRACTORS:
+        result = extractor(text)
+        if result is not None:
+            return result
+    return None
@@ -0,0 +1,757 @@
+"""画像メタデータの永続インデックス（SQLite）
+
+フォルダをスキャンしてメタデータをデータベースに保存し、2回目以降は
+(サイズ, 更新日時) が変わったファイルだけを読み直す。削除されたファイルの行は
+スキャン時に取り除く。整理・リネーム・検索は画像を開かずにこのインデックスを参照する。
+データベースは既定でユーザーごとのデータフォルダに置く（app_paths を参照）。
+
+プロンプトの全文検索用に FTS5 の転置インデックス（prompt_fts、rowid は images と共通）を持ち、
+行の追加・更新・削除と同時に更新する。類似プロンプトの検索用に MinHash の署名と LSH のバケット
+（prompt_minhash・prompt_lsh、prompt_similarity を参照）も同様に保持する。
+重複画像の検出用の知覚ハッシュ（image_hashes）は画像のデコードが必要なため、スキャンでは作らず
+update_hashes() で作る。ファイルの内容のハッシュ（content_hashes）は整理処理で出力先の
+ファイルと比較するときに作り、画像以外・インデックスの対象外のファイルも保存する。
+"""
+import os
+import re
+import sqlite3
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from app_paths import data_path
+from content_hash import file_digest
+from folder_scanner import iter_image_entries
+from metadata_extractors import extract_parameters
+from metadata_reader import read_image_metadata
+from prompt_search import (COLUMN_WEIGHTS, FTS_COLUMNS, FTS_TOKENIZE, bm25_scores, compile_query, document_fields,
+                           phrase_expression, prompt_elements)
+from prompt_similarity import (FAMILY_THRESHOLD, DisjointSet, band_buckets, estimate_similarity, jaccard,
+                               minhash_signature, signature_from_bytes, signature_to_bytes)
+
+INDEX_NAME = "metadata_index.db"
+
+# 変更されたファイルの読み込みに使うスレッド数（ヘッダー読み込みはI/O待ちが主体）
+READ_THREADS = 8
+COMMIT_INTERVAL = 1000
+
+# 全文検索で順位を付ける候補の上限（これを超える一致は FTS5 の bm25() の順に候補を選ぶ）
+RANK_CANDIDATES = 1000
+# bm25() で候補を選ぶ一致数・各語の文書数の上限。これを超える検索は、文書数の少ない語を含む行から
+# 候補を選ぶ（bm25() は ORDER BY rank LIMIT でも一致した全件と、各語を含む全文書を数えるため）
+RANK_SCAN = 20000
+# 文書数を数える上限。これより多く含まれる語は新しい行の中での割合から見積もる
+DOCUMENT_COUNT_SAMPLE = 20000
+# 類似プロンプトの検索で Jaccard 係数を計算する候補の上限。共有するバケットの数が多い順に選ぶ
+# （よく使うタグだけで署名の帯が決まると、似ていない画像が大量に同じバケットに入るため）
+SIMILAR_CANDIDATES = 1000
+
+COLUMNS = ("path", "size", "mtime", "width", "height", "format", "source", "model", "vae",
+           "sampler", "seed", "prompt", "negative_prompt", "parameters")
+
+# スキーマを変更したら増やす（古いインデックスは開いたときに移行する）
+SCHEMA_VERSION = 6
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    format TEXT,
+    source TEXT,
+    model TEXT,
+    vae TEXT,
+    sampler TEXT,
+    seed INTEGER,
+    prompt TEXT,
+    negative_prompt TEXT,
+    parameters TEXT
+);
+CREATE INDEX IF NOT EXISTS images_model ON images(model);
+CREATE INDEX IF NOT EXISTS images_vae ON images(vae);
+CREATE VIRTUAL TABLE IF NOT EXISTS prompt_fts USING fts5(
+    prompt, negative_prompt, tags, negative_tags, tokenize = "%s"
+);
+CREATE TABLE IF NOT EXISTS prompt_minhash (
+    image INTEGER PRIMARY KEY,  -- images の rowid
+    signature BLOB              -- プロンプトがなければ NULL
+);
+CREATE TABLE IF NOT EXISTS prompt_lsh (
+    bucket INTEGER,
+    image INTEGER,
+    PRIMARY KEY (bucket, image)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS image_hashes (
+    image INTEGER PRIMARY KEY,  -- images の rowid
+    size INTEGER,               -- ハッシュを作ったときのファイルの (サイズ, 更新日時)
+    mtime REAL,
+    dhash INTEGER,              -- 読めない画像は NULL
+    phash INTEGER
+);
+CREATE TABLE IF NOT EXISTS content_hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    digest TEXT
+);
+CREATE INDEX IF NOT EXISTS content_hashes_size ON content_hashes(size);
+""" % FTS_TOKENIZE
+
+
+def summarize_parameters(parsed):
+    """解析済みの生成パラメータから検索・整理に使う項目を取り出す"""
+    if parsed is None:
+        return {"source": None, "model": None, "vae": None, "sampler": None, "seed": None,
+                "prompt": None, "negative_prompt": None, "parameters": ""}
+    return {
+        "source": parsed.source,
+        "model": parsed.model,
+        "vae": parsed.vae,
+        "sampler": parsed.sampler,
+        "seed": parsed.seed,
+        "prompt": parsed.prompt or None,
+        "negative_prompt": parsed.negative_prompt or None,
+        # A1111以外の形式もA1111形式の文字列にして保存し、表示側の処理を共通にする
+        "parameters": parsed.to_text() if parsed.source != "A1111" else None,
+    }
+
+
+def build_record(path, stat=None):
+    """1ファイル分のインデックス行を作成（画素はデコードしない）"""
+    if stat is None:
+        stat = os.stat(path)
+    metadata = read_image_metadata(path)
+    record = {
+        "path": path,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "width": metadata["width"],
+        "height": metadata["height"],
+        "format": metadata["format"],
+    }
+    record.update(summarize_parameters(extract_parameters(metadata["text"])))
+    if record["parameters"] is None:
+        record["parameters"] = metadata["text"]["parameters"]
+    return record
+
+
+def default_index_path():
+    """既定のデータベースのパス（データフォルダの metadata_index.db）"""
+    return data_path(INDEX_NAME)
+
+
+class MetadataIndex:
+    """画像メタデータのインデックス
+
+    sqlite3 の接続はスレッドをまたいで使えないため、スレッドごとに生成すること。
+    """
+
+    def __init__(self, db_path=None):
+        if db_path is None:
+            db_path = default_index_path()
+        self.db_path = db_path
+        # 内容のハッシュを書き込まずにためておく場合の {パス: (サイズ, 更新日時, ハッシュ)}（None なら書き込む）
+        self.deferred_digests = None
+        self.conn = sqlite3.connect(db_path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._migrate()
+        self.conn.executescript(SCHEMA)
+
+    def _migrate(self):
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(images)")]
+        if columns and "source" not in columns:
+            # ComfyUI/NovelAIの画像はメタデータなしで登録されているため、次回のスキャンで読み直す
+            self.conn.execute("ALTER TABLE images ADD COLUMN source TEXT")
+            self.conn.execute("UPDATE images SET mtime = -1")
+        if version < 3 and columns:
+            # 登録済みの行のプロンプトから全文検索のインデックスを作る（画像は読み直さない）
+            self.conn.executescript(SCHEMA)
+            self.conn.execute("DELETE FROM prompt_fts")  # 中断した移行の続きでも重複させない
+            cursor = self.conn.execute("SELECT rowid, prompt, negative_prompt FROM images")
+            for rowid, prompt, negative_prompt in cursor.fetchall():
+                self._index_prompt(rowid, prompt, negative_prompt, replace=False)
+        if version < 4 and columns:
+            # 登録済みの行のプロンプトから類似検索の署名を作る
+            self.conn.executescript(SCHEMA)
+            self._backfill_signatures()
+        self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _upsert(self, records):
+        # 既存の行は rowid を変えずに更新する（prompt_fts の rowid と対応させるため）
+        placeholders = ", ".join("?" for _ in COLUMNS)
+        updates = ", ".join(f"{column} = excluded.{column}" for column in COLUMNS[1:])
+        for record in records:
+            self.conn.execute(
+                f"INSERT INTO images ({', '.join(COLUMNS)}) VALUES ({placeholders}) "
+                f"ON CONFLICT(path) DO UPDATE SET {updates}",
+                tuple(record[column] for column in COLUMNS))
+            rowid = self.conn.execute("SELECT rowid FROM images WHERE path = ?",
+                                      (record["path"],)).fetchone()[0]
+            self._index_prompt(rowid, record["prompt"], record["negative_prompt"])
+
+    def _index_prompt(self, rowid, prompt, negative_prompt, replace=True):
+        if replace:
+            self._unindex_prompt(rowid)
+        fields = document_fields(prompt, negative_prompt)
+        if any(fields):
+            self.conn.execute(
+                f"INSERT INTO prompt_fts (rowid, {', '.join(FTS_COLUMNS)}) VALUES (?, ?, ?, ?, ?)",
+                (rowid,) + fields)
+        if replace:
+            self._index_signatures([(rowid, prompt)])
+
+    def _index_signatures(self, rows):
+        """(rowid, プロンプト) の署名とバケットを登録する"""
+        signatures = []
+        buckets = []
+        for rowid, prompt in rows:
+            signature = minhash_signature(prompt_elements(prompt))
+            signatures.append((rowid, signature and signature_to_bytes(signature)))
+            if signature:
+                buckets.extend((bucket, rowid) for bucket in band_buckets(signature))
+        self.conn.executemany("INSERT INTO prompt_minhash VALUES (?, ?)", signatures)
+        # バケットの順に挿入すると B-tree の同じページへの書き込みがまとまる
+        buckets.sort()
+        self.conn.executemany("INSERT OR IGNORE INTO prompt_lsh VALUES (?, ?)", buckets)
+
+    def _unindex_prompt(self, rowid):
+        """行のプロンプトを全文検索・類似検索のインデックスから取り除く"""
+        self.conn.execute("DELETE FROM prompt_fts WHERE rowid = ?", (rowid,))
+        row = self.conn.execute("SELECT signature FROM prompt_minhash WHERE image = ?", (rowid,)).fetchone()
+        if row is None:
+            return
+        if row[0] is not None:
+            self.conn.executemany(
+                "DELETE FROM prompt_lsh WHERE bucket = ? AND image = ?",
+                [(bucket, rowid) for bucket in band_buckets(signature_from_bytes(row[0]))])
+        self.conn.execute("DELETE FROM prompt_minhash WHERE image = ?", (rowid,))
+
+    def _backfill_signatures(self):
+        """登録済みの行の署名を作る
+
+        件数が多くてもメモリが一定になるよう分けてコミットし、中断した場合は次回続きから作る。
+        """
+        last = self.conn.execute("SELECT max(image) FROM prompt_minhash").fetchone()[0]
+        if last is None:
+            last = -1
+        while True:
+            rows = self.conn.execute(
+                "SELECT rowid, prompt FROM images WHERE rowid > ? ORDER BY rowid LIMIT 50000",
+                (last,)).fetchall()
+            if not rows:
+                break
+            self._index_signatures(rows)
+            self.conn.commit()
+            last = rows[-1][0]
+
+    def _folder_range(self, folder):
+        prefix = os.path.join(folder, "")
+        return prefix, prefix + "\U0010ffff"
+
+    def scan(self, folder, progress=None, **filters):
+        """フォルダをスキャンしてインデックスを更新し、画像のパスを列挙順に返す
+
+        progress が指定されていれば、確認したファイル数を引数に呼び出す。
+        """
+        paths = []
+        for path, _ in self.iter_scan(folder, **filters):
+            paths.append(path)
+            if progress and len(paths) % 1000 == 0:
+                progress(len(paths))
+        if progress:
+            progress(len(paths))
+        return paths
+
+    def iter_scan(self, folder, columns=None, include=None, exclude=None, max_depth=None,
+                  skip_dirs=(), created_before=None):
+        """フォルダを走査しながらインデックスを更新し、(パス, 行) を列挙順に返す
+
+        変更のないファイルは登録済みの行（columns を指定したときだけ。その列と path）を、
+        変更されたファイルはヘッダーを読み直した行を返す（読めなければ None）。
+        ヘッダーの読み込みは先読みしながら並列に行う。
+        最後まで走査したときだけ、存在しなくなったファイルの行を削除する。
+        絞り込みの引数は folder_scanner.iter_image_entries と同じ。
+        """
+        folder = os.path.abspath(folder)
+        columns = tuple(column for column in columns or () if column not in ("path", "size", "mtime"))
+        selected = ", ".join(("size", "mtime") + columns)
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS scanned (path TEXT PRIMARY KEY)")
+        self.conn.execute("DELETE FROM scanned")
+        pending = deque()  # (パス, 行 or Future)
+        updated = []
+        seen = []
+
+        def flush():
+            self._upsert(updated)
+            self.conn.executemany("INSERT OR IGNORE INTO scanned VALUES (?)", [(p,) for p in seen])
+            self.conn.commit()
+            updated.clear()
+            seen.clear()
+
+        def pop():
+            path, record = pending.popleft()
+            if isinstance(record, Future):
+                record = record.result()
+                if record is not None:
+                    updated.append(record)
+            seen.append(path)
+            if len(seen) >= COMMIT_INTERVAL:
+                flush()
+            return path, record
+
+        executor = ThreadPoolExecutor(max_workers=READ_THREADS)
+        try:
+            for path, stat in iter_image_entries(folder, include, exclude, max_depth, skip_dirs,
+                                                 created_before):
+                row = self.conn.execute(f"SELECT {selected} FROM images WHERE path = ?",
+                                        (path,)).fetchone()
+                if row is not None and (row["size"], row["mtime"]) == (stat.st_size, stat.st_mtime):
+                    pending.append((path, dict(row, path=path) if columns else None))
+                else:
+                    pending.append((path, executor.submit(self._safe_build_record, (path, stat))))
+                # 先頭が読み込み待ちでなければすぐに返し、読み込み待ちは先読みの上限まで溜める
+                while pending and (not isinstance(pending[0][1], Future) or pending[0][1].done()
+                                   or len(pending) > READ_THREADS * 4):
+                    yield pop()
+            while pending:
+                yield pop()
+            flush()
+            self._remove_missing(folder, bool(include or exclude or skip_dirs or created_before)
+                                 or max_depth is not None)
+        finally:
+            for _, record in pending:
+                if isinstance(record, Future):
+                    record.cancel()
+            executor.shutdown(wait=True)
+            if updated or seen:
+                flush()
+
+    def _remove_missing(self, folder, filtered):
+        """今回の走査で見つからなかったファイルの行を削除する
+
+        絞り込みをした走査では対象外のファイルも見つからないため、存在を確認してから削除する。
+        """
+        cursor = self.conn.execute(
+            "SELECT path FROM images WHERE path >= ? AND path < ? "
+            "AND path NOT IN (SELECT path FROM scanned)", self._folder_range(folder))
+        missing = [(row["path"],) for row in cursor
+                   if not filtered or not os.path.exists(row["path"])]
+        for (path,) in missing:
+            row = self.conn.execute("SELECT rowid FROM images WHERE path = ?", (path,)).fetchone()
+            self._unindex_prompt(row[0])
+            self.conn.execute("DELETE FROM image_hashes WHERE image = ?", (row[0],))
+        self.conn.executemany("DELETE FROM images WHERE path = ?", missing)
+        self.conn.executemany("DELETE FROM content_hashes WHERE path = ?", missing)
+        self.conn.execute("DELETE FROM scanned")
+        self.conn.commit()
+
+    @staticmethod
+    def _safe_build_record(item):
+        path, stat = item
+        try:
+            return build_record(path, stat)
+        except Exception:
+            # 読めないファイルは登録せず、処理時にエラーとして扱う
+            return None
+
+    def content_digest(self, path, stat=None):
+        """ファイルの内容のハッシュ。(サイズ, 更新日時) が変わっていなければ保存済みの値を返す"""
+        path = os.path.abspath(path)
+        stat = stat or os.stat(path)
+        deferred = (self.deferred_digests or {}).get(path)
+        if deferred is not None and deferred[:2] == (stat.st_size, stat.st_mtime):
+            return deferred[2]
+        row = self.conn.execute("SELECT size, mtime, digest FROM content_hashes WHERE path = ?",
+                                (path,)).fetchone()
+        if row is not None and (row["size"], row["mtime"]) == (stat.st_size, stat.st_mtime):
+            return row["digest"]
+        digest = file_digest(path)
+        self.store_digest(path, digest, stat)
+        return digest
+
+    def store_digest(self, path, digest, stat=None):
+        """内容のハッシュがわかっているファイル（コピーした出力など）を読まずに登録する
+
+        deferred_digests が None でなければ書き込まずにためておく（take_deferred_digests で取り出す）。
+        """
+        path = os.path.abspath(path)
+        stat = stat or os.stat(path)
+        if self.deferred_digests is not None:
+            self.deferred_digests[path] = (stat.st_size, stat.st_mtime, digest)
+            return
+        self.store_digests([(path, stat.st_size, stat.st_mtime, digest)])
+
+    def take_deferred_digests(self):
+        """ためておいたハッシュを (パス, サイズ, 更新日時, ハッシュ) のリストで取り出す"""
+        if not self.deferred_digests:
+            return []
+        rows = [(path,) + value for path, value in self.deferred_digests.items()]
+        self.deferred_digests = {}
+        return rows
+
+    def store_digests(self, rows):
+        """(パス, サイズ, 更新日時, ハッシュ) の列をまとめて登録する"""
+        self.conn.executemany("INSERT OR REPLACE INTO content_hashes VALUES (?, ?, ?, ?)", rows)
+        self.conn.commit()
+
+    def same_content(self, path, other):
+        """2つのファイルの内容が同じか（サイズが異なればハッシュは計算しない）"""
+        stat, other_stat = os.stat(path), os.stat(other)
+        if stat.st_size != other_stat.st_size:
+            return False
+        return self.content_digest(path, stat) == self.content_digest(other, other_stat)
+
+    def find_identical(self, path, folder):
+        """folder 以下のハッシュを登録済みのファイルから、path と内容が同じものを探す（なければ None）
+
+        同じサイズのファイルが登録されていなければ、path のハッシュは計算しない。
+        """
+        stat = os.stat(path)
+        candidates = self.conn.execute(
+            "SELECT path, size, mtime, digest FROM content_hashes WHERE size = ? AND path >= ? AND path < ?",
+            (stat.st_size,) + self._folder_range(os.path.abspath(folder))).fetchall()
+        if not candidates:
+            return None
+        digest = self.content_digest(path, stat)
+        for row in candidates:
+            if row["digest"] != digest or row["path"] == os.path.abspath(path):
+                continue
+            try:
+                candidate_stat = os.stat(row["path"])
+            except OSError:
+                continue
+            # 登録後に変更されたファイルは使わない
+            if (candidate_stat.st_size, candidate_stat.st_mtime) == (row["size"], row["mtime"]):
+                return row["path"]
+        return None
+
+    def get(self, path):
+        """登録済みの行を返す（鮮度は確認しない）"""
+        row = self.conn.execute("SELECT * FROM images WHERE path = ?",
+                                (os.path.abspath(path),)).fetchone()
+        return dict(row) if row else None
+
+    def lookup(self, path):
+        """最新の行を返す。未登録または変更されていれば読み直して登録する"""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        record = self.get(path)
+        if record and (record["size"], record["mtime"]) == (stat.st_size, stat.st_mtime):
+            return record
+        record = build_record(path, stat)
+        self._upsert([record])
+        self.conn.commit()
+        return record
+
+    def records(self, paths, columns=None):
+        """パスのリストに対応する行を {パス: 行} で返す
+
+        columns を指定すると、その列（と path）だけを取り出す。
+        """
+        selected = "*" if columns is None else ", ".join(("path",) + tuple(columns))
+        result = {}
+        paths = list(paths)
+        # SQLiteのプレースホルダー数の上限を超えないよう分割して問い合わせる
+        for start in range(0, len(paths), 500):
+            chunk = paths[start:start + 500]
+            cursor = self.conn.execute(
+                f"SELECT {selected} FROM images WHERE path IN ({', '.join('?' for _ in chunk)})",
+                chunk)
+            for row in cursor:
+                result[row["path"]] = dict(row)
+        return result
+
+    def search(self, text=None, model=None, vae=None, sampler=None, folder=None, limit=100):
+        """条件に一致する行を返す（text はプロンプトの部分一致）"""
+        conditions = []
+        params = []
+        if text:
+            conditions.append("(prompt LIKE ? ESCAPE '\\' OR negative_prompt LIKE ? ESCAPE '\\')")
+            pattern = "%" + re.sub(r"([\\%_])", r"\\\1", text) + "%"
+            params += [pattern, pattern]
+        for column, value in (("model", model), ("vae", vae), ("sampler", sampler)):
+            if value:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if folder:
+            conditions.append("path >= ? AND path < ?")
+            params += list(self._folder_range(os.path.abspath(folder)))
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        cursor = self.conn.execute(f"SELECT * FROM images{where} ORDER BY path LIMIT ?",
+                                   params + [limit])
+        return [dict(row) for row in cursor]
+
+    def search_prompts(self, query, folder=None, limit=100):
+        """プロンプトを全文検索し、関連度（BM25）の高い順に行を返す
+
+        検索式の書き方は prompt_search を参照（不正な検索式は ValueError）。
+        各行の "score" は大きいほど関連度が高い。一致が RANK_CANDIDATES 件を超える場合は、
+        FTS5 の bm25()（同じ列の重み）で並べた上位 RANK_CANDIDATES 件の中で順位を付ける。
+        一致またはいずれかの語を含む文書が RANK_SCAN 件を超える場合は、_rank_candidates() で選んだ
+        候補の中で順位を付ける。
+        """
+        compiled = compile_query(query)
+        source = "prompt_fts"
+        conditions = ["prompt_fts MATCH ?"]
+        filters = []
+        if folder:
+            source += " JOIN images ON images.rowid = prompt_fts.rowid"
+            conditions.append("images.path >= ? AND images.path < ?")
+            filters = list(self._folder_range(os.path.abspath(folder)))
+        where = f"FROM {source} WHERE {' AND '.join(conditions)}"
+        matches = self.conn.execute(f"SELECT count(*) FROM (SELECT 1 {where} LIMIT ?)",
+                                    [compiled.match] + filters + [RANK_SCAN + 1]).fetchone()[0]
+        if not matches:
+            return []
+
+        # prompt_fts_docsize は FTS5 が文書ごとに1行持つ内部テーブル
+        total = self.conn.execute("SELECT count(*) FROM prompt_fts_docsize").fetchone()[0]
+        counts = [self._document_count(phrase_expression(phrase), total) for phrase in compiled.phrases]
+        columns = ", ".join("prompt_fts." + column for column in FTS_COLUMNS)
+        if matches > RANK_SCAN or max(counts, default=0) > RANK_SCAN:
+            rowids = self._rank_candidates(compiled, counts, where, filters)
+            documents = []
+            for start in range(0, len(rowids), 500):
+                chunk = rowids[start:start + 500]
+                cursor = self.conn.execute(
+                    f"SELECT rowid, {columns} FROM prompt_fts WHERE rowid IN ({', '.join('?' for _ in chunk)})",
+                    chunk)
+                documents.extend((row[0], dict(zip(FTS_COLUMNS, row[1:]))) for row in cursor)
+        else:
+            order = ""
+            if matches > RANK_CANDIDATES:
+                weights = ", ".join(str(weight) for weight in COLUMN_WEIGHTS)
+                order = f"ORDER BY bm25(prompt_fts, {weights}) LIMIT {RANK_CANDIDATES}"
+            cursor = self.conn.execute(f"SELECT prompt_fts.rowid, {columns} {where} {order}",
+                                       [compiled.match] + filters)
+            documents = [(row[0], dict(zip(FTS_COLUMNS, row[1:]))) for row in cursor]
+
+        scores = bm25_scores(documents, compiled.phrases, counts, total)
+        ranked = sorted(scores, key=lambda rowid: (-scores[rowid], -rowid))[:limit]
+
+        results = []
+        for rowid in ranked:
+            record = dict(self.conn.execute("SELECT * FROM images WHERE rowid = ?", (rowid,)).fetchone())
+            record["score"] = scores[rowid]
+            results.append(record)
+        return results
+
+    def _rank_candidates(self, compiled, counts, where, filters):
+        """一致が多い検索で順位を付ける候補の rowid を RANK_CANDIDATES 件まで選ぶ
+
+        BM25 では文書数の少ない（IDF の大きい）フレーズを含む行ほど点数が高くなるため、
+        文書数の少ないフレーズから順に、そのフレーズを含む一致を新しい行から集める。
+        FTS5 の bm25() で並べると一致した全件の点数と文書数を計算するため、
+        ほぼ全件に一致する検索では100万件で1秒以上かかる。
+        """
+        rowids = {}
+        for _, phrase in sorted(zip(counts, compiled.phrases)):
+            cursor = self.conn.execute(
+                f"SELECT prompt_fts.rowid {where} ORDER BY prompt_fts.rowid DESC LIMIT ?",
+                [f"({compiled.match}) AND {phrase_expression(phrase)}"] + filters + [RANK_CANDIDATES])
+            for (rowid,) in cursor:
+                rowids.setdefault(rowid)
+                if len(rowids) >= RANK_CANDIDATES:
+                    return list(rowids)
+        return list(rowids)
+
+    def _document_count(self, expression, total):
+        """式に一致する文書数（多い場合は見積もり）"""
+        count = self.conn.execute(
+            "SELECT count(*) FROM (SELECT 1 FROM prompt_fts WHERE prompt_fts MATCH ? LIMIT ?)",
+            (expression, DOCUMENT_COUNT_SAMPLE)).fetchone()[0]
+        if count < DOCUMENT_COUNT_SAMPLE or total <= DOCUMENT_COUNT_SAMPLE:
+            return count
+        # 全件を数えると一致数に比例して遅くなるため、新しい DOCUMENT_COUNT_SAMPLE 件での割合を使う
+        bound = self.conn.execute(
+            "SELECT rowid FROM prompt_fts_docsize ORDER BY rowid DESC LIMIT 1 OFFSET ?",
+            (DOCUMENT_COUNT_SAMPLE - 1,)).fetchone()[0]
+        sampled = self.conn.execute(
+            "SELECT count(*) FROM prompt_fts WHERE prompt_fts MATCH ? AND rowid >= ?",
+            (expression, bound)).fetchone()[0]
+        return max(sampled * total / DOCUMENT_COUNT_SAMPLE, count)
+
+    def similar_prompts(self, prompt, folder=None, limit=20):
+        """プロンプトの要素の集合が似ている画像を、Jaccard 係数の高い順に返す
+
+        LSH のバケットを共有する画像だけを候補にするため、全件とは比較しない
+        （Jaccard 係数がおよそ 0.5 未満の画像は見つからないことがある）。候補は
+        BANDS 個の帯のうち共有するバケットの数が多い順に SIMILAR_CANDIDATES 件まで選ぶ
+        （Jaccard 係数が高いほど多くの帯が一致するため、大きなバケットでも近いものは残る）。
+        各行の "similarity" は要素の集合の Jaccard 係数（0〜1）。
+        """
+        signature = minhash_signature(prompt_elements(prompt))
+        if signature is None:
+            return []
+        buckets = band_buckets(signature)
+        source = "prompt_lsh"
+        params = list(buckets)
+        if folder:
+            source += " JOIN images ON images.rowid = prompt_lsh.image AND path >= ? AND path < ?"
+            params = list(self._folder_range(os.path.abspath(folder))) + params
+        cursor = self.conn.execute(
+            f"SELECT prompt_lsh.image, count(*) AS shared FROM {source} "
+            f"WHERE bucket IN ({', '.join('?' for _ in buckets)}) GROUP BY prompt_lsh.image "
+            f"ORDER BY shared DESC, prompt_lsh.image DESC LIMIT ?", params + [SIMILAR_CANDIDATES])
+        candidates = [row[0] for row in cursor]
+
+        elements = set(prompt_elements(prompt))
+        results = []
+        for start in range(0, len(candidates), 500):
+            chunk = candidates[start:start + 500]
+            cursor = self.conn.execute(
+                f"SELECT * FROM images WHERE rowid IN ({', '.join('?' for _ in chunk)})", chunk)
+            for row in cursor:
+                record = dict(row)
+                record["similarity"] = jaccard(elements, prompt_elements(record["prompt"]))
+                results.append(record)
+        results.sort(key=lambda record: (-record["similarity"], record["path"]))
+        return results[:limit]
+
+    def prompt_families(self, folder=None, threshold=FAMILY_THRESHOLD, min_size=2, progress=None):
+        """プロンプトが似ている画像を家族にまとめ、パスのリストを大きい順に返す
+
+        同じ LSH のバケットにあり、署名から推定した Jaccard 係数が threshold 以上の画像を
+        同じ家族にする（似た画像をたどってつながったものも同じ家族になる）。
+        progress が指定されていれば、確認したバケットの行数を引数に呼び出す。
+        """
+        source = "prompt_lsh"
+        params = []
+        if folder:
+            source += " JOIN images ON images.rowid = prompt_lsh.image WHERE path >= ? AND path < ?"
+            params = list(self._folder_range(os.path.abspath(folder)))
+        signatures = {}
+
+        def signature(rowid):
+            if rowid not in signatures:
+                if len(signatures) >= 100000:
+                    signatures.clear()
+                row = self.conn.execute("SELECT signature FROM prompt_minhash WHERE image = ?",
+                                        (rowid,)).fetchone()
+                signatures[rowid] = signature_from_bytes(row[0])
+            return signatures[rowid]
+
+        families = DisjointSet()
+        current = anchor = None
+        # 主キーの順に読むため、同じバケットの画像は続けて返る
+        cursor = self.conn.execute(f"SELECT bucket, image FROM {source} ORDER BY bucket", params)
+        for count, (bucket, rowid) in enumerate(cursor, 1):
+            if bucket != current:
+                current, anchor = bucket, rowid
+            elif (families.find(anchor) != families.find(rowid)
+                  and estimate_similarity(signature(anchor), signature(rowid)) >= threshold):
+                families.union(anchor, rowid)
+            if progress and count % 100000 == 0:
+                progress(count)
+
+        groups = [group for group in families.groups() if len(group) >= min_size]
+        groups.sort(key=len, reverse=True)
+        paths = self._paths([rowid for group in groups for rowid in group])
+        return [sorted(paths[rowid] for rowid in group) for group in groups]
+
+    def _paths(self, rowids):
+        result = {}
+        for start in range(0, len(rowids), 500):
+            chunk = rowids[start:start + 500]
+            cursor = self.conn.execute(
+                f"SELECT rowid, path FROM images WHERE rowid IN ({', '.join('?' for _ in chunk)})", chunk)
+            result.update(cursor.fetchall())
+        return result
+
+    def update_hashes(self, folder=None, progress=None):
+        """登録済みの画像のうち、知覚ハッシュがないか古いものを作る
+
+        画像はスレッドで縮小して読み込み、ハッシュは HASH_BATCH 枚ずつまとめて計算する。
+        progress が指定されていれば、(処理した数, 対象の数) を引数に呼び出す。
+        """
+        # NumPy を読み込むため、起動時ではなく使うときに import する
+        from image_hash import HASH_BATCH, dhash_many, phash_many, to_signed
+
+        conditions = "(h.image IS NULL OR h.size != images.size OR h.mtime != images.mtime)"
+        params = []
+        if folder:
+            conditions += " AND images.path >= ? AND images.path < ?"
+            params = list(self._folder_range(os.path.abspath(folder)))
+        rows = self.conn.execute(
+            "SELECT images.rowid, images.path, images.size, images.mtime FROM images "
+            f"LEFT JOIN image_hashes h ON h.image = images.rowid WHERE {conditions}", params).fetchall()
+
+        with ThreadPoolExecutor(max_workers=READ_THREADS) as executor:
+            for start in range(0, len(rows), HASH_BATCH):
+                chunk = rows[start:start + HASH_BATCH]
+                loaded = list(executor.map(_safe_load_hash_images, [row[1] for row in chunk]))
+                valid = [i for i, images in enumerate(loaded) if images is not None]
+                hashes = {}
+                if valid:
+                    phashes = to_signed(phash_many([loaded[i][0] for i in valid])).tolist()
+                    dhashes = to_signed(dhash_many([loaded[i][1] for i in valid])).tolist()
+                    hashes = {i: (dhash, phash) for i, dhash, phash in zip(valid, dhashes, phashes)}
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO image_hashes VALUES (?, ?, ?, ?, ?)",
+                    [(rowid, size, mtime) + hashes.get(i, (None, None))
+                     for i, (rowid, _, size, mtime) in enumerate(chunk)])
+                self.conn.commit()
+                if progress:
+                    progress(start + len(chunk), len(rows))
+
+    def find_duplicates(self, folder=None, radius=None):
+        """見た目がほぼ同じ画像のグループを、大きいグループから順に返す
+
+        各グループは行（dict）のリストで、先頭が残す画像（解像度が大きい → メタデータがある →
+        ファイルが大きい）。ハッシュは update_hashes() で作ったものを使う。
+        radius を省略すると image_hash.DEFAULT_RADIUS を使う。
+        """
+        from image_hash import DEFAULT_RADIUS, duplicate_groups, from_signed, keep_order
+
+        if radius is None:
+            radius = DEFAULT_RADIUS
+        conditions = "h.phash IS NOT NULL AND h.size = images.size AND h.mtime = images.mtime"
+        params = []
+        if folder:
+            conditions += " AND images.path >= ? AND images.path < ?"
+            params = list(self._folder_range(os.path.abspath(folder)))
+        rows = self.conn.execute(
+            "SELECT images.rowid, h.phash, h.dhash FROM image_hashes h "
+            f"JOIN images ON images.rowid = h.image WHERE {conditions}", params).fetchall()
+        if not rows:
+            return []
+        rowids, phashes, dhashes = zip(*rows)
+        groups = duplicate_groups(from_signed(phashes), from_signed(dhashes), radius)
+
+        clusters = []
+        for group in groups:
+            records = []
+            for start in range(0, len(group), 500):
+                chunk = [rowids[i] for i in group[start:start + 500]]
+                cursor = self.conn.execute(
+                    f"SELECT * FROM images WHERE rowid IN ({', '.join('?' for _ in chunk)})", chunk)
+                records.extend(dict(row) for row in cursor)
+            clusters.append(sorted(records, key=keep_order))
+        clusters.sort(key=len, reverse=True)
+        return clusters
+
+
+def _safe_load_hash_images(path):
+    from image_hash import load_hash_images
+
+    try:
+        return load_hash_images(path)
+    except Exception:
+        # 読めない画像はハッシュなしで登録し、ファイルが変わるまで読み直さない
+        return None
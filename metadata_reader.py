@@ -0,0 +1,291 @@
+"""画像ファイルからメタデータだけを読み出すモジュール
+
+画素データはデコードせず、ヘッダーやテキストチャンクのみを読む。
+ネットワークドライブ上の大量のファイルを整理する際も数KBの読み込みで済む。
+"""
+import struct
+import zlib
+
+from PIL import Image
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+JPEG_SIGNATURE = b"\xff\xd8"
+
+EXIF_HEADER = b"Exif\x00\x00"
+TAG_EXIF_IFD = 0x8769
+TAG_USER_COMMENT = 0x9286
+
+# UserCommentの先頭8バイトの文字コード指定
+USER_COMMENT_ASCII = b"ASCII\x00\x00\x00"
+USER_COMMENT_JIS = b"JIS\x00\x00\x00\x00\x00"
+USER_COMMENT_UNICODE = b"UNICODE\x00"
+
+# 長さを持たないJPEGマーカー
+JPEG_STANDALONE_MARKERS = {0x01} | set(range(0xD0, 0xD8))
+# SOFマーカー（DHT, JPG, DAC を除く）
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# 圧縮テキストの展開サイズ上限（ComfyUIのワークフローは数百KBになることがある）
+MAX_TEXT_SIZE = 16 * 1024 * 1024
+
+
+def _decompress(data):
+    decompressor = zlib.decompressobj()
+    text = decompressor.decompress(data, MAX_TEXT_SIZE)
+    if decompressor.unconsumed_tail:
+        raise ValueError("Compressed text chunk is too large")
+    return text
+
+
+def _decode_text_chunk(chunk_type, data):
+    """tEXt/zTXt/iTXt チャンクを (キーワード, テキスト) に変換"""
+    keyword, _, rest = data.partition(b"\x00")
+    keyword = keyword.decode("latin-1")
+    if chunk_type == b"tEXt":
+        return keyword, rest.decode("latin-1")
+    if chunk_type == b"zTXt":
+        # rest[0] は圧縮方式（0 = deflate のみ定義）
+        return keyword, _decompress(rest[1:]).decode("latin-1")
+    # iTXt: 圧縮フラグ, 圧縮方式, 言語タグ\0, 翻訳キーワード\0, テキスト(UTF-8)
+    compressed = rest[0]
+    rest = rest[2:]
+    _, _, rest = rest.partition(b"\x00")  # 言語タグ
+    _, _, text = rest.partition(b"\x00")  # 翻訳キーワード
+    if compressed:
+        text = _decompress(text)
+    return keyword, text.decode("utf-8", errors="replace")
+
+
+def read_png_metadata(fp):
+    """PNGのチャンクを先頭から順に読み、最初のIDATで打ち切る
+
+    fp はバイナリモードで開いたファイルオブジェクト（先頭位置）。
+    """
+    if fp.read(8) != PNG_SIGNATURE:
+        raise ValueError("Not a PNG file")
+
+    metadata = {"format": "PNG", "width": None, "height": None, "text": {}}
+    while True:
+        header = fp.read(8)
+        if len(header) < 8:
+            break
+        length, chunk_type = struct.unpack(">I4s", header)
+        if chunk_type in (b"IDAT", b"IEND"):
+            break
+        if chunk_type == b"IHDR":
+            data = fp.read(length)
+            metadata["width"], metadata["height"] = struct.unpack(">II", data[:8])
+            fp.seek(4, 1)  # CRC
+        elif chunk_type in (b"tEXt", b"zTXt", b"iTXt"):
+            data = fp.read(length)
+            if len(data) < length:
+                raise ValueError("Truncated PNG text chunk")
+            keyword, text = _decode_text_chunk(chunk_type, data)
+            metadata["text"].setdefault(keyword, text)
+            fp.seek(4, 1)  # CRC
+        else:
+            # 不要なチャンクは読まずに読み飛ばす
+            fp.seek(length + 4, 1)
+    return metadata
+
+
+def _decode_utf16(data, byte_order):
+    """UNICODE指定のUserCommentを復号（BOMがなければ0x00の位置でエンディアンを推定）"""
+    if data[:2] in (b"\xfe\xff", b"\xff\xfe"):
+        return data.decode("utf-16", errors="replace")
+    if len(data) % 2:
+        data = data[:-1]
+    # ASCII主体の文章なら上位バイトが0になるため、0x00が偶数位置に多ければビッグエンディアン
+    even_zeros = data[0::2].count(0)
+    odd_zeros = data[1::2].count(0)
+    if even_zeros != odd_zeros:
+        encoding = "utf-16-be" if even_zeros > odd_zeros else "utf-16-le"
+    else:
+        encoding = "utf-16-be" if byte_order == ">" else "utf-16-le"
+    return data.decode(encoding, errors="replace")
+
+
+def decode_user_comment(value, byte_order=">"):
+    """EXIFのUserCommentを文字列に変換"""
+    prefix, body = value[:8], value[8:]
+    if prefix == USER_COMMENT_UNICODE:
+        text = _decode_utf16(body, byte_order)
+    elif prefix == USER_COMMENT_ASCII:
+        text = body.decode("utf-8", errors="replace")
+    elif prefix == USER_COMMENT_JIS:
+        text = body.decode("shift_jis", errors="replace")
+    else:
+        # 文字コード未定義の場合はUTF-8として扱う
+        text = value.lstrip(b"\x00").decode("utf-8", errors="replace")
+    return text.rstrip("\x00").strip()
+
+
+def _read_ifd_entries(tiff, offset, byte_order):
+    """IFDのエントリを {タグ: (型, 個数, 値またはオフセットのバイト列)} で返す"""
+    count = struct.unpack_from(byte_order + "H", tiff, offset)[0]
+    entries = {}
+    for i in range(count):
+        entry_offset = offset + 2 + i * 12
+        if entry_offset + 12 > len(tiff):
+            break
+        tag, type_, n = struct.unpack_from(byte_order + "HHI", tiff, entry_offset)
+        entries[tag] = (type_, n, tiff[entry_offset + 8:entry_offset + 12])
+    return entries
+
+
+def parse_exif_user_comment(tiff):
+    """TIFF形式のEXIFデータからUserCommentを取り出す（なければNone）"""
+    if tiff.startswith(EXIF_HEADER):
+        tiff = tiff[len(EXIF_HEADER):]
+    if tiff[:2] == b"II":
+        byte_order = "<"
+    elif tiff[:2] == b"MM":
+        byte_order = ">"
+    else:
+        return None
+
+    try:
+        ifd0_offset = struct.unpack_from(byte_order + "I", tiff, 4)[0]
+        ifd0 = _read_ifd_entries(tiff, ifd0_offset, byte_order)
+        if TAG_EXIF_IFD not in ifd0:
+            return None
+        exif_offset = struct.unpack(byte_order + "I", ifd0[TAG_EXIF_IFD][2])[0]
+        exif_ifd = _read_ifd_entries(tiff, exif_offset, byte_order)
+        if TAG_USER_COMMENT not in exif_ifd:
+            return None
+        _, count, raw = exif_ifd[TAG_USER_COMMENT]
+        if count <= 4:
+            value = raw[:count]
+        else:
+            value_offset = struct.unpack(byte_order + "I", raw)[0]
+            value = tiff[value_offset:value_offset + count]
+    except struct.error:
+        return None
+    return decode_user_comment(value, byte_order) or None
+
+
+def read_jpeg_metadata(fp):
+    """JPEGのセグメントを順に読み、APP1(EXIF)とSOFだけを取り出す
+
+    SOS（画像データの開始）に到達した時点で読み込みを終える。
+    """
+    if fp.read(2) != JPEG_SIGNATURE:
+        raise ValueError("Not a JPEG file")
+
+    metadata = {"format": "JPEG", "width": None, "height": None, "text": {}}
+    while True:
+        byte = fp.read(1)
+        if not byte:
+            break
+        if byte != b"\xff":
+            continue
+        marker = fp.read(1)
+        while marker == b"\xff":  # フィルバイト
+            marker = fp.read(1)
+        if not marker:
+            break
+        marker = marker[0]
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        if marker in (0xD9, 0xDA):  # EOI, SOS
+            break
+        length_bytes = fp.read(2)
+        if len(length_bytes) < 2:
+            break
+        length = struct.unpack(">H", length_bytes)[0] - 2
+        if marker == 0xE1 and "parameters" not in metadata["text"]:
+            data = fp.read(length)
+            if data.startswith(EXIF_HEADER):
+                comment = parse_exif_user_comment(data)
+                if comment:
+                    metadata["text"]["parameters"] = comment
+        elif marker == 0xFE:  # COM
+            comment = fp.read(length).decode("utf-8", errors="replace")
+            metadata["text"].setdefault("comment", comment)
+        elif marker in JPEG_SOF_MARKERS:
+            data = fp.read(length)
+            metadata["height"], metadata["width"] = struct.unpack(">HH", data[1:5])
+            # EXIFはSOFより前に置かれるため、ここで打ち切る
+            break
+        else:
+            fp.seek(length, 1)
+    return metadata
+
+
+def _webp_size(chunk_type, data):
+    if chunk_type == b"VP8X":
+        width = int.from_bytes(data[4:7], "little") + 1
+        height = int.from_bytes(data[7:10], "little") + 1
+    elif chunk_type == b"VP8 ":
+        width, height = struct.unpack("<HH", data[6:10])
+        width &= 0x3FFF
+        height &= 0x3FFF
+    else:  # VP8L
+        bits = int.from_bytes(data[1:5], "little")
+        width = (bits & 0x3FFF) + 1
+        height = ((bits >> 14) & 0x3FFF) + 1
+    return width, height
+
+
+def read_webp_metadata(fp):
+    """RIFF(WEBP)のチャンクを順に読み、サイズとEXIFチャンクだけを取り出す"""
+    header = fp.read(12)
+    if header[:4] != b"RIFF" or header[8:12] != b"WEBP":
+        raise ValueError("Not a WEBP file")
+
+    metadata = {"format": "WEBP", "width": None, "height": None, "text": {}}
+    extended = False
+    while True:
+        chunk_header = fp.read(8)
+        if len(chunk_header) < 8:
+            break
+        chunk_type, length = struct.unpack("<4sI", chunk_header)
+        padded = length + (length & 1)
+        if chunk_type in (b"VP8X", b"VP8 ", b"VP8L"):
+            data = fp.read(min(length, 10))
+            if metadata["width"] is None and len(data) >= (5 if chunk_type == b"VP8L" else 10):
+                metadata["width"], metadata["height"] = _webp_size(chunk_type, data)
+            if chunk_type == b"VP8X":
+                extended = True
+            elif not extended:
+                # 拡張形式(VP8X)でなければ画像データ以降にEXIFは存在しない
+                break
+            fp.seek(padded - len(data), 1)
+        elif chunk_type == b"EXIF":
+            comment = parse_exif_user_comment(fp.read(length))
+            if comment:
+                metadata["text"]["parameters"] = comment
+            fp.seek(padded - length, 1)
+        else:
+            fp.seek(padded, 1)
+    return metadata
+
+
+def _read_with_pillow(path):
+    # Image.open はヘッダーのみを読み、画素のデコードは行わない
+    with Image.open(path) as image:
+        text = {key: value for key, value in image.info.items() if isinstance(value, str)}
+        return {"format": image.format, "width": image.size[0],
+                "height": image.size[1], "text": text}
+
+
+def read_image_metadata(path):
+    """画像のサイズ・形式・テキストメタデータを返す
+
+    戻り値: {"format": str, "width": int, "height": int, "text": {キー: 値}}
+    """
+    with open(path, "rb") as fp:
+        header = fp.read(12)
+        fp.seek(0)
+        if header.startswith(PNG_SIGNATURE):
+            return read_png_metadata(fp)
+        if header.startswith(JPEG_SIGNATURE):
+            return read_jpeg_metadata(fp)
+        if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+            return read_webp_metadata(fp)
+    return _read_with_pillow(path)
+
+
+def get_parameters(metadata):
+    """A1111形式の生成パラメータ文字列（なければ空文字）"""
+    return metadata["text"].get("parameters", "")
@@ -0,0 +1,263 @@
+"""画素を再エンコードせずにメタデータだけを書き換えるモジュール
+
+- PNG: 指定されたキーワードのテキストチャンクだけを差し替え、それ以外のチャンク
+  （IHDR・IDATなど）はバイト列のままコピーする
+- JPEG: APP1(EXIF)セグメントの UserComment だけを書き換え、画像データはそのままコピーする
+- WEBP: EXIFチャンクの UserComment だけを書き換える
+
+書き込みは同じフォルダの一時ファイルに行い、完了後に置き換える。
+"""
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+
+import piexif
+import piexif.helper
+
+from metadata_reader import (EXIF_HEADER, JPEG_SIGNATURE, JPEG_STANDALONE_MARKERS, PNG_SIGNATURE,
+                             _webp_size)
+
+TEXT_CHUNK_TYPES = (b"tEXt", b"zTXt", b"iTXt")
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# VP8Xのフラグ
+WEBP_FLAG_EXIF = 0x08
+WEBP_FLAG_ALPHA = 0x10
+
+
+def _png_chunk(chunk_type, data):
+    crc = zlib.crc32(data, zlib.crc32(chunk_type))
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", crc)
+
+
+def make_text_chunk(keyword, text):
+    """キーワードとテキストからPNGのテキストチャンクを作る（Latin-1で表せなければiTXt）"""
+    key = keyword.encode("latin-1")
+    try:
+        return _png_chunk(b"tEXt", key + b"\x00" + text.encode("latin-1"))
+    except UnicodeEncodeError:
+        # 圧縮なし, 圧縮方式, 言語タグ(空), 翻訳キーワード(空)
+        return _png_chunk(b"iTXt", key + b"\x00\x00\x00\x00\x00" + text.encode("utf-8"))
+
+
+def _copy_bytes(src, dst, length):
+    while length > 0:
+        data = src.read(min(length, COPY_BUFFER_SIZE))
+        if not data:
+            raise ValueError("Unexpected end of file")
+        dst.write(data)
+        length -= len(data)
+
+
+def rewrite_png_text(src, dst, text):
+    """PNGのテキストチャンクを書き換える
+
+    text は {キーワード: 値}。値が None のキーワードは削除する。
+    新しいチャンクは最初のIDATの直前に置く。
+    """
+    if src.read(8) != PNG_SIGNATURE:
+        raise ValueError("Not a PNG file")
+    dst.write(PNG_SIGNATURE)
+    keywords = {keyword.encode("latin-1") for keyword in text}
+    written = False
+    while True:
+        header = src.read(8)
+        if len(header) < 8:
+            raise ValueError("Truncated PNG file")
+        length, chunk_type = struct.unpack(">I4s", header)
+        if chunk_type in TEXT_CHUNK_TYPES:
+            data = src.read(length + 4)
+            if data.partition(b"\x00")[0] in keywords:
+                continue  # 差し替え対象の古いチャンクは捨てる
+            dst.write(header + data)
+            continue
+        if chunk_type in (b"IDAT", b"IEND") and not written:
+            for keyword, value in text.items():
+                if value is not None:
+                    dst.write(make_text_chunk(keyword, value))
+            written = True
+        dst.write(header)
+        _copy_bytes(src, dst, length + 4)
+        if chunk_type == b"IEND":
+            break
+
+
+def build_exif(exif_bytes, parameters):
+    """既存のEXIF（なければ None）の UserComment を差し替えたEXIFを返す
+
+    戻り値は "Exif\\0\\0" で始まるバイト列。書き込むものがなければ None。
+    """
+    if exif_bytes is None and parameters is None:
+        return None
+    exif = piexif.load(exif_bytes) if exif_bytes else {"0th": {}, "Exif": {}, "GPS": {},
+                                                        "Interop": {}, "1st": {}, "thumbnail": None}
+    if parameters is None:
+        exif["Exif"].pop(piexif.ExifIFD.UserComment, None)
+    else:
+        exif["Exif"][piexif.ExifIFD.UserComment] = piexif.helper.UserComment.dump(
+            parameters, encoding="unicode")
+    return piexif.dump(exif)
+
+
+def rewrite_jpeg_exif(src, dst, parameters):
+    """JPEGのEXIFの UserComment を書き換える（画像データはコピーするだけ）"""
+    if src.read(2) != JPEG_SIGNATURE:
+        raise ValueError("Not a JPEG file")
+
+    # SOSまでのセグメントを読み、EXIF以外はそのまま残す
+    segments = []
+    exif_bytes = None
+    exif_position = None
+    while True:
+        marker = src.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            raise ValueError("Invalid JPEG segment")
+        if marker[1] in JPEG_STANDALONE_MARKERS:
+            segments.append(marker)
+            continue
+        if marker[1] in (0xD9, 0xDA):  # EOI, SOS（以降は画像データ）
+            src.seek(-2, 1)
+            break
+        length_bytes = src.read(2)
+        length = struct.unpack(">H", length_bytes)[0]
+        data = src.read(length - 2)
+        if marker[1] == 0xE1 and data.startswith(EXIF_HEADER) and exif_position is None:
+            exif_bytes = data
+            exif_position = len(segments)
+            continue
+        segments.append(marker + length_bytes + data)
+
+    if exif_position is None:
+        # JFIF(APP0)があればその直後に置く
+        exif_position = 1 if segments and segments[0][:2] == b"\xff\xe0" else 0
+    exif = build_exif(exif_bytes, parameters)
+    if exif is not None:
+        if len(exif) + 2 > 0xFFFF:
+            raise ValueError("Metadata is too large for a JPEG EXIF segment")
+        segments.insert(exif_position, b"\xff\xe1" + struct.pack(">H", len(exif) + 2) + exif)
+
+    dst.write(JPEG_SIGNATURE)
+    for segment in segments:
+        dst.write(segment)
+    shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+
+
+def _webp_chunk(chunk_type, data):
+    return struct.pack("<4sI", chunk_type, len(data)) + data + (b"\x00" if len(data) & 1 else b"")
+
+
+def _vp8x_data(chunk_type, head):
+    """単純形式(VP8/VP8L)のWEBPを拡張形式にするためのVP8Xチャンクのデータを作る
+
+    head は画像チャンクのデータの先頭（10バイト）。
+    """
+    width, height = _webp_size(chunk_type, head)
+    flags = 0
+    if chunk_type == b"VP8L" and head[4] & 0x10:  # alpha_is_used
+        flags |= WEBP_FLAG_ALPHA
+    return struct.pack("<I", flags) + (width - 1).to_bytes(3, "little") + (height - 1).to_bytes(3, "little")
+
+
+def _read_webp_data(src, length):
+    data = src.read(length)
+    if len(data) < length:
+        raise ValueError("Truncated WEBP file")
+    return data
+
+
+def rewrite_webp_exif(src, dst, parameters):
+    """WEBPのEXIFチャンクの UserComment を書き換える（画像チャンクはコピーするだけ）
+
+    EXIFを書き込む場合、単純形式(VP8/VP8L)は拡張形式(VP8X)にする。EXIFがなければ単純形式のまま残す。
+    """
+    header = src.read(12)
+    if header[:4] != b"RIFF" or header[8:12] != b"WEBP":
+        raise ValueError("Not a WEBP file")
+    # RIFFのサイズより短いファイルは途中で切れている（後ろに余分なデータがあれば無視する）
+    riff_end = 8 + struct.unpack("<I", header[4:8])[0]
+    if src.seek(0, os.SEEK_END) < riff_end:
+        raise ValueError("Truncated WEBP file")
+    src.seek(12)
+
+    # チャンクの位置だけを調べ、画像データは読まずに飛ばす（書き込むときにコピーする）
+    # 各チャンクは (種類, データの位置, 長さ, データの先頭)。VP8Xはデータ全体を読む
+    chunks = []
+    exif_bytes = None
+    while src.tell() + 8 <= riff_end:
+        chunk_type, length = struct.unpack("<4sI", src.read(8))
+        position = src.tell()
+        if position + length > riff_end:
+            raise ValueError("Truncated WEBP file")
+        if chunk_type == b"EXIF":
+            exif_bytes = _read_webp_data(src, length)
+        else:
+            head = _read_webp_data(src, length if chunk_type == b"VP8X" else min(length, 10))
+            chunks.append((chunk_type, position, length, head))
+        src.seek(position + length + (length & 1))
+    if not chunks:
+        raise ValueError("Invalid WEBP file")
+
+    exif = build_exif(exif_bytes, parameters)
+    first_type, _, _, first_head = chunks[0]
+    vp8x = None
+    if first_type == b"VP8X":
+        vp8x = first_head
+        del chunks[0]
+    elif exif:
+        vp8x = _vp8x_data(first_type, first_head)
+    if vp8x is not None:
+        flags = struct.unpack("<I", vp8x[:4])[0]
+        flags = flags | WEBP_FLAG_EXIF if exif else flags & ~WEBP_FLAG_EXIF
+        vp8x = struct.pack("<I", flags) + vp8x[4:]
+
+    vp8x_chunk = _webp_chunk(b"VP8X", vp8x) if vp8x is not None else b""
+    exif_chunk = _webp_chunk(b"EXIF", exif[len(EXIF_HEADER):]) if exif else b""
+    body_size = (len(vp8x_chunk) + sum(8 + length + (length & 1) for _, _, length, _ in chunks)
+                 + len(exif_chunk))
+    dst.write(b"RIFF" + struct.pack("<I", body_size + 4) + b"WEBP")
+    dst.write(vp8x_chunk)
+    for chunk_type, position, length, _ in chunks:
+        dst.write(struct.pack("<4sI", chunk_type, length))
+        src.seek(position)
+        _copy_bytes(src, dst, length)
+        if length & 1:
+            dst.write(b"\x00")
+    # EXIFは画像データより後に置く（WEBPの仕様で定められた順序）
+    dst.write(exif_chunk)
+
+
+def write_metadata(path, text, output_path=None):
+    """画像のテキストメタデータを書き換える
+
+    text は {キーワード: 値}（値が None なら削除）。JPEG/WEBP は EXIF の UserComment に
+    保存される "parameters" だけに対応する。output_path を省略すると元のファイルを置き換える。
+    """
+    output_path = output_path or path
+    with open(path, "rb") as src:
+        signature = src.read(12)
+        src.seek(0)
+        if signature.startswith(PNG_SIGNATURE):
+            rewrite = rewrite_png_text
+            value = text
+        elif signature.startswith(JPEG_SIGNATURE) or signature[8:12] == b"WEBP":
+            unsupported = set(text) - {"parameters"}
+            if unsupported:
+                raise ValueError(f"Unsupported metadata keys for this format: {', '.join(sorted(unsupported))}")
+            rewrite = rewrite_jpeg_exif if signature.startswith(JPEG_SIGNATURE) else rewrite_webp_exif
+            value = text.get("parameters")
+        else:
+            raise ValueError("Unsupported image format")
+
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output_path)),
+                                         suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as dst:
+                rewrite(src, dst, value)
+        except Exception:
+            os.remove(temp_path)
+            raise
+    # mkstemp は所有者のみ読み書きできる権限で作るため、元の権限に合わせる
+    shutil.copymode(path, temp_path)
+    os.replace(temp_path, output_path)
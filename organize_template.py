@@ -0,0 +1,275 @@
+"""整理先のフォルダ名のテンプレートと絞り込みの条件式
+
+メタデータインデックスの行から整理先のサブフォルダを決める。画像は開かない。
+
+テンプレート:
+    {model}/{sampler}/{width}x{height}   "/" でサブフォルダを区切る
+    {seed:1000000}                       数値を幅ごとの範囲にまとめる（"0-999999" など）
+    {Hires upscaler}                     設定行の任意の項目（大文字・小文字と "_" / 空白は区別しない）
+値のない項目は "Unknown" になる。
+
+条件式:
+    steps >= 30 and sampler == "Euler a"
+    not (model ~ "^sdxl") or loras != "None"
+比較は ==, !=, <, <=, >, >=, ~（正規表現、大文字・小文字を区別しない）。数値どうしは数値として比較する。
+空白を含む項目名は "_" でつなぐ（schedule_type == Karras）。値のない項目は != だけが成り立つ。
+
+項目: FIELDS と、生成パラメータの設定行の項目（"Schedule type" など）
+"""
+import operator
+import os
+import re
+from datetime import datetime
+from string import Formatter
+
+from parameters_parser import parse_parameters
+
+# テンプレート・条件式で使える項目（設定行の項目のほかに使える名前）
+FIELDS = ("model", "vae", "sampler", "seed", "steps", "cfg", "width", "height", "resolution",
+          "orientation", "megapixels", "format", "source", "loras", "year", "month", "date")
+
+# 項目の計算に必要なインデックスの列
+RECORD_COLUMNS = ("model", "vae", "sampler", "seed", "width", "height", "format", "source",
+                  "prompt", "parameters")
+
+UNKNOWN = "Unknown"
+
+_LORA = re.compile(r"<lora:([^:>]+)")
+_UNSAFE = re.compile(r'[<>:"/\\|?*\x00-\x1f]')
+_FILTER_TOKEN = re.compile(
+    r"""\s*(\(|\)|==|!=|<=|>=|<|>|~|"(?:\\.|[^"\\])*"|'[^']*'|[^\s()=!<>~"']+)""")
+_OPERATORS = {"==": operator.eq, "!=": operator.ne, "<=": operator.le, ">=": operator.ge,
+              "<": operator.lt, ">": operator.gt, "~": None}
+
+
+def _setting_key(name):
+    return re.sub(r"[\s_]+", " ", name).strip().lower()
+
+
+def orientation(width, height):
+    """縦横比から Square・Landscape・Portrait を返す（幅・高さがなければ None）"""
+    if not width or not height:
+        return None
+    ratio = width / height
+    if 0.9 <= ratio <= 1.1:
+        return "Square"
+    return "Landscape" if ratio > 1.1 else "Portrait"
+
+
+class RecordFields:
+    """インデックスの行から項目の値を取り出す（生成パラメータは必要になったときだけ解析する）"""
+
+    def __init__(self, record):
+        self.record = record
+        self._parsed = None
+        self._settings = None
+
+    @property
+    def parsed(self):
+        if self._parsed is None:
+            self._parsed = parse_parameters(self.record.get("parameters"))
+        return self._parsed
+
+    @property
+    def settings(self):
+        """設定行の {正規化した項目名: 値}"""
+        if self._settings is None:
+            self._settings = {_setting_key(key): value for key, value in self.parsed.settings.items()}
+        return self._settings
+
+    def get(self, name):
+        """項目の値（なければ None）"""
+        record = self.record
+        if name in ("model", "vae", "sampler", "seed", "width", "height", "format", "source"):
+            return record.get(name)
+        if name == "steps":
+            return self.parsed.steps
+        if name == "cfg":
+            return self.parsed.cfg_scale
+        if name == "resolution":
+            if not record.get("width") or not record.get("height"):
+                return None
+            return f"{record['width']}x{record['height']}"
+        if name == "orientation":
+            return orientation(record.get("width"), record.get("height"))
+        if name == "megapixels":
+            if not record.get("width") or not record.get("height"):
+                return None
+            return round(record["width"] * record["height"] / 1000000, 1)
+        if name == "loras":
+            names = sorted(set(_LORA.findall(record.get("prompt") or "")))
+            return "+".join(names) if names else "None"
+        if name in ("year", "month", "date"):
+            if record.get("mtime") is None:
+                return None
+            return datetime.fromtimestamp(record["mtime"]).strftime(
+                {"year": "%Y", "month": "%Y-%m", "date": "%Y-%m-%d"}[name])
+        return self.settings.get(_setting_key(name))
+
+
+def _check_field(name):
+    if not name or not re.fullmatch(r"[\w][\w \-/]*", name):
+        raise ValueError(f"Invalid field name: {name!r}")
+
+
+def _bucket(value, width):
+    """数値を幅 width ごとの範囲（"0-999" など）にする"""
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            return value
+    start = int(value // width * width)
+    return f"{start}-{start + width - 1}"
+
+
+def _safe_component(value):
+    """値をフォルダ名に使える文字列にする（区切り文字などは "_" にする）"""
+    text = _UNSAFE.sub("_", str(value)).strip().rstrip(". ")
+    return text or UNKNOWN
+
+
+class OrganizeTemplate:
+    """整理先のサブフォルダのテンプレート（不正なテンプレートは ValueError）"""
+
+    def __init__(self, template):
+        self.template = template
+        self.parts = []  # (文字列, 項目名, 範囲の幅)
+        try:
+            parsed = list(Formatter().parse(template))
+        except ValueError as e:
+            raise ValueError(f"Invalid template: {e}") from None
+        for literal, field, spec, conversion in parsed:
+            width = None
+            if field is not None:
+                field = field.strip()
+                _check_field(field)
+                if conversion:
+                    raise ValueError(f"Conversions are not supported in templates: !{conversion}")
+                if spec:
+                    try:
+                        width = int(spec)
+                    except ValueError:
+                        raise ValueError(f"Invalid range width for {{{field}}}: {spec}") from None
+                    if width <= 0:
+                        raise ValueError(f"Invalid range width for {{{field}}}: {spec}")
+            self.parts.append((literal, field, width))
+        literals = "".join(literal for literal, _, _ in self.parts)
+        if not any(field for _, field, _ in self.parts) and not literals.strip("/ "):
+            raise ValueError("Template is empty")
+        if template.startswith(("/", "\\")) or ".." in re.split(r"[/\\]", literals):
+            raise ValueError("Template must be a relative folder path")
+
+    def render(self, record):
+        """行の整理先のサブフォルダ（相対パス）を返す"""
+        fields = RecordFields(record)
+        text = []
+        for literal, field, width in self.parts:
+            text.append(literal.replace("\\", "/"))
+            if field is not None:
+                value = fields.get(field)
+                if value is None or value == "":
+                    text.append(UNKNOWN)
+                else:
+                    text.append(_safe_component(_bucket(value, width) if width else value))
+        components = [_safe_component(part) for part in "".join(text).split("/") if part.strip()]
+        return os.path.join(*components) if components else UNKNOWN
+
+
+def _number(value):
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _compare(value, name, operand):
+    if value is None:
+        return name == "!="
+    if name == "~":
+        return operand.search(str(value)) is not None
+    left, right = _number(value), _number(operand)
+    if left is None or right is None:
+        left, right = str(value).lower(), str(operand).lower()
+    return _OPERATORS[name](left, right)
+
+
+class FilterExpression:
+    """整理する画像の条件式（不正な条件式は ValueError）"""
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = _FILTER_TOKEN.findall(expression)
+        if "".join(self.tokens).replace(" ", "") != re.sub(r"\s+", "", expression):
+            raise ValueError(f"Invalid filter expression: {expression}")
+        self.position = 0
+        self.tree = self._parse_or()
+        if self.position < len(self.tokens):
+            raise ValueError(f"Unexpected {self.tokens[self.position]!r} in filter expression")
+
+    def _peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            raise ValueError("Filter expression ends unexpectedly")
+        self.position += 1
+        return token
+
+    def _parse_or(self):
+        items = [self._parse_and()]
+        while (self._peek() or "").lower() == "or":
+            self._next()
+            items.append(self._parse_and())
+        return ("or", items) if len(items) > 1 else items[0]
+
+    def _parse_and(self):
+        items = [self._parse_not()]
+        while (self._peek() or "").lower() == "and":
+            self._next()
+            items.append(self._parse_not())
+        return ("and", items) if len(items) > 1 else items[0]
+
+    def _parse_not(self):
+        if (self._peek() or "").lower() == "not":
+            self._next()
+            return ("not", self._parse_not())
+        if self._peek() == "(":
+            self._next()
+            tree = self._parse_or()
+            if self._next() != ")":
+                raise ValueError("Unbalanced parentheses in filter expression")
+            return tree
+        field = self._next()
+        _check_field(field)
+        operator = self._next()
+        if operator not in _OPERATORS:
+            raise ValueError(f"Expected a comparison after {field!r}, got {operator!r}")
+        operand = self._next()
+        if operand[:1] in ('"', "'"):
+            operand = re.sub(r"\\(.)", r"\1", operand[1:-1]) if operand[0] == '"' else operand[1:-1]
+        elif operand in ("(", ")"):
+            raise ValueError(f"Expected a value after {operator!r}")
+        if operator == "~":
+            try:
+                operand = re.compile(operand, re.IGNORECASE)
+            except re.error as e:
+                raise ValueError(f"Invalid regular expression in filter: {e}") from None
+        return ("compare", field, operator, operand)
+
+    def matches(self, record):
+        return self._evaluate(self.tree, RecordFields(record))
+
+    def _evaluate(self, tree, fields):
+        kind = tree[0]
+        if kind == "or":
+            return any(self._evaluate(item, fields) for item in tree[1])
+        if kind == "and":
+            return all(self._evaluate(item, fields) for item in tree[1])
+        if kind == "not":
+            return not self._evaluate(tree[1], fields)
+        _, field, operator, operand = tree
+        return _compare(fields.get(field), operator, operand)
@@ -0,0 +1,230 @@
+"""A1111形式の生成パラメータ文字列の解析
+
+    <プロンプト（複数行可）>
+    Negative prompt: <ネガティブプロンプト（複数行可）>
+    Steps: 20, Sampler: Euler a, CFG scale: 7, Seed: 1, Size: 512x768, Model: xxx, ...
+
+最終行の設定行は1回の走査で key: value に分解する。値は "..." で囲まれていれば
+カンマを含んでもよい（Lora hashes など）。プロンプト中に "Steps:" が現れても、
+設定行は最終行だけなので誤認しない。
+モデル名と数値の項目（Steps, CFG scale, Seed, Size）は解析時に一度だけ取り出して保持する。
+"""
+import json
+import re
+from functools import lru_cache
+
+NEGATIVE_PROMPT_PREFIX = "Negative prompt:"
+_NEGATIVE_PROMPT_LINE = "\n" + NEGATIVE_PROMPT_PREFIX
+
+# key: value の1組。値は引用符で囲まれた文字列、またはカンマまでの文字列
+_SETTING_RE = re.compile(r'\s*(\w[\w \-/]*):\s*("(?:\\.|[^\\"])*"|[^,]*)(?:,|$)')
+# キー・値の前後に空白が残る可能性がある行（まれなため、その場合だけ strip する）
+_PADDED_RE = re.compile(r"\s[:,]|\s$")
+# キーとして使える文字列（正規表現の (\w[\w \-/]*) を前後の空白なしで満たすもの）
+_KEY_RE = re.compile(r"\w(?:[\w \-/]*[\w\-/])?")
+# 確認済みのキー。キーの種類は少ないため、一度確認したものは集合の比較だけで済ませる
+_known_keys = set()
+_KNOWN_KEYS_LIMIT = 4096
+# 区切りの形を調べるため、":" と "," と ASCII の空白以外の空白文字以外のバイトを取り除く
+_NOT_SEPARATOR = bytes(byte for byte in range(256) if byte not in b":,\t\n\x0b\x0c\r\x1c\x1d\x1e\x1f")
+
+# 設定行とみなすのに必要な key: value の数（A1111本体と同じ基準）
+MIN_SETTINGS = 3
+
+
+def _unquote(value):
+    if len(value) >= 2 and value[0] == '"' and value[-1] == '"':
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value[1:-1]
+    return value
+
+
+def _split_plain(line):
+    """"key: value, key: value" の形に整った行を文字列操作だけで分解する
+
+    正規表現による分解と同じ結果になる行だけを扱い、それ以外は None を返す。
+    引用符で囲まれた値は '"' 1文字に置き換えて分解し、あとで中身を戻す。
+    """
+    parts = None
+    if '"' in line:
+        parts = line.split('"')
+        if len(parts) % 2 == 0 or "\\" in line:
+            return None
+        line = '"'.join(parts[0::2])
+    # ":" と "," がすべて区切りで、交互に並んでいること（ASCII の空白以外の空白文字もここで弾く）
+    shape = line.encode("utf-8", "surrogatepass").translate(None, _NOT_SEPARATOR)
+    if shape[-1:] != b":" or shape.count(b":,") != len(shape) >> 1:
+        return None
+    if not line.isascii() and not line.isprintable():
+        return None
+    # 区切りがすべて ": " か ", " で、前後に余分な空白がないこと（正規表現は空白を取り除くため）
+    line = line.replace(", ", ": ")
+    if " :" in line or ":  " in line or line[-1:] == " ":
+        return None
+    fields = line.split(": ")
+    if len(fields) != len(shape) + 1:
+        return None
+    values = fields[1::2]
+    if parts:
+        # 引用符で囲まれた値は、値全体が '"' 1文字になっているものだけを元に戻す
+        if values.count('"') != len(parts) >> 1:
+            return None
+        index = -1
+        for value in parts[1::2]:
+            index = values.index('"', index + 1)
+            values[index] = value
+    settings = dict(zip(fields[0::2], values))
+    if not _known_keys.issuperset(settings):
+        for key in settings.keys() - _known_keys:
+            if not _KEY_RE.fullmatch(key):
+                return None
+            if len(_known_keys) < _KNOWN_KEYS_LIMIT:
+                _known_keys.add(key)
+    return settings
+
+
+def parse_settings(line):
+    """設定行を {キー: 値} に分解する（出現順を保持）"""
+    if ":" not in line:
+        return {}
+    settings = _split_plain(line)
+    if settings is None:
+        settings = _split_regex(line)
+    return settings
+
+
+def _split_regex(line):
+    """_split_plain で扱えない行を正規表現で分解する"""
+    if _PADDED_RE.search(line):
+        settings = {key.strip(): value.strip() for key, value in _SETTING_RE.findall(line)}
+    else:
+        # 正規表現が前後の空白を取り除いているため、そのまま dict にできる
+        settings = dict(_SETTING_RE.findall(line))
+    if '"' in line:
+        for key, value in settings.items():
+            if value[:1] == '"':
+                settings[key] = _unquote(value)
+    return settings
+
+
+@lru_cache(maxsize=256)
+def _parse_size(value):
+    """"512x768" を (幅, 高さ) にする（"512 x 768" も可。それ以外は (None, None)）"""
+    if value:
+        width, _, height = value.partition("x")
+        if not (width.isdecimal() and height.isdecimal()):
+            width, height = width.rstrip(), height.lstrip()
+        if width.isdecimal() and height.isdecimal():
+            return int(width), int(height)
+    return None, None
+
+
+def _to_int(value):
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_float(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class GenerationParameters:
+    """解析済みの生成パラメータ"""
+
+    __slots__ = ("prompt", "negative_prompt", "settings", "settings_text",
+                 "model", "vae", "sampler", "steps", "cfg_scale", "seed", "width", "height")
+
+    source = "A1111"
+
+    def __init__(self, prompt="", negative_prompt="", settings=None, settings_text=""):
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.settings = settings = settings if settings is not None else {}
+        self.settings_text = settings_text
+
+        self.model = settings.get("Model")
+        self.vae = settings.get("VAE")
+        self.sampler = settings.get("Sampler")
+        self.steps = _to_int(settings.get("Steps"))
+        self.cfg_scale = _to_float(settings.get("CFG scale"))
+        self.seed = _to_int(settings.get("Seed"))
+        self.width, self.height = _parse_size(settings.get("Size"))
+
+    def format_settings(self):
+        """設定を1行に1項目の文字列にする"""
+        return "".join(f"{key}: {value}\n" for key, value in self.settings.items())
+
+    def to_text(self):
+        """A1111形式の文字列に戻す"""
+        return format_parameters_text(self.prompt, self.negative_prompt, self.settings)
+
+    def __repr__(self):
+        return (f"GenerationParameters(prompt={self.prompt!r}, "
+                f"negative_prompt={self.negative_prompt!r}, settings={self.settings!r})")
+
+
+def format_settings_line(settings):
+    """{キー: 値} を設定行にする（カンマを含む値は引用符で囲む）"""
+    items = []
+    for key, value in settings.items():
+        value = str(value)
+        if "," in value or value[:1] == '"':
+            value = json.dumps(value, ensure_ascii=False)
+        items.append(f"{key}: {value}")
+    return ", ".join(items)
+
+
+def format_parameters_text(prompt, negative_prompt, settings):
+    """プロンプト・ネガティブプロンプト・設定からA1111形式の文字列を組み立てる"""
+    lines = [prompt or ""]
+    if negative_prompt:
+        lines.append(f"{NEGATIVE_PROMPT_PREFIX} {negative_prompt}")
+    if settings:
+        lines.append(format_settings_line(settings))
+    return "\n".join(lines)
+
+
+def parse_parameters(text):
+    """生成パラメータ文字列を GenerationParameters に変換"""
+    text = (text or "").strip()
+
+    # 最終行を1回だけ分解し、項目が MIN_SETTINGS 個以上あれば設定行とする
+    settings = {}
+    settings_text = ""
+    body_end = len(text)
+    newline = text.rfind("\n")
+    last_line = text[newline + 1:]
+    candidate = _split_plain(last_line)
+    if candidate is None and last_line.count(":") >= MIN_SETTINGS:
+        candidate = _split_regex(last_line)
+    if candidate and len(candidate) >= MIN_SETTINGS:
+        settings = candidate
+        settings_text = last_line.strip()
+        body_end = max(newline, 0)
+
+    # プロンプトとネガティブプロンプトを分割（本文を切り出さずに範囲で探す）
+    if text.startswith(NEGATIVE_PROMPT_PREFIX, 0, body_end):
+        split_at = 0
+    else:
+        split_at = text.find(_NEGATIVE_PROMPT_LINE, 0, body_end)
+        if split_at >= 0:
+            split_at += 1
+    if split_at >= 0:
+        prompt = text[:split_at]
+        negative_prompt = text[split_at + len(NEGATIVE_PROMPT_PREFIX):body_end]
+    else:
+        prompt = text[:body_end]
+        negative_prompt = ""
+
+    return GenerationParameters(prompt.strip(), negative_prompt.strip(), settings, settings_text)
@@ -0,0 +1,90 @@
+"""表示サイズに合わせた縮小画像の読み込み
+
+プレビューやトリミング画面では、画像を全解像度でデコードしてから縮小するのではなく、
+表示サイズに対してもっとも安くデコードできる方法を選ぶ。
+
+- JPEG は draft() で 1/2・1/4・1/8 のスケールのまま直接デコードする
+- その他の形式はデコード後に reduce() で整数分の1にしてから LANCZOS で仕上げる
+- 表示サイズがキャッシュの範囲内なら、サムネイルキャッシュから作る
+
+load_coarse_preview() はデコードをほとんど行わずに粗いプレビューを作り、
+load_preview() が同じサイズの正確なプレビューを作る。粗いプレビューを先に表示し、
+正確なプレビューはバックグラウンドで作って差し替える。
+"""
+from PIL import Image
+
+from thumbnail_cache import THUMBNAIL_SIZES
+
+# JPEGのDCTスケーリングで選べる縮小率の最大値
+MAX_JPEG_SCALE = 8
+
+
+def fit_size(size, target):
+    """size を target に収まるよう縮小したサイズ（拡大はしない）"""
+    width, height = size
+    scale = min(target[0] / width, target[1] / height, 1)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def reduce_factor(size, display_size):
+    """display_size 以上の大きさを保てる最大の整数縮小率"""
+    return max(1, min(size[0] // display_size[0], size[1] // display_size[1]))
+
+
+def _resize(image, display_size, resample):
+    factor = reduce_factor(image.size, display_size)
+    if factor > 1:
+        # 整数分の1の縮小は画素の平均を取るだけなので、全体をLANCZOSにかけるより安い
+        image = image.reduce(factor)
+    if image.size != display_size:
+        image = image.resize(display_size, resample)
+    return image
+
+
+def _draft_mode(image):
+    # CMYKなどはdraftで色変換できないため、モードは変えずにスケールだけ指定する
+    return "RGB" if image.mode == "RGB" else None
+
+
+def load_preview(path, target, thumbnail_cache=None):
+    """target に収まるプレビューと元画像のサイズ (幅, 高さ) を返す"""
+    image = Image.open(path)
+    original_size = image.size
+    display_size = fit_size(original_size, target)
+
+    if thumbnail_cache is not None and max(display_size) <= THUMBNAIL_SIZES[-1]:
+        image.close()
+        source = thumbnail_cache.get_thumbnail(path, max(display_size))
+        return _resize(source, display_size, Image.Resampling.LANCZOS), original_size
+
+    if image.format == "JPEG":
+        # 要求サイズ以上を保てる範囲で、もっとも小さいスケールでデコードされる
+        image.draft(_draft_mode(image), display_size)
+    image.load()
+    return _resize(image, display_size, Image.Resampling.LANCZOS), original_size
+
+
+def load_coarse_preview(path, target, thumbnail_cache=None):
+    """すぐに表示できる粗いプレビューと元画像のサイズを返す
+
+    キャッシュ済みのサムネイルか、JPEGの1/8スケールのデコードから作る。
+    どちらも使えない場合、プレビューは None になる。
+    """
+    image = Image.open(path)
+    original_size = image.size
+    display_size = fit_size(original_size, target)
+
+    source = None
+    if thumbnail_cache is not None:
+        source = thumbnail_cache.find_cached(path, max(display_size))
+    if source is None and image.format == "JPEG":
+        scaled = (-(-original_size[0] // MAX_JPEG_SCALE), -(-original_size[1] // MAX_JPEG_SCALE))
+        image.draft(_draft_mode(image), scaled)
+        image.load()
+        source = image
+    if source is None:
+        image.close()
+        return None, original_size
+    if source is not image:
+        image.close()
+    return _resize(source, display_size, Image.Resampling.BILINEAR), original_size
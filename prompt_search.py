@@ -0,0 +1,230 @@
+"""プロンプトの全文検索用の正規化と検索式の変換
+
+検索はメタデータインデックスの FTS5 テーブル（転置インデックス）で行う。このモジュールでは
+インデックスに登録する文字列の作成、検索式の FTS5 の MATCH 式への変換、BM25 による順位付けを行う。
+（FTS5 の bm25() は語ごとに全一致を数えて IDF を求めるため、"masterpiece" のように
+ほぼ全件に含まれる語があると遅くなる。そのため一致が少なければ全件をこちらで順位付けし、
+多い場合は bm25() で、ほぼ全件に含まれる語がある場合は文書数の少ない語を含む新しい行から
+候補を絞ってから同じ計算で順位を付ける）
+
+プロンプトはプロンプト欄と同じくカンマ区切りの要素に分け、強調の括弧と重み
+（"(masterpiece:1.2)" → "masterpiece"）を取り除いて小文字にする。各要素は
+単語の列（prompt 列）と、要素全体を1語にしたタグ（tags 列、"long hair" → "long_hair"）の
+両方で登録する。
+
+検索式:
+    long hair            両方の単語を含む（AND）
+    "long hair"          語順どおりに続く（フレーズ）
+    tag:"long hair"      要素 "long hair" そのものを含む（tag:long_hair と同じ）
+    neg:lowres           ネガティブプロンプトの単語（negtag: はネガティブのタグ）
+    cat OR dog, -hat, NOT hat, ( ... )   論理演算と括弧
+    mast*                前方一致
+"""
+import math
+import re
+from collections import namedtuple
+
+# インデックスの列（FTS5 テーブルの列順）と、検索での重み（大きいほど順位が上がる）
+FTS_COLUMNS = ("prompt", "negative_prompt", "tags", "negative_tags")
+COLUMN_WEIGHTS = (1.0, 0.5, 2.0, 1.0)
+
+# 検索式の "field:" と対応する列
+QUERY_FIELDS = {"": "prompt", "tag": "tags", "neg": "negative_prompt", "negtag": "negative_tags"}
+
+# FTS5 のトークナイザー（タグの "_" を語の一部として扱う。分割は _WORD と一致させる）
+FTS_TOKENIZE = "unicode61 remove_diacritics 0 tokenchars '_'"
+
+# BM25 のパラメータ
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# 変換した検索式。phrases は順位付けに使う (列, 語のタプル, 前方一致か) のリスト（除外する語は含まない）
+CompiledQuery = namedtuple("CompiledQuery", ["match", "phrases"])
+
+_SEPARATOR = re.compile(r"[,\n]")
+_WEIGHT = re.compile(r":\s*-?\d+(?:\.\d+)?\s*(?=[)\]>]|$)")  # (word:1.2) の重み
+_BRACKETS = re.compile(r"[()\[\]{}<>]")
+_WORD = re.compile(r"[^\W_]+")
+_QUERY_TOKEN = re.compile(r'\s*([()]|[^\s()"]*"[^"]*"?|[^\s()"]+)')
+
+
+def normalize_element(element):
+    """プロンプトの要素から強調の括弧・重み・エスケープを取り除き、小文字にする"""
+    element = _WEIGHT.sub("", element.replace("\\", ""))
+    element = _BRACKETS.sub(" ", element).replace("_", " ")
+    return " ".join(element.lower().split())
+
+
+def prompt_elements(text):
+    """プロンプトを正規化した要素のリストにする"""
+    elements = (normalize_element(element) for element in _SEPARATOR.split(text or ""))
+    return [element for element in elements if element]
+
+
+def tag_token(element):
+    """正規化した要素を1語のタグにする（"long hair" → "long_hair"）"""
+    return "_".join(_WORD.findall(element))
+
+
+def document_fields(prompt, negative_prompt):
+    """FTS5 テーブルに登録する (prompt, negative_prompt, tags, negative_tags) を作る"""
+    positive = prompt_elements(prompt)
+    negative = prompt_elements(negative_prompt)
+    return (" ".join(positive), " ".join(negative),
+            " ".join(filter(None, map(tag_token, positive))),
+            " ".join(filter(None, map(tag_token, negative))))
+
+
+def _parse_term(term):
+    field, separator, value = term.partition(":")
+    if not separator or field.lower() not in QUERY_FIELDS or not value:
+        field, value = "", term
+    column = QUERY_FIELDS[field.lower()]
+    quoted = value.startswith('"')
+    value = value.strip('"')
+    prefix = not quoted and value.endswith("*")
+    if column in ("tags", "negative_tags"):
+        tokens = [tag_token(normalize_element(value.rstrip("*")))]
+    else:
+        tokens = _WORD.findall(value.lower())
+    tokens = tuple(token for token in tokens if token)
+    if not tokens:
+        return None
+    return column, tokens, prefix
+
+
+def phrase_expression(phrase):
+    """(列, 語のタプル, 前方一致か) を FTS5 の式にする"""
+    column, tokens, prefix = phrase
+    return f'{column} : "{" ".join(tokens)}"' + (" *" if prefix else "")
+
+
+class _QueryParser:
+    """検索式を FTS5 の MATCH 式に変換する（語は必ず引用符で囲み、FTS5 の構文として解釈させない）"""
+
+    def __init__(self, query):
+        self.tokens = _QUERY_TOKEN.findall(query)
+        self.position = 0
+        self.phrases = []
+        self.negated = 0  # NOT の内側を読んでいる深さ
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def next(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def parse(self):
+        expression = self.parse_or()
+        if self.peek() is not None:
+            raise ValueError("Unbalanced parentheses in search query")
+        return expression
+
+    def parse_or(self):
+        parts = [self.parse_and()]
+        while self.peek() == "OR":
+            self.next()
+            parts.append(self.parse_and())
+        return parts[0] if len(parts) == 1 else "(" + " OR ".join(parts) + ")"
+
+    def parse_and(self):
+        positives = []
+        negatives = []
+        while self.peek() not in (None, ")", "OR"):
+            token = self.peek()
+            if token == "AND":
+                self.next()
+                continue
+            negate = False
+            if token == "NOT":
+                self.next()
+                negate = True
+            elif token == "-":  # -( ... )
+                self.next()
+                negate = True
+            elif token.startswith("-"):
+                self.tokens[self.position] = token[1:]
+                negate = True
+            self.negated += negate
+            expression = self.parse_primary()
+            self.negated -= negate
+            if expression is not None:
+                (negatives if negate else positives).append(expression)
+        if not positives:
+            # FTS5 の NOT は二項演算子のため、除外だけの検索はできない
+            raise ValueError("Search query needs at least one term to match")
+        expression = positives[0] if len(positives) == 1 else "(" + " AND ".join(positives) + ")"
+        for negative in negatives:
+            expression = f"({expression} NOT {negative})"
+        return expression
+
+    def parse_primary(self):
+        token = self.next()
+        if token is None:
+            return None
+        if token == "(":
+            expression = self.parse_or()
+            if self.next() != ")":
+                raise ValueError("Unbalanced parentheses in search query")
+            return expression
+        phrase = _parse_term(token)
+        if phrase is None:
+            return None
+        if not self.negated:
+            self.phrases.append(phrase)
+        return phrase_expression(phrase)
+
+
+def compile_query(query):
+    """検索式を FTS5 の MATCH 式に変換する（不正な検索式は ValueError）"""
+    parser = _QueryParser(query)
+    match = parser.parse()
+    return CompiledQuery(match, list(dict.fromkeys(parser.phrases)))
+
+
+def column_tokens(column, text):
+    """FTS5 のトークナイザーと同じ分割（prompt 系の列は単語、tags 系の列は空白区切り）"""
+    return text.split() if column in ("tags", "negative_tags") else _WORD.findall(text)
+
+
+def _count_phrase(tokens, phrase, prefix):
+    """tokens の中でフレーズが現れる回数（prefix なら最後の語は前方一致）"""
+    head, last = phrase[:-1], phrase[-1]
+    if not head and not prefix:
+        return tokens.count(last)
+    count = 0
+    for i in range(len(tokens) - len(head)):
+        if tuple(tokens[i:i + len(head)]) == head:
+            token = tokens[i + len(head)]
+            if token == last or (prefix and token.startswith(last)):
+                count += 1
+    return count
+
+
+def bm25_scores(documents, phrases, document_counts, total_documents):
+    """候補の文書に BM25 の点数を付ける
+
+    documents は (rowid, {列: 本文}) のリスト、document_counts は各フレーズを含む文書数。
+    平均の長さは候補から求める。{rowid: 点数} を返す（大きいほど関連度が高い）。
+    """
+    columns = sorted({column for column, _, _ in phrases})
+    weights = dict(zip(FTS_COLUMNS, COLUMN_WEIGHTS))
+    idf = [math.log(1 + (total_documents - count + 0.5) / (count + 0.5)) for count in document_counts]
+    tokenized = [(rowid, {column: column_tokens(column, fields[column] or "") for column in columns})
+                 for rowid, fields in documents]
+    average_length = {column: max(sum(len(tokens[column]) for _, tokens in tokenized)
+                                  / max(len(tokenized), 1), 1)
+                      for column in columns}
+    scores = {}
+    for rowid, tokens in tokenized:
+        score = 0.0
+        for (column, phrase, prefix), phrase_idf in zip(phrases, idf):
+            frequency = _count_phrase(tokens[column], phrase, prefix)
+            if frequency:
+                norm = 1 - BM25_B + BM25_B * len(tokens[column]) / average_length[column]
+                score += (weights[column] * phrase_idf * frequency * (BM25_K1 + 1)
+                          / (frequency + BM25_K1 * norm))
+        scores[rowid] = score
+    return scores
@@ -0,0 +1,105 @@
+"""プロンプトの類似度（MinHash と LSH）
+
+プロンプトを正規化した要素の集合（prompt_search.prompt_elements、ネガティブプロンプトは含めない）
+として扱い、2つの集合の Jaccard 係数で似ているかを判断する。
+
+全件と比較せずに済むよう、各画像の集合から MinHash の署名（NUM_PERM 個の最小ハッシュ値）を作り、
+署名を BANDS 個の帯に分けて帯ごとのバケットに登録する（LSH）。Jaccard 係数 s の2つの集合が
+少なくとも1つのバケットを共有する確率は 1 - (1 - s^ROWS)^BANDS で、s が 0.5 付近を境に
+急に高くなる（s=0.8 で約 1.0、s=0.3 で約 0.12）。検索は同じバケットの画像だけを候補にする。
+"""
+import hashlib
+import struct
+from functools import lru_cache
+
+# 署名の長さと LSH の分け方（NUM_PERM = BANDS * ROWS）
+NUM_PERM = 64
+BANDS = 16
+ROWS = 4
+
+# 家族としてまとめる Jaccard 係数（署名からの推定値）の下限
+FAMILY_THRESHOLD = 0.5
+
+_SIGNATURE = struct.Struct(f"<{NUM_PERM}I")
+_DIGEST = struct.Struct("<16I")  # blake2b の64バイトの出力を16個のハッシュ値として使う
+_BAND = struct.Struct(f"<B{ROWS}I")
+
+
+@lru_cache(maxsize=65536)
+def _element_hashes(element):
+    """要素の NUM_PERM 個のハッシュ値（同じタグは多くの画像に現れるためキャッシュする）
+
+    関数ごとに blake2b の person を変えて独立したハッシュ関数とする。署名をデータベースに
+    保存するため、実行ごとに値が変わる hash() は使わない。
+    """
+    data = element.encode("utf-8")
+    hashes = ()
+    for i in range(NUM_PERM // 16):
+        digest = hashlib.blake2b(data, digest_size=64, person=b"minhash%d" % i).digest()
+        hashes += _DIGEST.unpack(digest)
+    return hashes
+
+
+def minhash_signature(elements):
+    """要素の集合から MinHash の署名（整数のタプル）を作る。空なら None"""
+    elements = set(elements)
+    if not elements:
+        return None
+    return tuple(map(min, zip(*map(_element_hashes, elements))))
+
+
+def signature_to_bytes(signature):
+    return _SIGNATURE.pack(*signature)
+
+
+def signature_from_bytes(data):
+    return _SIGNATURE.unpack(data)
+
+
+def band_buckets(signature):
+    """署名の各帯のバケット番号（SQLite の INTEGER に収まる符号付き64ビット）"""
+    buckets = []
+    for band in range(BANDS):
+        rows = signature[band * ROWS:(band + 1) * ROWS]
+        digest = hashlib.blake2b(_BAND.pack(band, *rows), digest_size=8).digest()
+        buckets.append(int.from_bytes(digest, "little", signed=True))
+    return buckets
+
+
+def estimate_similarity(signature, other):
+    """2つの署名から Jaccard 係数を推定する（一致した最小ハッシュ値の割合）"""
+    return sum(1 for x, y in zip(signature, other) if x == y) / NUM_PERM
+
+
+def jaccard(elements, other):
+    """2つの要素の集合の Jaccard 係数"""
+    elements, other = set(elements), set(other)
+    if not elements and not other:
+        return 0.0
+    return len(elements & other) / len(elements | other)
+
+
+class DisjointSet:
+    """画像を家族にまとめるための Union-Find"""
+
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, item):
+        root = self.parent.setdefault(item, item)
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while item != root:  # 経路を圧縮する
+            self.parent[item], item = root, self.parent[item]
+        return root
+
+    def union(self, item, other):
+        root, other_root = self.find(item), self.find(other)
+        if root != other_root:
+            self.parent[other_root] = root
+
+    def groups(self):
+        result = {}
+        for item in self.parent:
+            result.setdefault(self.find(item), []).append(item)
+        return list(result.values())
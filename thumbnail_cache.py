@@ -0,0 +1,210 @@
+"""サムネイルのディスクキャッシュ
+
+(パス, ファイルサイズ, 更新日時, サムネイルサイズ) から求めたキーで、縮小済みの
+サムネイルを WEBP（使えない環境では JPEG）で保存する。サムネイルは決まった
+いくつかのサイズだけを作り、要求サイズへはメモリ上で縮小する。
+
+キャッシュ全体の容量には上限があり、最後に使われた時刻（ファイルの更新日時）が
+古いものから削除する。書き込みは一時ファイルに行ってから置き換えるため、
+途中で終了しても壊れたサムネイルが残ることはない。
+キャッシュフォルダは既定でユーザーごとのデータフォルダに置く（app_paths を参照）。
+"""
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from PIL import Image, features
+
+from app_paths import data_path
+
+CACHE_DIR_NAME = "thumbnail_cache"
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+# 保存するサムネイルの長辺サイズ
+THUMBNAIL_SIZES = (128, 256, 1024)
+
+if features.check("webp"):
+    CACHE_FORMAT, CACHE_EXTENSION = "WEBP", ".webp"
+else:
+    CACHE_FORMAT, CACHE_EXTENSION = "JPEG", ".jpg"
+TEMP_SUFFIX = ".tmp"
+
+# 書き込み途中で終了した一時ファイルとみなす条件（起動より前で、この秒数より古い）
+# 別のスレッドや同時に起動した別のビューアーが書き込み中の一時ファイルは消さない
+STALE_TEMP_SECONDS = 60
+_PROCESS_START = time.time()
+
+
+def bucket_for(size):
+    """要求サイズを満たす最小の保存サイズ"""
+    for bucket in THUMBNAIL_SIZES:
+        if bucket >= size:
+            return bucket
+    return THUMBNAIL_SIZES[-1]
+
+
+def _fit(image, size):
+    if max(image.size) > size:
+        image.thumbnail((size, size))
+    return image
+
+
+class ThumbnailCache:
+    """スレッドセーフなサムネイルキャッシュ"""
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir or data_path(CACHE_DIR_NAME)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = None  # キャッシュファイル -> バイト数（古い順）。初回書き込み時に読み込む
+        self.total_bytes = 0
+
+    def _key_path(self, path, stat, bucket):
+        key = f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}|{bucket}"
+        digest = hashlib.sha1(key.encode("utf-8", errors="surrogatepass")).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + CACHE_EXTENSION)
+
+    def _load_entries(self):
+        """キャッシュフォルダを走査して使用量を把握する（呼び出し側でロックを取得）"""
+        found = []
+        if os.path.isdir(self.cache_dir):
+            for shard in os.scandir(self.cache_dir):
+                if not shard.is_dir():
+                    continue
+                for entry in os.scandir(shard.path):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue  # 走査中に置き換え・削除された
+                    if entry.name.endswith(TEMP_SUFFIX):
+                        if stat.st_mtime < min(_PROCESS_START, time.time() - STALE_TEMP_SECONDS):
+                            # 書き込み途中で終了した一時ファイル
+                            self._remove(entry.path)
+                        continue
+                    found.append((stat.st_mtime, entry.path, stat.st_size))
+        found.sort()
+        self.entries = OrderedDict((path, size) for _, path, size in found)
+        self.total_bytes = sum(self.entries.values())
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _read(self, cache_path):
+        try:
+            image = Image.open(cache_path)
+            image.load()
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # 壊れたキャッシュは削除して作り直す
+            self._discard(cache_path)
+            return None
+        try:
+            os.utime(cache_path)  # 最終使用時刻として記録
+        except OSError:
+            pass
+        with self.lock:
+            if self.entries is not None and cache_path in self.entries:
+                self.entries.move_to_end(cache_path)
+        return image
+
+    def _discard(self, cache_path):
+        self._remove(cache_path)
+        with self.lock:
+            if self.entries is not None and cache_path in self.entries:
+                self.total_bytes -= self.entries.pop(cache_path)
+
+    def _write(self, cache_path, image):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        if CACHE_FORMAT == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        elif image.mode not in ("RGB", "RGBA", "L", "LA"):
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix=TEMP_SUFFIX)
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                image.save(fp, CACHE_FORMAT, quality=85)
+            os.replace(temp_path, cache_path)
+        except Exception:
+            self._remove(temp_path)
+            raise
+
+        size = os.path.getsize(cache_path)
+        with self.lock:
+            if self.entries is None:
+                self._load_entries()
+            else:
+                self.total_bytes -= self.entries.pop(cache_path, 0)
+                self.entries[cache_path] = size
+                self.total_bytes += size
+            self._evict()
+
+    def _evict(self):
+        """容量の上限を超えた分を古いものから削除（呼び出し側でロックを取得）"""
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            cache_path, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self._remove(cache_path)
+
+    def get_thumbnail(self, path, size):
+        """長辺が size 以下のサムネイルを返す（キャッシュになければ作成して保存）"""
+        stat = os.stat(path)
+        bucket = bucket_for(size)
+
+        image = self._read(self._key_path(path, stat, bucket))
+        if image is not None:
+            return _fit(image, size)
+
+        # より大きいサイズのキャッシュがあれば、元画像の代わりにそれを縮小する
+        source = None
+        for larger in THUMBNAIL_SIZES:
+            if larger > bucket:
+                source = self._read(self._key_path(path, stat, larger))
+                if source is not None:
+                    break
+        if source is None:
+            # 元画像のファイルは縮小したら閉じる（close() で画素も破棄されるため縮小後の画像を複製する）
+            with Image.open(path) as original:
+                original.draft("RGB", (bucket, bucket))
+                original.thumbnail((bucket, bucket))
+                source = original.copy()
+        else:
+            source.thumbnail((bucket, bucket))
+
+        try:
+            self._write(self._key_path(path, stat, bucket), source)
+        except OSError:
+            pass  # キャッシュに書けなくても表示は続ける
+        return _fit(source, size)
+
+    def find_cached(self, path, size):
+        """キャッシュ済みのサムネイルだけを返す（元画像はデコードしない。なければ None）
+
+        size 以上のものを優先し、なければそれより小さいもののうち最大のものを返す。
+        """
+        stat = os.stat(path)
+        bucket = bucket_for(size)
+        larger = [b for b in THUMBNAIL_SIZES if b >= bucket]
+        smaller = [b for b in reversed(THUMBNAIL_SIZES) if b < bucket]
+        for candidate in larger + smaller:
+            image = self._read(self._key_path(path, stat, candidate))
+            if image is not None:
+                return image
+        return None
+
+    def clear(self):
+        with self.lock:
+            if self.entries is None:
+                self._load_entries()
+            for cache_path in self.entries:
+                self._remove(cache_path)
+            self.entries.clear()
+            self.total_bytes = 0